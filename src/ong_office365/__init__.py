@@ -1,3 +1,4 @@
+import os
 import sys
 import loguru
 
@@ -22,6 +23,14 @@ test_config = _cfg.config_test
 logger = loguru.logger
 
 
+def get_cache_dir(*subfolders: str) -> str:
+    """Returns a folder (created if it does not exist) for the local caches of the library, placed next to the
+    config file of the current user. Optional subfolders are appended to the path"""
+    path = os.path.join(os.path.dirname(_cfg.config_filename), name + "_cache", *subfolders)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 def get_email(default: str = None) -> str:
     if default:
         return default
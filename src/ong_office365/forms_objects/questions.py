@@ -62,6 +62,11 @@ class _BaseQuestion:
     def payload(self) -> dict:
         return self.question
 
+    def __getitem__(self, key: str):
+        """Gives access to fields of the payload (e.g. id or title), so sections can be used as choices of a
+        QuestionChoice before being created"""
+        return self.question[key]
+
 
 class Section(_BaseQuestion):
 
@@ -90,8 +95,8 @@ class QuestionChoice(_BaseQuestion):
         """
         Creates a new choice question
         :param title: title of the question
-        :param choices: list of strings with the choices, or list of sections to create a menu
-        that jumps to each of the sections
+        :param choices: list of strings with the choices, or list of sections (either Section objects or sections
+        created with Forms.create_section) to create a menu that jumps to each of the sections
         :param allow_other_answer: True to allow multiple options
         :param subtitle: None (default) to leave empty
         :param required: Defaults to False
@@ -0,0 +1,56 @@
+"""
+Question schema of a form: the questions that hold answers, in order, with the pandas dtype of their answers, so
+responses are decoded with a dictionary lookup per answer (see ong_forms.decode_responses)
+"""
+from __future__ import annotations
+
+from typing import NamedTuple
+
+import pandas as pd
+
+# pandas dtypes of the answers of each question type. Answers of other types are kept as strings
+QUESTION_DTYPES = {
+    "Question.Choice": "string",
+    "Question.TextField": "string",
+    "Question.Rating": "Int64",
+    "Question.NPS": "Int64",
+    "Question.DateTime": "datetime",
+}
+# Question types that do not hold answers
+NO_ANSWER_TYPES = ("Question.ColumnGroup",)
+
+
+class QuestionColumn(NamedTuple):
+    """Column of the answers to a question"""
+    id: str
+    title: str
+    type: str
+    dtype: str          # a pandas dtype or "datetime"
+
+
+class FormSchema(NamedTuple):
+    """Questions of a form that hold answers, as a dict of QuestionColumn indexed by question id (in form order)"""
+    columns: dict
+
+    @property
+    def titles(self) -> dict:
+        """Titles of the questions indexed by question id"""
+        return {question_id: column.title for question_id, column in self.columns.items()}
+
+    def convert(self, values: list, column: QuestionColumn) -> pd.Series:
+        """Converts the answers (strings or None) of a column to a Series of its dtype. Answers that cannot be
+        converted become null"""
+        if column.dtype == "datetime":
+            return pd.to_datetime(pd.Series(values, dtype="string"), errors="coerce")
+        if column.dtype == "Int64":
+            return pd.to_numeric(pd.Series(values, dtype="string"), errors="coerce").round().astype("Int64")
+        return pd.Series(values, dtype=column.dtype)
+
+
+def form_schema(questions: list) -> FormSchema:
+    """Builds the schema of a form from its questions, as received from forms api"""
+    questions = sorted((q for q in questions if q.get('type') not in NO_ANSWER_TYPES),
+                       key=lambda q: q.get('order') or 0)
+    return FormSchema(columns={q['id']: QuestionColumn(id=q['id'], title=q['title'], type=q.get('type'),
+                                                       dtype=QUESTION_DTYPES.get(q.get('type'), "string"))
+                               for q in questions})
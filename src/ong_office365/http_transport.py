@@ -0,0 +1,177 @@
+"""
+Shared http transport of the library: a requests.Session whose connections are pooled, kept alive and reused by
+every client (and thread) that uses it, so parallel workers do not pay a tcp and tls handshake per request.
+The session counts the connections it creates and the requests sent over already open ones (see ConnectionStats),
+and its requests are paced by a RequestScheduler, that retries throttled requests (see request_scheduler)
+"""
+from __future__ import annotations
+
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from ong_office365 import config, logger as log
+from ong_office365.request_scheduler import RequestScheduler
+
+DEFAULT_POOL_SIZE = 32          # Connections kept open per host
+DEFAULT_MAX_RETRIES = 3         # Retries of connection errors and of 500, 502 and 504 responses
+DEFAULT_BACKOFF_FACTOR = 0.5    # Retries wait backoff_factor * 2 ** (retry - 1) seconds
+DEFAULT_MAX_THROTTLING_RETRIES = 5  # Retries of throttled (429 and 503) requests
+# Status retried with backoff. Throttled requests (429 and 503) are retried by the scheduler instead
+RETRY_STATUS = (500, 502, 504)
+
+
+class ConnectionStats:
+    """Thread safe counters of the requests sent by a transport, split into those that had to open a new
+    connection and those that reused an open one"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def count(self, new_connection: bool):
+        with self.__lock:
+            if new_connection:
+                self.created += 1
+            else:
+                self.reused += 1
+
+    @property
+    def requests(self) -> int:
+        return self.created + self.reused
+
+    def __repr__(self):
+        return f"ConnectionStats(created={self.created}, reused={self.reused})"
+
+
+def counting_pool_classes(stats: ConnectionStats) -> dict:
+    """Returns urllib3 connection pool classes, indexed by scheme, that count in stats whether each request
+    opens a new connection or reuses one"""
+
+    class CountingMixin:
+        def _make_request(self, conn, *args, **kwargs):
+            # A connection without socket connects now (it is either new or was dropped by the server)
+            stats.count(getattr(conn, "sock", None) is None)
+            return super()._make_request(conn, *args, **kwargs)
+
+    return {"http": type("CountingHTTPConnectionPool", (CountingMixin, HTTPConnectionPool), {}),
+            "https": type("CountingHTTPSConnectionPool", (CountingMixin, HTTPSConnectionPool), {})}
+
+
+def keep_alive_socket_options() -> list:
+    """Socket options that enable tcp keep-alive probes, so idle pooled connections are not silently dropped by
+    firewalls or load balancers"""
+    options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # Probe after 60s idle, every 15s. Not all platforms allow tuning it
+    for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15), ("TCP_KEEPCNT", 4)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a sized connection pool, retries with exponential backoff, tcp keep-alive, connection
+    stats and, optionally, a RequestScheduler"""
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_factor: float = DEFAULT_BACKOFF_FACTOR, stats: ConnectionStats = None,
+                 scheduler: RequestScheduler = None):
+        """
+        Initializes adapter
+        :param pool_size: maximum number of connections kept open per host. Threads beyond it still work, but
+        their connections are closed after use instead of being returned to the pool
+        :param max_retries: retries of connection errors and of RETRY_STATUS responses (idempotent methods only)
+        :param backoff_factor: retries wait backoff_factor * 2 ** (retry - 1) seconds
+        :param stats: optional ConnectionStats to count into (a new one by default)
+        :param scheduler: optional RequestScheduler that paces requests (until their response headers arrive) and
+        retries the throttled ones
+        """
+        self.stats = stats or ConnectionStats()
+        self.scheduler = scheduler
+        # Retry-After is not honoured here, so throttled responses reach the scheduler
+        retries = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS,
+                        raise_on_status=False, respect_retry_after_header=False)
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", keep_alive_socket_options())
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = counting_pool_classes(self.stats)
+
+    def send(self, request: requests.PreparedRequest, *args, **kwargs) -> requests.Response:
+        if self.scheduler is None:
+            return super().send(request, *args, **kwargs)
+        # A body that is a stream (e.g. a file) cannot be sent twice, so its throttled response is returned
+        can_retry = request.body is None or isinstance(request.body, (bytes, str))
+        attempt = 0
+        while True:
+            self.scheduler.acquire(request.url)
+            try:
+                response = super().send(request, *args, **kwargs)
+            except Exception:
+                self.scheduler.release(request.url, None, attempt)
+                raise
+            delay = self.scheduler.release(request.url, response, attempt)
+            if delay is None or not can_retry:
+                return response
+            log.warning(f"Request throttled with status {response.status_code}, retrying in {delay:.1f}s")
+            response.close()
+            attempt += 1
+
+
+def create_session(pool_size: int = None, max_retries: int = None, backoff_factor: float = None,
+                   rate_limit: float = None, max_throttling_retries: int = None) -> requests.Session:
+    """
+    Returns a new requests.Session with a PooledHTTPAdapter mounted for http and https (sharing the same stats and
+    RequestScheduler). Parameters default to config values "http_pool_size", "http_max_retries",
+    "http_backoff_factor", "http_rate_limit" and "http_max_throttling_retries"
+    :param pool_size: connections kept open per host, that is also the maximum of requests in flight per resource
+    :param max_retries: retries of connection errors and of 500, 502 and 504 responses
+    :param backoff_factor: retries wait backoff_factor * 2 ** (retry - 1) seconds
+    :param rate_limit: maximum requests per second per resource (None for no limit)
+    :param max_throttling_retries: retries of throttled (429 and 503) requests
+    """
+    pool_size = pool_size or config("http_pool_size", DEFAULT_POOL_SIZE)
+    scheduler = RequestScheduler(max_concurrency=pool_size,
+                                 rate=rate_limit or config("http_rate_limit", None),
+                                 max_retries=config("http_max_throttling_retries", DEFAULT_MAX_THROTTLING_RETRIES)
+                                 if max_throttling_retries is None else max_throttling_retries)
+    adapter = PooledHTTPAdapter(pool_size=pool_size,
+                                max_retries=config("http_max_retries", DEFAULT_MAX_RETRIES)
+                                if max_retries is None else max_retries,
+                                backoff_factor=config("http_backoff_factor", DEFAULT_BACKOFF_FACTOR)
+                                if backoff_factor is None else backoff_factor,
+                                scheduler=scheduler)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def shared_session() -> requests.Session:
+    """Returns the session shared by all clients of the library that are not given one of their own (created on
+    first use with create_session defaults)"""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = create_session()
+        return _shared_session
+
+
+def connection_stats(session: requests.Session) -> ConnectionStats | None:
+    """Returns the ConnectionStats of a session created with create_session (None for other sessions)"""
+    return getattr(session.get_adapter("https://"), "stats", None)
+
+
+def request_scheduler(session: requests.Session) -> RequestScheduler | None:
+    """Returns the RequestScheduler of a session created with create_session (None for other sessions)"""
+    return getattr(session.get_adapter("https://"), "scheduler", None)
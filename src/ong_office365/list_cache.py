@@ -0,0 +1,67 @@
+"""
+Local copy of the items of a sharepoint list in a sqlite database, so a list can be refreshed reading only
+the items modified since last time (see Sharepoint.read_list_cached)
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+
+
+class ListCache:
+    """
+    Stores the items of a list (as received from the rest api, in json) indexed by ID, along with the latest
+    Modified timestamp seen, that is where next refresh must start from. Usage:
+    with ListCache(path) as cache:
+        cache.upsert(rows)
+        rows = cache.rows()
+    Changes are committed when the context is exited without errors
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS items (ID INTEGER PRIMARY KEY, Modified TEXT, data TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+
+    @property
+    def last_modified(self) -> str | None:
+        """Latest Modified timestamp of the cached items (in the format received from server) or None if empty"""
+        row = self.conn.execute("SELECT value FROM state WHERE key = 'last_modified'").fetchone()
+        return row[0] if row else None
+
+    def upsert(self, rows: list):
+        """Inserts or replaces items, given as a list of dicts that must include ID and Modified"""
+        if not rows:
+            return
+        self.conn.executemany("INSERT OR REPLACE INTO items (ID, Modified, data) VALUES (?, ?, ?)",
+                              [(row['ID'], row['Modified'], json.dumps(row)) for row in rows])
+        last_modified = max(row['Modified'] for row in rows)
+        if self.last_modified is None or last_modified > self.last_modified:
+            self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('last_modified', ?)",
+                              (last_modified,))
+
+    def ids(self) -> set:
+        """Returns the set of IDs of the cached items"""
+        return {row[0] for row in self.conn.execute("SELECT ID FROM items")}
+
+    def delete(self, ids: set):
+        """Deletes items given by their IDs"""
+        self.conn.executemany("DELETE FROM items WHERE ID = ?", [(item_id,) for item_id in ids])
+
+    def rows(self) -> list:
+        """Returns all cached items as a list of dicts, in ID order"""
+        return [json.loads(row[0]) for row in self.conn.execute("SELECT data FROM items ORDER BY ID")]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.close()
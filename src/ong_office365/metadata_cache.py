@@ -0,0 +1,149 @@
+"""
+Cache of metadata of sharepoint files and folders (file properties, folder listings...), so repeated calls on the
+same paths within seconds do not need a round trip each (see metadata_cache param of Sharepoint).
+Entries are kept in memory in LRU order and, optionally, in a sqlite database, so they outlive the process.
+An entry is fresh for ttl seconds. After that, if it has an ETag, it is revalidated with a conditional request
+(If-None-Match) that still costs a round trip but no payload, otherwise it is read again
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple
+
+
+class CacheEntry(NamedTuple):
+    """A cached value"""
+    value: Any              # json serializable value
+    etag: str | None        # ETag of the value, to revalidate it once expired (None if it has no ETag)
+    stored: float           # timestamp (time.time()) when value was read or last revalidated
+
+
+class CacheStats(NamedTuple):
+    """Snapshot of the counters of a MetadataCache"""
+    hits: int               # values returned from cache without any request
+    misses: int             # values that had to be read (not cached, or expired without ETag or modified)
+    revalidations: int      # expired values still valid, as told by a conditional request
+    entries: int            # entries in memory
+
+
+class MetadataCache:
+    """
+    LRU cache with TTL of json serializable values indexed by a string key, optionally backed by a sqlite file.
+    Thread safe. Usage:
+        value = cache.fetch(key, load)
+    where load(etag) reads the value from the server (conditionally if etag is not None) and returns either a
+    tuple (value, etag) or None if the value was not modified since etag
+    """
+
+    def __init__(self, ttl: float = 30, max_entries: int = 1024, path: str = None):
+        """
+        :param ttl: seconds that an entry is fresh, so it is returned with no request at all
+        :param max_entries: maximum number of entries kept (least recently used are dropped first)
+        :param path: optional path of a sqlite file to keep entries on disk too
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__revalidations = 0
+        self.__conn = None
+        if path is not None:
+            self.__conn = sqlite3.connect(path, check_same_thread=False)
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                                "(key TEXT PRIMARY KEY, value TEXT, etag TEXT, stored REAL)")
+            self.__conn.commit()
+
+    def get(self, key: str) -> CacheEntry | None:
+        """Returns the entry of key, either fresh or expired, or None if it is not cached. Does not count as
+        hit nor miss"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None and self.__conn is not None:
+                row = self.__conn.execute("SELECT value, etag, stored FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = CacheEntry(json.loads(row[0]), row[1], row[2])
+                    self.__store(key, entry, persist=False)
+            elif entry is not None:
+                self.__entries.move_to_end(key)
+            return entry
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.stored < self.ttl
+
+    def __store(self, key: str, entry: CacheEntry, persist: bool = True):
+        self.__entries[key] = entry
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+        if persist and self.__conn is not None:
+            self.__conn.execute("INSERT OR REPLACE INTO entries (key, value, etag, stored) VALUES (?, ?, ?, ?)",
+                                (key, json.dumps(entry.value), entry.etag, entry.stored))
+            # Drop the oldest entries of the file as well
+            self.__conn.execute("DELETE FROM entries WHERE key NOT IN "
+                                "(SELECT key FROM entries ORDER BY stored DESC LIMIT ?)", (self.max_entries,))
+            self.__conn.commit()
+
+    def put(self, key: str, value: Any, etag: str = None):
+        """Stores a value (fresh from now on)"""
+        with self.__lock:
+            self.__store(key, CacheEntry(value, etag, time.time()))
+
+    def fetch(self, key: str, load: Callable[[str | None], tuple | None]) -> Any:
+        """
+        Returns the value of key: from cache if it is fresh, otherwise calls load to read it (conditionally if the
+        cached value has an ETag) and caches it. Concurrent calls for the same expired key may both call load
+        :param key: key of the value
+        :param load: function that receives the ETag of the cached value (or None) and returns a tuple
+        (value, etag) or None if the value was not modified since the given ETag
+        :return: the value
+        """
+        entry = self.get(key)
+        if entry is not None and self.is_fresh(entry):
+            with self.__lock:
+                self.__hits += 1
+            return entry.value
+        result = load(entry.etag if entry is not None else None)
+        with self.__lock:
+            if result is None and entry is not None:
+                self.__revalidations += 1
+                self.__store(key, entry._replace(stored=time.time()))
+                return entry.value
+            self.__misses += 1
+            value, etag = result
+            self.__store(key, CacheEntry(value, etag, time.time()))
+            return value
+
+    def invalidate(self, *keys: str):
+        """Removes the given keys from the cache (missing keys are ignored)"""
+        with self.__lock:
+            for key in keys:
+                self.__entries.pop(key, None)
+            if self.__conn is not None:
+                self.__conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+                self.__conn.commit()
+
+    def clear(self):
+        """Removes all entries (counters are kept)"""
+        with self.__lock:
+            self.__entries.clear()
+            if self.__conn is not None:
+                self.__conn.execute("DELETE FROM entries")
+                self.__conn.commit()
+
+    @property
+    def stats(self) -> CacheStats:
+        with self.__lock:
+            return CacheStats(hits=self.__hits, misses=self.__misses, revalidations=self.__revalidations,
+                              entries=len(self.__entries))
+
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
@@ -6,15 +6,22 @@ Adapted for pyjwt 2.x using https://blog.darrenjrobinson.com/decoding-azure-ad-a
 """
 from __future__ import annotations
 
+import os
 import re
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
+import jwt
 import msal
 from msal_extensions import PersistedTokenCache, FilePersistenceWithDataProtection, KeychainPersistence, FilePersistence
+from msal_extensions import CrossPlatLock, LockError
+from msal_extensions.persistence import PersistenceNotFound
 from office365.runtime.auth.token_response import TokenResponse
 from ong_utils import decode_jwt_token
 
-from ong_office365 import logger as log
+from ong_office365 import logger as log, get_cache_dir, config
 
 
 def is_uuid(tenant) -> bool:
@@ -23,9 +30,131 @@ def is_uuid(tenant) -> bool:
     return bool(UUID_PATTERN.match(tenant))
 
 
+def token_expiry(result: dict) -> float:
+    """Returns the timestamp when the access token of a msal result expires, read from its exp claim (or from
+    expires_in if the token cannot be decoded)"""
+    try:
+        return float(decode_jwt_token(result['access_token'])['exp'])
+    except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+        return time.time() + float(result.get('expires_in', 0))
+
+
+def resource_scopes(server: str | None, scopes: list = None) -> list:
+    """Returns the scopes of the resource of a server: ms graph for None, otherwise the sharepoint tenant of the
+    server (so all sites of the same tenant get the same scopes) or the server itself if not a sharepoint url"""
+    scopes = scopes or ['.default']
+    if server is None:  # a Graph client as default
+        return [f"https://graph.microsoft.com/{scope}" for scope in scopes]
+    pattern = r"^https://(?P<tenant>\w+(-my)?).sharepoint.com/"
+    if match := re.match(pattern, server):
+        scope_tenant = match['tenant']
+        return [f"https://{scope_tenant}.sharepoint.com/{scope}" for scope in scopes]
+    return [f"{server}/{scope}" for scope in scopes]
+
+
+def pid_exists(pid: int) -> bool:
+    """True if a process with that pid is running. It cannot be checked in Windows (where os.kill would terminate
+    the process), so there it is always True"""
+    if sys.platform == "win32":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process exists, but belongs to another user
+        pass
+    return True
+
+
+def remove_stale_lock(path: str, stale_after: float) -> bool:
+    """
+    Removes a lock file of CrossPlatLock left by a process that was killed while holding it
+    :param path: path of the lock file, that holds the pid of its owner
+    :param stale_after: a lock older than these seconds is stale even if its owner is still running
+    :return: True if the lock file was stale and has been removed
+    """
+    try:
+        with open(path, "rb") as f:
+            content = f.read().split()
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return False
+    pid = int(content[0]) if content and content[0].isdigit() else None
+    if age < stale_after and (pid is None or pid_exists(pid)):
+        return False
+    log.warning(f"Removing stale lock {path} of process {pid} ({age:.0f}s old)")
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
+
+
+@contextmanager
+def process_lock(path: str, timeout: float):
+    """Cross-process lock (a msal_extensions CrossPlatLock on a file) that waits for up to timeout seconds. Locks
+    left by processes that no longer run, or older than timeout, are removed. Raises LockError if the lock cannot
+    be obtained in time"""
+    lock = CrossPlatLock(path)
+    deadline = time.monotonic() + timeout
+    while True:
+        remove_stale_lock(path, timeout)
+        try:
+            lock.__enter__()
+            break
+        except LockError:
+            if time.monotonic() > deadline:
+                raise LockError(f"Could not lock {path} in {timeout}s: it is held by another process") from None
+    try:
+        yield
+    finally:
+        lock.__exit__(None, None, None)
+
+
+class SharedTokenCache(PersistedTokenCache):
+    """
+    Token cache persisted in a file shared by several threads and processes. Besides the file lock of
+    PersistedTokenCache for writes, it keeps the modification time of the file it last read or wrote (instead of
+    the time of reading), so the in-memory copy is reloaded whenever another process changes the file, and
+    never misses a write that happened while it was being read. Reads and writes are serialized among threads
+    """
+
+    def __init__(self, persistence, lock_location=None):
+        super().__init__(persistence, lock_location)
+        self.__mtime = None  # modification time of the file when it was last read or written
+        self.__thread_lock = threading.RLock()
+
+    def _reload_if_necessary(self):
+        try:
+            mtime = self._persistence.time_last_modified()
+            if mtime != self.__mtime:
+                self.deserialize(self._persistence.load())
+                self.__mtime = mtime
+        except PersistenceNotFound:
+            # Nothing written yet
+            pass
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        with self.__thread_lock, CrossPlatLock(self._lock_location):
+            self._reload_if_necessary()
+            msal.SerializableTokenCache.modify(self, credential_type, old_entry,
+                                               new_key_value_pairs=new_key_value_pairs)
+            self._persistence.save(self.serialize())
+            self.__mtime = self._persistence.time_last_modified()
+
+    def search(self, credential_type, **kwargs):
+        with self.__thread_lock:
+            return super().search(credential_type, **kwargs)
+
+
 class MsalTokenManager:
+    # Seconds before expiration when the token in memory is no longer returned and msal is asked for a new one
+    TOKEN_EXPIRY_MARGIN = 300
+
     def __init__(self, client_id: str, email: str, server: str | None, tenant: str,
-                 scopes: list = None, timeout: int = None, logger=None):
+                 scopes: list = None, timeout: int = None, logger=None, cache_location: str = None,
+                 http_client=None, shared_manager: MsalTokenManager = None):
         """
         Initializes a token manager
         :param client_id: app client id
@@ -35,10 +164,23 @@ class MsalTokenManager:
         :param scopes: scopes to request access to, defaults to ['.default']
         :param timeout: timeout to wait for interactive flow. Defaults to 20 sec
         :param logger: optional logger, or use library default logger
+        :param cache_location: path of the token cache file, that can be shared by several processes. Defaults to
+        token_cache.bin in the per-user cache folder of the library
+        :param http_client: optional http client (e.g. a requests.Session) for msal to talk to the authority
+        :param shared_manager: optional manager (of the same client id, user and tenant) whose msal application,
+        token cache and lock are reused, so both get their tokens from the same refresh token (see TokenBroker)
         """
         self.logger = logger or log
         self.__last_scopes = None  # scopes received in token (only for fresh tokens)
         self.__last_token = None  # Last obtained token
+        self.__last_result = None  # Last successful result of msal, returned while its token does not expire
+        self.__last_expiry = 0  # Timestamp of expiration of last token
+        self.__app = None
+        self.__shared_manager = shared_manager
+        # Ensures a single token request at a time (single flight)
+        self.__lock = shared_manager.__lock if shared_manager is not None else threading.Lock()
+        self.__refresher = None  # Thread of background refresh
+        self.__stop_refresh = threading.Event()
         self.server = server
         self.email = email
         self.tenant_prefix = tenant
@@ -54,10 +196,15 @@ class MsalTokenManager:
             self.tenant_name = self.tenant_prefix + ".onmicrosoft.com"
         self.authority = 'https://login.microsoftonline.com/' + self.tenant_name
         self.client_id = client_id
-        self.location = "token_cache.bin"
         self.scopes = self.get_scopes(scopes or ['.default'])
-        self.persistence = self.msal_persistence()
-        self.cache = PersistedTokenCache(self.persistence)
+        if shared_manager is not None:
+            self.location, self.http_client = shared_manager.location, shared_manager.http_client
+            self.persistence, self.cache = shared_manager.persistence, shared_manager.cache
+        else:
+            self.location = cache_location or os.path.join(get_cache_dir(), "token_cache.bin")
+            self.http_client = http_client
+            self.persistence = self.msal_persistence()
+            self.cache = SharedTokenCache(self.persistence)
 
     @property
     def last_token(self) -> str:
@@ -66,6 +213,22 @@ class MsalTokenManager:
             self.acquire_token()
         return self.__last_token
 
+    @property
+    def token_expires_in(self) -> float:
+        """Seconds until last token expires (zero or negative if expired or there is no token yet)"""
+        return self.__last_expiry - time.time()
+
+    @property
+    def app(self) -> msal.PublicClientApplication:
+        """The msal application, created on first use and reused afterwards, as creating it involves authority
+        discovery and reading the token cache"""
+        if self.__shared_manager is not None:
+            return self.__shared_manager.app
+        if self.__app is None:
+            self.__app = msal.PublicClientApplication(client_id=self.client_id, authority=self.authority,
+                                                      token_cache=self.cache, http_client=self.http_client)
+        return self.__app
+
     @property
     def last_decoded_token(self) -> dict:
         """Return last access token decoded as a dict"""
@@ -75,22 +238,12 @@ class MsalTokenManager:
     def get_scopes(self, scopes: list = None) -> list:
         """Gets a list of scopes for auth"""
         scopes = scopes or ['.default']
-        if self.server is None:  # a Graph client as default
-            retval = [f"https://graph.microsoft.com/{scope}" for scope in scopes]
-        else:
-            pattern = r"^https://(?P<tenant>\w+(-my)?).sharepoint.com/"
-            if match := re.match(pattern, self.server):
-                scope_tenant = match['tenant']
-                retval = [f"https://{scope_tenant}.sharepoint.com/{scope}" for scope in scopes]
-            else:
-                retval = [f"{self.server}/{scope}" for scope in scopes]
-                # raise ValueError(f"Server {self.server} not understood")
+        retval = resource_scopes(self.server, scopes)
         self.logger.debug(f"{scopes=}")
         return retval
 
     def msal_cache_accounts(self, username=None):
-        app = msal.PublicClientApplication(client_id=self.client_id, authority=self.authority, token_cache=self.cache)
-        accounts = app.get_accounts(username)
+        accounts = self.app.get_accounts(username)
         return accounts
 
     def msal_persistence(self):
@@ -102,9 +255,7 @@ class MsalTokenManager:
         return FilePersistence(self.location)
 
     def msal_delegated_refresh(self, account):
-        app = msal.PublicClientApplication(
-            client_id=self.client_id, authority=self.authority, token_cache=self.cache)
-        result = app.acquire_token_silent_with_error(
+        result = self.app.acquire_token_silent_with_error(
             scopes=self.scopes, account=account)
         if result is not None and "error" in result:
             self.logger.debug(f"Error in token: error='{result.get('error')}' suberror='{result.get('suberror')}'")
@@ -115,7 +266,7 @@ class MsalTokenManager:
                                         timeout=None, port=None, extra_scopes_to_consent=None):
         self.logger.debug("Initiate an Interactive Flow (auth via Browser) to get AAD Access and Refresh Tokens.")
         timeout = timeout or self.timeout
-        app = msal.PublicClientApplication(client_id=self.client_id, authority=self.authority, token_cache=self.cache)
+        app = self.app
 
         success_template = """<html><body><script>setTimeout(function(){window.close()}, 3000);</script></body></html>"""
         welcome_template = """<html><body><script>setTimeout(function(){window.close()}, 10000);</script></body></html>"""
@@ -129,7 +280,32 @@ class MsalTokenManager:
                                                extra_scopes_to_consent=extra_scopes_to_consent)
         return result
 
+    def __is_valid(self, margin: float) -> bool:
+        """True if there is a token in memory that does not expire in the next margin seconds"""
+        return self.__last_result is not None and self.token_expires_in > margin
+
+    def __store_result(self, result: dict):
+        """Keeps a successful msal result in memory"""
+        self.__last_token = result['access_token']
+        self.__last_result = result
+        self.__last_expiry = token_expiry(result)
+        # Scopes are only received for fresh tokens. If token came from cache this is not received
+        self.__last_scopes = result.get('scopes')
+
     def acquire_token(self) -> dict:
+        """Returns a msal result with a valid access token. The last one is returned straight from memory until
+        TOKEN_EXPIRY_MARGIN seconds before its expiration, so most calls neither touch msal nor the token cache.
+        It is thread and process safe: if several threads or processes sharing the cache need a new token at once,
+        only one asks for it and the rest wait to find it in the cache"""
+        if self.__is_valid(self.TOKEN_EXPIRY_MARGIN):
+            return self.__last_result
+        with self.__lock, process_lock(self.location + ".acquire.lockfile", self.timeout + 30):
+            if self.__is_valid(self.TOKEN_EXPIRY_MARGIN):
+                # Another thread got a new token while this one was waiting
+                return self.__last_result
+            return self.__acquire_token()
+
+    def __acquire_token(self) -> dict:
         accounts = self.msal_cache_accounts(self.email)
         result = None
         if accounts:
@@ -155,11 +331,139 @@ class MsalTokenManager:
             if "error" in result:
                 self.logger.error(f"{result['error']}: {result['error_description']}")
             else:
-                self.__last_token = result['access_token']
-                # Scopes are only received for fresh tokens. If token came from cache this is not received
-                self.__last_scopes = result.get('scopes')
+                self.__store_result(result)
         return result
 
+    def refresh_token_silent(self, refresh_before: float = None) -> dict | None:
+        """
+        Renews the token using the refresh token of the cache (acquire_token_silent), never interactively, unless
+        the token in memory expires in more than refresh_before seconds. Like acquire_token, concurrent callers
+        wait for the refresh in progress instead of starting a new one
+        :param refresh_before: seconds before expiration from which token is renewed. Defaults to TOKEN_EXPIRY_MARGIN
+        :return: the msal result, or None if token could not be renewed silently
+        """
+        refresh_before = self.TOKEN_EXPIRY_MARGIN if refresh_before is None else refresh_before
+        with self.__lock, process_lock(self.location + ".acquire.lockfile", self.timeout + 30):
+            if self.__is_valid(refresh_before):
+                return self.__last_result
+            result = None
+            for account in self.msal_cache_accounts(self.email):
+                # Another process sharing the cache might have already renewed the token
+                result = self.app.acquire_token_silent(self.scopes, account=account)
+                if not result or "error" in result or token_expiry(result) - time.time() <= refresh_before:
+                    result = self.app.acquire_token_silent(self.scopes, account=account, force_refresh=True)
+                if result and "error" not in result:
+                    self.__store_result(result)
+                    self.logger.debug(f"Token renewed, expires in {self.token_expires_in:.0f}s")
+                    break
+            return result
+
+    def start_background_refresh(self, refresh_before: float = 600, retry_interval: float = 60):
+        """
+        Starts a daemon thread that renews the token (see refresh_token_silent) refresh_before seconds ahead of its
+        expiration, so long-running jobs never wait for a renewal inside a request
+        :param refresh_before: seconds before token expiration when it is renewed
+        :param retry_interval: seconds to wait before retrying a failed renewal (or to check again if there is
+        no token yet)
+        """
+        if self.__refresher is not None and self.__refresher.is_alive():
+            return
+        self.__stop_refresh.clear()
+        self.__refresher = threading.Thread(target=self.__refresh_loop, args=(refresh_before, retry_interval),
+                                            name="token_refresher", daemon=True)
+        self.__refresher.start()
+
+    def stop_background_refresh(self):
+        """Stops the thread started by start_background_refresh, if any"""
+        self.__stop_refresh.set()
+        if self.__refresher is not None:
+            self.__refresher.join()
+            self.__refresher = None
+
+    def __refresh_loop(self, refresh_before: float, retry_interval: float):
+        wait = 0
+        while not self.__stop_refresh.wait(wait):
+            if self.__last_result is None:
+                # Nothing to renew until a first token is acquired (that might need interaction)
+                wait = retry_interval
+                continue
+            if not self.__is_valid(refresh_before):
+                result = self.refresh_token_silent(refresh_before)
+                if not result or "error" in result:
+                    self.logger.warning(f"Could not renew token in background: {(result or dict()).get('error')}")
+                    wait = retry_interval
+                    continue
+            wait = self.token_expires_in - refresh_before
+            if wait <= 0:
+                # Tokens lasting less than refresh_before are renewed at half of their remaining life
+                wait = max(self.token_expires_in / 2, 1)
+
     def acquire_token_response(self) -> TokenResponse:
         result = self.acquire_token()
         return TokenResponse.from_json(result)
+
+
+class TokenBroker:
+    """
+    Single sign-in shared by several clients (e.g. Sharepoint, OneDrive and SeleniumSharepoint instances) that
+    access different resources. It holds one msal application, token cache and account, so a single refresh token
+    issues the access tokens of every resource (audience) on demand. Usage:
+        broker = TokenBroker()
+        sharepoint = Sharepoint(token_broker=broker)
+        onedrive = OneDrive(token_broker=broker)
+    """
+
+    def __init__(self, client_id: str = None, email: str = None, tenant: str = None, timeout: int = None,
+                 logger=None, cache_location: str = None, http_client=None):
+        """
+        Initializes the broker. Parameters are the same of MsalTokenManager and default to config values
+        :param client_id: app client id. Defaults to config("client_id")
+        :param email: user email for delegated authentication. Defaults to config("email")
+        :param tenant: tenant name or id. Defaults to config("tenant")
+        :param timeout: timeout to wait for interactive flow. Defaults to config("timeout") or 20 sec
+        :param logger: optional logger, or use library default logger
+        :param cache_location: path of the token cache file. Defaults to config("token_cache_location") or to
+        token_cache.bin in the per-user cache folder of the library
+        :param http_client: optional http client (e.g. a requests.Session) for msal to talk to the authority
+        """
+        self.logger = logger or log
+        self.client_id = client_id or config("client_id")
+        self.email = email or config("email")
+        self.tenant = tenant or config("tenant")
+        self.timeout = timeout or config("timeout", 20)
+        self.cache_location = cache_location or config("token_cache_location", None)
+        self.http_client = http_client
+        self.__managers = dict()  # token managers, indexed by their scopes
+        self.__lock = threading.Lock()
+        self.__selenium_token_manager = None
+
+    def token_manager(self, server: str | None, scopes: list = None) -> MsalTokenManager:
+        """
+        Returns the token manager of the resource of a server (created on first use). All of them share the
+        msal application of the broker, and each keeps the access token of its resource in memory
+        :param server: server to access (None for ms graph, or a sharepoint url, in which case all sites of the
+        same tenant share the manager)
+        :param scopes: scopes to request access to, defaults to ['.default']
+        :return: a MsalTokenManager
+        """
+        key = tuple(resource_scopes(server, scopes))
+        manager = self.__managers.get(key)
+        if manager is not None:
+            return manager
+        with self.__lock:
+            if key not in self.__managers:
+                shared_manager = next(iter(self.__managers.values()), None)
+                self.__managers[key] = MsalTokenManager(
+                    client_id=self.client_id, email=self.email, server=server, tenant=self.tenant, scopes=scopes,
+                    timeout=self.timeout, logger=self.logger, cache_location=self.cache_location,
+                    http_client=self.http_client, shared_manager=shared_manager)
+            return self.__managers[key]
+
+    def selenium_token_manager(self):
+        """Returns the SeleniumTokenManager shared by the SeleniumSharepoint instances that use this broker
+        (created on first use), so the browser login is done only once"""
+        from ong_office365.selenium_token.office365_selenium import SeleniumTokenManager
+        with self.__lock:
+            if self.__selenium_token_manager is None:
+                self.__selenium_token_manager = SeleniumTokenManager(logger=self.logger)
+            return self.__selenium_token_manager
@@ -0,0 +1,135 @@
+"""
+Helpers to build and parse OData $batch requests, that send many rest api calls in a single http request: the
+multipart $batch of sharepoint rest api and the json $batch of ms graph.
+Requests are given as dicts with keys method, url and, optionally, headers and body (a dict sent as json)
+"""
+from __future__ import annotations
+
+import email
+import json
+import uuid
+from email.policy import HTTP
+from typing import NamedTuple
+
+SHAREPOINT_BATCH_SIZE = 100     # Maximum number of requests in a sharepoint $batch
+GRAPH_BATCH_SIZE = 20           # Maximum number of requests in a ms graph $batch
+
+
+class BatchResponse(NamedTuple):
+    """Response to one of the requests of a batch"""
+    status: int         # http status code
+    headers: dict
+    body: dict | str    # parsed json if possible, otherwise text (empty for no content)
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+    @property
+    def error(self) -> str | None:
+        """Error message of a failed response (None if succeeded)"""
+        if self.ok:
+            return None
+        if isinstance(self.body, dict):
+            error = self.body.get("odata.error") or self.body.get("error") or dict()
+            message = error.get("message") if isinstance(error, dict) else error
+            if isinstance(message, dict):
+                message = message.get("value")
+            if message:
+                return f"{self.status}: {message}"
+        return f"{self.status}: {self.body}"
+
+
+def build_sharepoint_batch(requests: list) -> tuple:
+    """
+    Builds the multipart body of a sharepoint $batch request. GET requests go straight into the batch, any
+    other request goes into a changeset of its own, so a failure in one of them does not affect the rest
+    :param requests: list of dicts with method, url and optionally headers and body
+    :return: a tuple of content type (with boundary) and body as bytes
+    """
+    batch_boundary = f"batch_{uuid.uuid4()}"
+    lines = []
+    for request in requests:
+        method = request['method'].upper()
+        headers = {"Accept": "application/json;odata=nometadata"}
+        headers.update(request.get('headers') or dict())
+        body = request.get('body')
+        if body is not None:
+            headers["Content-Type"] = "application/json;odata=nometadata"
+        http = [f"{method} {request['url']} HTTP/1.1", *(f"{k}: {v}" for k, v in headers.items()), ""]
+        http.append(json.dumps(body) if body is not None else "")
+        part = ["Content-Type: application/http", "Content-Transfer-Encoding: binary", "", *http]
+        lines.append(f"--{batch_boundary}")
+        if method == "GET":
+            lines.extend(part)
+        else:
+            changeset_boundary = f"changeset_{uuid.uuid4()}"
+            lines.extend([f'Content-Type: multipart/mixed; boundary="{changeset_boundary}"',
+                          "Content-Transfer-Encoding: binary", "",
+                          f"--{changeset_boundary}", *part, f"--{changeset_boundary}--"])
+    lines.append(f"--{batch_boundary}--")
+    lines.append("")
+    return f'multipart/mixed; boundary="{batch_boundary}"', "\r\n".join(lines).encode()
+
+
+def parse_http_response(raw: bytes) -> BatchResponse:
+    """Parses a raw http response (status line, headers and body) embedded in a batch response"""
+    head, _, content = raw.replace(b"\r\n", b"\n").partition(b"\n\n")
+    status_line, *header_lines = head.decode().split("\n")
+    headers = dict(line.split(":", 1) for line in header_lines if ":" in line)
+    headers = {k.strip(): v.strip() for k, v in headers.items()}
+    text = content.decode().strip()
+    try:
+        body = json.loads(text) if text else ""
+    except ValueError:
+        body = text
+    return BatchResponse(status=int(status_line.split(" ")[1]), headers=headers, body=body)
+
+
+def parse_sharepoint_batch(content_type: str, content: bytes) -> list:
+    """
+    Parses the multipart response of a sharepoint $batch request
+    :param content_type: content type of the response (includes the boundary)
+    :param content: body of the response
+    :return: a list of BatchResponse, in the same order as the requests
+    """
+    message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + content, policy=HTTP)
+    return [parse_http_response(part.get_payload(decode=True)) for part in message.walk()
+            if part.get_content_type() == "application/http"]
+
+
+def build_graph_batch(requests: list, service_root_url: str) -> dict:
+    """
+    Builds the json body of a ms graph $batch request
+    :param requests: list of dicts with method, url (absolute or relative to service_root_url) and optionally
+    headers and body
+    :param service_root_url: root of the graph api, e.g. https://graph.microsoft.com/v1.0
+    :return: a dict to be sent as json
+    """
+    batch = []
+    for request_id, request in enumerate(requests):
+        url = request['url']
+        if url.startswith(service_root_url):
+            url = url[len(service_root_url):]
+        item = dict(id=str(request_id), method=request['method'].upper(), url=url)
+        headers = dict(request.get('headers') or dict())
+        if request.get('body') is not None:
+            headers.setdefault("Content-Type", "application/json")
+            item['body'] = request['body']
+        if headers:
+            item['headers'] = headers
+        batch.append(item)
+    return {"requests": batch}
+
+
+def parse_graph_batch(content: dict) -> list:
+    """
+    Parses the json response of a ms graph $batch request (built with build_graph_batch), whose responses might
+    come in any order
+    :param content: parsed json of the response
+    :return: a list of BatchResponse, in the same order as the requests
+    """
+    responses = sorted(content['responses'], key=lambda response: int(response['id']))
+    return [BatchResponse(status=int(response['status']), headers=response.get('headers') or dict(),
+                          body=response.get('body') if response.get('body') is not None else "")
+            for response in responses]
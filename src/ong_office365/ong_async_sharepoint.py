@@ -0,0 +1,340 @@
+"""
+Asyncio client for sharepoint file and list operations, for callers that run inside an event loop and must not
+block it (nor hop to threads for every call as Sharepoint would need).
+It talks straight to the sharepoint rest api through a pooled httpx client (HTTP/2 if the server supports it),
+and gets tokens from the same MsalTokenManager used by Sharepoint. Needs pip install httpx[http2]
+Usage:
+    async with AsyncSharepoint() as sharepoint:
+        files = await sharepoint.list_files_folder()
+        await asyncio.gather(*(sharepoint.download_file(url, "downloads") for url in files))
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import httpx
+import pandas as pd
+
+from ong_office365 import config, logger as log
+from ong_office365.msal_token_manager import MsalTokenManager, TokenBroker
+from ong_office365.ong_office365_base import Office365Base
+from ong_office365.request_scheduler import retry_after_seconds
+from ong_office365.ong_sharepoint import file_api_url, odata_string, list_query_params, flatten_lookups
+
+
+class AsyncSharepoint:
+    """
+    Async counterpart of the file and list operations of Sharepoint. All requests share a connection pool, and at
+    most max_concurrency of them are in flight at once, no matter how many coroutines are awaiting
+    """
+    LARGE_FILE_SIZE = Office365Base.LARGE_FILE_SIZE
+    MAX_THROTTLING_RETRIES = 5      # Times that a throttled request (429 or 503) is retried
+    UPLOAD_CHUNK_SIZE = 10 * 1024 * 1024        # Size of the chunks of upload sessions of large files
+
+    def __init__(self, client_id: str = None, email: str = None, server: str = None, tenant: str = None,
+                 timeout=None, logger=None, token_broker: TokenBroker = None,
+                 token_manager: MsalTokenManager = None, max_concurrency: int = 16, http2: bool = True):
+        """
+        Initializes async sharepoint instance. Parameters are the same of Sharepoint and default to config values
+        :param client_id: app client id. Defaults to config("client_id")
+        :param email: your CORPORATE email, line name@tenant. Defaults to config("email")
+        :param server: the server, typically is https://{tenant}.sharepoint.com/site/{site}. Defaults to
+        config("site_url")
+        :param tenant: tenant name (find it in Ms Entra ID configuration). Defaults to config("tenant")
+        :param timeout: time to wait for user login. Defaults to config("timeout")
+        :param logger: a logger to use instead of default library logger
+        :param token_broker: an optional TokenBroker to share sign-in with other instances (see TokenBroker)
+        :param token_manager: an optional token manager to reuse, e.g. the one of a Sharepoint instance of the same
+        server (AsyncSharepoint(server=server, token_manager=sharepoint.token_manager))
+        :param max_concurrency: maximum number of requests in flight (and of pooled connections)
+        :param http2: True (default) to use HTTP/2 where the server supports it
+        """
+        self.logger = logger or log
+        self.site_url = (server or config("site_url")).rstrip("/")
+        if token_manager is not None:
+            self.token_manager = token_manager
+        elif token_broker is not None:
+            self.token_manager = token_broker.token_manager(self.site_url)
+        else:
+            self.token_manager = MsalTokenManager(client_id=client_id or config("client_id"),
+                                                  email=email or config("email"), server=self.site_url,
+                                                  tenant=tenant or config("tenant"),
+                                                  timeout=timeout or config("timeout", 20), logger=self.logger,
+                                                  cache_location=config("token_cache_location", None))
+        self.max_concurrency = max_concurrency
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        self.client = httpx.AsyncClient(http2=http2, limits=limits, timeout=httpx.Timeout(60, connect=10))
+        self.__semaphore = None
+        self.__digest = None
+        self.__digest_expiry = 0
+        self.__throttled_until = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        """Closes the pooled connections"""
+        await self.client.aclose()
+
+    def __concurrency_limit(self) -> asyncio.Semaphore:
+        """Semaphore that limits requests in flight. Created on first use, as it must belong to the running loop"""
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.__semaphore
+
+    async def _access_token(self) -> str:
+        """Returns a valid access token. While the last one does not expire it is returned straight from memory,
+        otherwise it is renewed by the token manager in a thread, as msal is blocking"""
+        manager = self.token_manager
+        if manager.token_expires_in > manager.TOKEN_EXPIRY_MARGIN:
+            return manager.last_token
+        result = await asyncio.get_running_loop().run_in_executor(None, manager.acquire_token)
+        if not result or "access_token" not in result:
+            result = result or dict()
+            raise ValueError(f"Could not get an access token: {result.get('error')}: "
+                             f"{result.get('error_description')}")
+        return result['access_token']
+
+    async def _form_digest(self) -> str:
+        """Returns the request digest needed by sharepoint for write requests, cached until it expires"""
+        if self.__digest is None or time.monotonic() > self.__digest_expiry:
+            info = (await self._request(f"{self.site_url}/_api/contextinfo", "post", digest=False)).json()
+            # Verbose responses nest the values under "d" and "GetContextWebInformation"
+            info = info.get("d", info)
+            info = info.get("GetContextWebInformation", info)
+            self.__digest = info['FormDigestValue']
+            self.__digest_expiry = time.monotonic() + int(info.get('FormDigestTimeoutSeconds', 1800)) - 60
+        return self.__digest
+
+    async def __acquire_slot(self):
+        """Waits for the end of throttling (if any) and then for a free slot. Waiting for throttling does not hold
+        a slot, so it is checked again once the slot is acquired, as throttling might have been extended"""
+        semaphore = self.__concurrency_limit()
+        while True:
+            wait = self.__throttled_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await semaphore.acquire()
+            if self.__throttled_until <= time.monotonic():
+                return
+            semaphore.release()
+
+    @asynccontextmanager
+    async def _stream(self, url: str, method: str = "get", headers: dict = None, digest: bool = True, **kwargs):
+        """
+        Sends an authenticated request and yields its response before reading its body, so it can be streamed.
+        The request waits for a free slot if max_concurrency requests are already in flight, and keeps it until the
+        body is read. Throttled requests (429 or 503) release their slot and are retried after the time told by the
+        Retry-After header, and meanwhile every other request waits as well
+        :param url: absolute url of the request
+        :param method: http method (get, post...)
+        :param headers: optional additional headers. Accept defaults to json without metadata
+        :param digest: for methods other than get, True (default) to send the form digest
+        :param kwargs: any other argument for httpx.AsyncClient.build_request (params, content, json...)
+        :return: a httpx.Response object, that has already been checked with raise_for_status
+        """
+        request_headers = {"Accept": "application/json;odata=nometadata",
+                           "Authorization": f"Bearer {await self._access_token()}"}
+        if digest and method.lower() != "get":
+            request_headers["X-RequestDigest"] = await self._form_digest()
+        request_headers.update(headers or dict())
+        for attempt in range(self.MAX_THROTTLING_RETRIES + 1):
+            await self.__acquire_slot()
+            try:
+                request = self.client.build_request(method.upper(), url, headers=request_headers, **kwargs)
+                resp = await self.client.send(request, stream=True)
+                try:
+                    if resp.status_code in (429, 503) and attempt < self.MAX_THROTTLING_RETRIES:
+                        delay = retry_after_seconds(resp, attempt)
+                        self.logger.warning(f"Request throttled with status {resp.status_code}, "
+                                            f"retrying in {delay:.1f}s")
+                        self.__throttled_until = max(self.__throttled_until, time.monotonic() + delay)
+                        continue
+                    resp.raise_for_status()
+                    yield resp
+                    return
+                finally:
+                    await resp.aclose()
+            finally:
+                self.__concurrency_limit().release()
+
+    async def _request(self, url: str, method: str = "get", headers: dict = None, digest: bool = True,
+                       **kwargs) -> httpx.Response:
+        """
+        Sends an authenticated request and reads its response, with the same concurrency limit and retries of
+        throttled requests as _stream
+        :param url: absolute url of the request
+        :param method: http method (get, post...)
+        :param headers: optional additional headers. Accept defaults to json without metadata
+        :param digest: for methods other than get, True (default) to send the form digest
+        :param kwargs: any other argument for httpx.AsyncClient.build_request (params, content, json...)
+        :return: a httpx.Response object, that has already been checked with raise_for_status
+        """
+        async with self._stream(url, method, headers, digest, **kwargs) as resp:
+            await resp.aread()
+        return resp
+
+    def __folder_api_url(self, folder_relative_url: str = None) -> str:
+        """Returns rest api url of a folder given its server relative url (root folder of documents if None)"""
+        if folder_relative_url is None:
+            return f"{self.site_url}/_api/web/DefaultDocumentLibrary()/RootFolder"
+        return f"{self.site_url}/_api/web/GetFolderByServerRelativeUrl({odata_string(folder_relative_url)})"
+
+    async def list_folders(self, folder_relative_url: str = None) -> dict:
+        """
+        Gets list of folders of a certain resource as a dict indexed by folder relative url
+        :param folder_relative_url: optional parameter with the server relative URL. If None, list root folder
+        :return: dict of folder properties indexed by folder server relative url
+        """
+        resp = await self._request(f"{self.__folder_api_url(folder_relative_url)}/Folders")
+        return {f['ServerRelativeUrl']: f for f in resp.json()['value']}
+
+    async def list_files_folder(self, folder_relative_url: str = None) -> dict:
+        """
+        Gets list of files of a certain folder_relative_url as a dict indexed by file relative url
+        :param folder_relative_url: optional parameter with the server relative URL. If None, list root folder
+        :return: dict of file properties indexed by file server relative url
+        """
+        resp = await self._request(f"{self.__folder_api_url(folder_relative_url)}/Files")
+        return {f['ServerRelativeUrl']: f for f in resp.json()['value']}
+
+    async def download_file(self, server_relative_url: str, path: str = None) -> str:
+        """
+        Downloads a file, streaming its contents to disk
+        :param server_relative_url: server relative url of the file
+        :param path: local folder to download to (current folder if None)
+        :return: local path of the downloaded file
+        """
+        destination = os.path.join(path or "", os.path.basename(server_relative_url))
+        async with self._stream(f"{file_api_url(self.site_url, server_relative_url)}/$value") as resp:
+            with open(destination, "wb") as local_file:
+                async for chunk in resp.aiter_bytes():
+                    local_file.write(chunk)
+        self.logger.debug("[Ok] file has been downloaded: {0}".format(destination))
+        return destination
+
+    async def upload_file(self, local_path: str, target_folder: str = None) -> str:
+        """
+        Uploads a local file to sharepoint. Files of LARGE_FILE_SIZE or more are sent in chunks through an upload
+        session
+        :param local_path: path of the local file
+        :param target_folder: example: "Shared Documents/archive". If None, root folder of Documents is used
+        :return: server relative url of the uploaded file
+        """
+        size = os.path.getsize(local_path)
+        add_url = f"{self.__folder_api_url(target_folder)}/Files/add" \
+                  f"(url={odata_string(os.path.basename(local_path))},overwrite=true)"
+        with open(local_path, "rb") as f:
+            if size < self.LARGE_FILE_SIZE:
+                file = (await self._request(add_url, "post", content=f.read())).json()
+            else:
+                file = (await self._request(add_url, "post", content=b"")).json()
+                file_url = file_api_url(self.site_url, file['ServerRelativeUrl'])
+                upload_id = f"uploadId=guid'{uuid.uuid4()}'"
+                offset = 0
+                while True:
+                    chunk = f.read(self.UPLOAD_CHUNK_SIZE)
+                    if offset + len(chunk) >= size:
+                        await self._request(f"{file_url}/FinishUpload({upload_id},fileOffset={offset})", "post",
+                                            content=chunk)
+                        break
+                    action = f"StartUpload({upload_id})" if offset == 0 else \
+                        f"ContinueUpload({upload_id},fileOffset={offset})"
+                    resp = await self._request(f"{file_url}/{action}", "post", content=chunk)
+                    offset = int(resp.json()['value'])
+                    f.seek(offset)
+        self.logger.debug("File has been uploaded into: {0}".format(file['ServerRelativeUrl']))
+        return file['ServerRelativeUrl']
+
+    async def exits(self, file_url: str) -> bool:
+        """
+        Checks if file exits
+        :param file_url: server relative url, example -> "/sites/site/Shared Documents/Financial Sample.xlsx"
+        :return: True or False
+        """
+        try:
+            await self._request(file_api_url(self.site_url, file_url), params={"$select": "Exists"})
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return False
+            raise ValueError(e.response.text)
+        return True
+
+    def __list_api_url(self, list_title: str = None, list_id: str = None) -> str:
+        """Returns the rest api url of a list given either by title or id (only one of them)"""
+        if (list_title is None) == (list_id is None):
+            raise ValueError("Only one parameter must be informed")
+        if list_id is not None:
+            return f"{self.site_url}/_api/web/lists(guid'{list_id}')"
+        return f"{self.site_url}/_api/web/lists/GetByTitle({odata_string(list_title)})"
+
+    async def __read_pages(self, url: str, params: dict) -> list:
+        """Returns the rows of all pages of a paged rest api collection, following next links"""
+        rows = []
+        while url:
+            page = (await self._request(url, params=params)).json()
+            rows.extend(page['value'])
+            # Next link already includes all query params
+            url, params = page.get('odata.nextLink'), None
+        return rows
+
+    async def read_list(self, list_title: str = None, list_id: str = None, columns: list = None,
+                        filter: str = None, order_by: str = None, window_size: int = None,
+                        page_size: int = 5000) -> pd.DataFrame:
+        """
+        Reads a list either with list title or list id. Only one of them must be informed.
+        Returns list as a pandas DataFrame indexed by ID
+        :param list_title: name of the list
+        :param list_id: guid of the list
+        :param columns: optional list of columns to read (all if None). Properties of lookup/person fields are
+        requested as "Field/Property" (e.g. "Author/Title") and returned as a column with that name
+        :param filter: optional odata filter evaluated in the server, e.g. "Status eq 'Open'"
+        :param order_by: optional odata sort order, e.g. "Modified desc"
+        :param window_size: if informed, the range of IDs of the list is split in windows of window_size ids
+        that are read concurrently and then merged in ID order. Not compatible with order_by
+        :param page_size: number of items requested in each page
+        :return: a pandas DataFrame
+        """
+        list_url = self.__list_api_url(list_title, list_id)
+        params = dict(list_query_params(columns, filter, order_by), **{"$top": page_size})
+        if window_size is None:
+            rows = await self.__read_pages(f"{list_url}/items", params)
+        elif order_by:
+            raise ValueError("order_by cannot be used with window_size, as items are returned in ID order")
+        else:
+            rows = await self.__read_list_windows(list_url, params, window_size)
+        rows = [flatten_lookups(row, columns or []) for row in rows]
+        df = pd.DataFrame(rows, columns=["ID"] + [c for c in columns if c != "ID"] if columns else None)
+        return df.set_index("ID")
+
+    async def __read_list_windows(self, list_url: str, params: dict, window_size: int) -> list:
+        """Returns all rows of the items of a list, read concurrently in windows of window_size consecutive IDs
+        (filtered with "ID ge x and ID lt y", besides the filter in params). Rows are returned in ID order"""
+
+        async def first_id(order: str) -> int | None:
+            resp = await self._request(f"{list_url}/items",
+                                       params={"$select": "ID", "$orderby": f"ID {order}", "$top": 1})
+            rows = resp.json()['value']
+            return rows[0]['ID'] if rows else None
+
+        min_id, max_id = await asyncio.gather(first_id("asc"), first_id("desc"))
+        if min_id is None:
+            return []
+        user_filter = params.get("$filter")
+
+        def window_params(start: int) -> dict:
+            window = f"ID ge {start} and ID lt {start + window_size}"
+            return dict(params, **{"$filter": f"({user_filter}) and {window}" if user_filter else window,
+                                   "$top": min(window_size, params["$top"])})
+
+        windows = await asyncio.gather(*(self.__read_pages(f"{list_url}/items", window_params(start))
+                                         for start in range(min_id, max_id + 1, window_size)))
+        self.logger.debug(f"Read {sum(len(rows) for rows in windows)} items in {len(windows)} windows")
+        return [row for rows in windows for row in rows]
@@ -3,16 +3,52 @@ Uses the un-documented forms api
 """
 from __future__ import annotations
 
+import copy
 import datetime
 import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator, NamedTuple
 
 from dotenv import dotenv_values
 import pandas as pd
-
-from ong_office365 import logger as log
-from ong_office365.forms_objects.questions import Section, QuestionText, QuestionChoice
+import requests
+
+from ong_office365 import logger as log, get_cache_dir
+from ong_office365.forms_objects.questions import Section, QuestionText, QuestionChoice, Order, serialize_json
+from ong_office365.forms_objects.schema import FormSchema, form_schema
+from ong_office365.http_transport import create_session
+from ong_office365.response_cache import ResponseCache
+from ong_office365.metadata_cache import MetadataCache
+from ong_office365.ong_office365_base import write_parquet
 from ong_office365.selenium_token.office365_selenium import SeleniumTokenManager
 
+FORMS_BASE_URL = "https://forms.office.com"
+# Columns with the info of each response added by get_form_responses and get_pandas_result when all_info=True
+RESPONSE_INFO_COLUMNS = ['ID', 'Hora de inicio', 'Hora de finalizacion', 'Correo electrónico', 'Nombre']
+# Code of the error of forms api when reading the questions of a form of another user
+OTHER_USER_FORM_ERROR = 707
+
+
+def error_code(error) -> int | None:
+    """
+    Returns the code of an error of forms api
+    :param error: the 'error' of a failed query, that is the body of the response (bytes or str) or its json
+    :return: the code as an int, or None if the error has no numeric code
+    """
+    if isinstance(error, (bytes, str)):
+        try:
+            error = json.loads(error)
+        except ValueError:
+            return None
+    if isinstance(error, dict) and isinstance(error.get('error'), dict):
+        error = error['error']
+    try:
+        return int(error['code'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
 
 def remove_sections(questions: list) -> list:
     """Removes sections from question list"""
@@ -20,39 +56,123 @@ def remove_sections(questions: list) -> list:
     return retval
 
 
+def decode_responses(responses: list, schema: FormSchema, all_info: bool = False,
+                     first_id: int | None = 1) -> pd.DataFrame:
+    """
+    Decodes a page of responses (as received from forms api, with answers as a json string) into a DataFrame with
+    a column per question of schema, typed according to the question type, so every page has the same columns and
+    dtypes
+    :param responses: list of responses
+    :param schema: the FormSchema of the form (see Forms.get_form_schema)
+    :param all_info: if True, adds RESPONSE_INFO_COLUMNS first
+    :param first_id: ID of the first response of the page (they are numbered consecutively). If None, ID is the id
+    of each response in forms api
+    :return: a DataFrame with a row per response
+    """
+    values = {question_id: [None] * len(responses) for question_id in schema.columns}
+    for row, response in enumerate(responses):
+        for answer in json.loads(response['answers']):
+            if (column := values.get(answer['questionId'])) is not None:
+                column[row] = answer['answer1']
+    # Built by position, as several questions may have the same title
+    df = pd.DataFrame({position: schema.convert(values[question_id], column)
+                       for position, (question_id, column) in enumerate(schema.columns.items())},
+                      index=range(len(responses)))
+    df.columns = [column.title for column in schema.columns.values()]
+    if all_info:
+        info = pd.DataFrame({
+            'ID': range(first_id, first_id + len(responses)) if first_id is not None else
+            pd.Series([r['id'] for r in responses], dtype="int64"),
+            'Hora de inicio': pd.to_datetime([r['startDate'] for r in responses], utc=True),
+            'Hora de finalizacion': pd.to_datetime([r['submitDate'] for r in responses], utc=True),
+            'Correo electrónico': pd.Series([r['responder'] for r in responses], dtype="string"),
+            'Nombre': pd.Series([r['responderName'] for r in responses], dtype="string"),
+        })
+        df = pd.concat([info, df], axis=1)
+    return df
+
+
+class FormExport(NamedTuple):
+    """Result of the export of a form (see Forms.export_forms)"""
+    form_id: str
+    data: pd.DataFrame | None       # responses, as returned by iter_form_responses. None if export failed
+    error: str | None               # None if export succeeded
+
+
 class Forms:
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, base_url: str = None, token_manager=None, schema_cache: MetadataCache = None):
+        """
+        Initializes forms instance, logging in
+        :param logger: a logger to use instead of default library logger
+        :param base_url: url of ms forms. Defaults to FORMS_BASE_URL
+        :param token_manager: an object with the get_auth_forms_session and clear_cache methods of a
+        SeleniumTokenManager, that is the default
+        :param schema_cache: optional MetadataCache for the questions of forms (see get_form_schema). Defaults to an
+        in memory cache whose entries are revalidated after 5 minutes
+        """
         self.logger = logger or log
-        self.token_manager = SeleniumTokenManager(logger=logger)
+        self.schema_cache = schema_cache or MetadataCache(ttl=300)
+        self.token_manager = token_manager or SeleniumTokenManager(logger=logger)
         self.session = None
+        self.__base_url = (base_url or FORMS_BASE_URL).rstrip("/")
+        self.__api_base_url = f"{self.__base_url}/formapi/api/"
+        # Each thread sends requests with its own copy of self.session (see __thread_session). A new login
+        # increases __login_count, so threads know that their copies are outdated
+        self.__login_lock = threading.Lock()
+        self.__login_count = 0
+        self.__local = threading.local()
         self.login()
         if self.session is None:
             raise ValueError("Could not log in")
-        self.__base_url = "https://forms.office.com"
-        self.__api_base_url = f"{self.__base_url}/formapi/api/"
 
     def login(self, fresh=False):
         if fresh:
             self.token_manager.clear_cache()
-        self.token_manager.get_auth_forms_session()
-        self.session = self.token_manager.get_auth_forms_session()
+        # A pooled session (see http_transport), whose connections are shared by the sessions of all threads
+        self.session = self.token_manager.get_auth_forms_session(session=create_session())
+        self.__login_count += 1
+
+    def __relogin(self, login_count: int):
+        """Logs in again after an AntiForgery error of a request sent with the session of login number login_count.
+        Only the first thread that gets the error logs in: the rest wait for it and then reuse the new session"""
+        with self.__login_lock:
+            if self.__login_count == login_count:
+                self.logger.info("Forms session expired, logging in again")
+                self.login(fresh=True)
+
+    def __thread_session(self) -> tuple:
+        """Returns a tuple of the session of current thread, that has the cookies and headers (including the
+        __requestverificationtoken) of self.session and shares its connection pool, and its login number"""
+        with self.__login_lock:
+            # Waits here while another thread logs in
+            login_count = self.__login_count
+        local = self.__local
+        if getattr(local, "login_count", None) != login_count:
+            session = requests.Session()
+            session.cookies.update(self.session.cookies)
+            session.headers.update(self.session.headers)
+            for prefix, adapter in self.session.adapters.items():
+                session.mount(prefix, adapter)
+            local.session, local.login_count = session, login_count
+        return local.session, login_count
 
     def __query_entity(self, entity: str, method="get", json_data=None, params=None):
         return self.__query(method=method, url=self.__api_base_url + entity, params=params, json_data=json_data)
 
     def __query(self, url: str, method="get", params=None, json_data=None, retry=False) -> dict:
-        resp = self.session.request(method=method, url=url, params=params, json=json_data)
+        session, login_count = self.__thread_session()
+        resp = session.request(method=method, url=url, params=params, json=json_data)
         try:
             resp.raise_for_status()
         except:
             if not retry:
                 if "AntiForgery token validation error" in resp.text:
                     # Try again with a new fresh login
-                    self.login(fresh=True)
+                    self.__relogin(login_count)
                     return self.__query(url, method, params, json_data, retry=True)
             else:
-                print(resp.content)
+                self.logger.debug(f"Error response of {method} {url}: {resp.content}")
                 raise
         try:
             retval = resp.json()
@@ -98,9 +218,8 @@ class Forms:
     def get_form_responses(self, form_id: str, all_info: bool = False) -> list:
         """Uses all_info to get a dict with all info about each answer as a list. It can return multiple answers for the
         same user"""
-        questions = self.get_form_questions(form_id)
-        resp = self.__query_entity(f"forms('{form_id}')/responses")
-        responses = resp['value']
+        questions = self.get_form_schema(form_id).titles
+        responses = (r for page in self.__iter_response_pages(form_id) for r in page)
         retval = list()
         for idx, r in enumerate(responses):
             answers = json.loads(r['answers'])
@@ -120,9 +239,160 @@ class Forms:
             retval.append(answers_dict)
         return retval
 
+    def __iter_response_pages(self, form_id: str, page_size: int = 1000, filter: str = None) -> Iterator[list]:
+        """Yields the pages of responses of a form (as received from forms api), requested with $top and $skip and
+        an optional odata filter. Always yields at least one page, even if empty"""
+        skip = 0
+        while True:
+            params = {"$top": page_size, "$skip": skip}
+            if filter:
+                params["$filter"] = filter
+            resp = self.__query_entity(f"forms('{form_id}')/responses", params=params)
+            if "error" in resp:
+                raise ValueError(f"Error reading responses of form {form_id}: {resp['error']}")
+            page = resp['value']
+            if page or skip == 0:
+                yield page
+            if len(page) < page_size:
+                return
+            skip += len(page)
+
+    def iter_form_responses(self, form_id: str, page_size: int = 1000, all_info: bool = False,
+                            version: str = None) -> Iterator[pd.DataFrame]:
+        """
+        Yields the responses of a form in DataFrames of page_size responses, as each page is received ($top and
+        $skip), so big forms neither time out nor need all responses in memory at once. Answers are decoded into a
+        column per question (all pages have the same columns)
+        :param form_id: id of the form
+        :param page_size: number of responses requested in each page
+        :param all_info: if True, adds RESPONSE_INFO_COLUMNS (ID, start and submit times, email and name)
+        :param version: optional modifiedDate of the form, to check the cached schema (see get_form_schema)
+        :return: an iterator of DataFrames
+        """
+        schema = self.get_form_schema(form_id, version=version)
+        first_id = 1
+        for page in self.__iter_response_pages(form_id, page_size):
+            yield decode_responses(page, schema, all_info, first_id=first_id)
+            first_id += len(page)
+
+    def export_form_responses(self, form_id: str, path: str, page_size: int = 1000, all_info: bool = True) -> int:
+        """
+        Writes the responses of a form into a csv or parquet file (according to path extension, parquet needs
+        pyarrow) page by page, so memory used does not depend on the number of responses
+        :param form_id: id of the form
+        :param path: path of the file to write, either .csv or .parquet
+        :param page_size: number of responses requested in each page
+        :param all_info: if True, adds RESPONSE_INFO_COLUMNS (ID, start and submit times, email and name)
+        :return: number of responses written
+        """
+        pages = self.iter_form_responses(form_id, page_size=page_size, all_info=all_info)
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".parquet":
+            return write_parquet(pages, path)
+        if extension != ".csv":
+            raise ValueError(f"Unsupported file type {extension}, use .csv or .parquet")
+        rows = 0
+        for df in pages:
+            df.to_csv(path, mode="w" if rows == 0 else "a", header=rows == 0, index=False)
+            rows += len(df)
+        return rows
+
+    def __poll_responses(self, form_id: str, cache: ResponseCache, since=None, page_size: int = 1000) -> list:
+        """Reads the responses submitted after the cursor of the form in cache (and after since, if given), adds
+        them to cache and returns them"""
+        last_id = cache.cursor(form_id).last_id or 0
+        since_date = None
+        if isinstance(since, int):
+            last_id = max(last_id, since)
+        elif since is not None:
+            since_date = pd.Timestamp(since)
+            if since_date.tzinfo is None:
+                since_date = since_date.tz_localize("UTC")
+        new_responses = list()
+        for page in self.__iter_response_pages(form_id, page_size, filter=f"id gt {last_id}"):
+            # Filter is applied again, in case the server ignored it
+            page = [r for r in page if r['id'] > last_id and
+                    (since_date is None or pd.Timestamp(r['submitDate']) > since_date)]
+            cache.add(form_id, page)
+            new_responses.extend(page)
+        self.logger.debug(f"Read {len(new_responses)} new responses of form {form_id} after response {last_id}")
+        return new_responses
+
+    @staticmethod
+    def __responses_cache_path(cache_dir: str = None) -> str:
+        return os.path.join(cache_dir or get_cache_dir("forms"), "responses.sqlite")
+
+    def get_new_responses(self, form_id: str, since: int | str | datetime.datetime = None, page_size: int = 1000,
+                          cache_dir: str = None) -> pd.DataFrame:
+        """
+        Returns the responses of a form submitted since the previous call, so polling costs as much as the number of
+        new responses. Responses are appended to a local cache (a sqlite file, see ResponseCache), that keeps the
+        last response read of each form as the cursor where next call starts from (see get_cached_responses to read
+        them all)
+        :param form_id: id of the form
+        :param since: optional start for this call: either a response id or a submit date (str or datetime,
+        UTC if it has no timezone). Responses before the cursor are never returned again
+        :param page_size: number of responses requested in each page
+        :param cache_dir: folder of the cache file. Defaults to a "forms" folder in the library cache folder
+        :return: a DataFrame with RESPONSE_INFO_COLUMNS (ID is the id of the response) and a column per question
+        """
+        schema = self.get_form_schema(form_id)
+        with ResponseCache(self.__responses_cache_path(cache_dir)) as cache:
+            new_responses = self.__poll_responses(form_id, cache, since, page_size)
+        return decode_responses(new_responses, schema, all_info=True, first_id=None)
+
+    def get_cached_responses(self, form_id: str, page_size: int = 1000, cache_dir: str = None) -> pd.DataFrame:
+        """
+        Same as get_new_responses, but returns all responses in the local cache, that is, all the responses read so
+        far (including the new ones)
+        :param form_id: id of the form
+        :param page_size: number of responses requested in each page
+        :param cache_dir: folder of the cache file. Defaults to a "forms" folder in the library cache folder
+        :return: a DataFrame with RESPONSE_INFO_COLUMNS (ID is the id of the response) and a column per question
+        """
+        schema = self.get_form_schema(form_id)
+        with ResponseCache(self.__responses_cache_path(cache_dir)) as cache:
+            self.__poll_responses(form_id, cache, page_size=page_size)
+            responses = cache.responses(form_id)
+        return decode_responses(responses, schema, all_info=True, first_id=None)
+
+    def export_forms(self, form_ids: Iterable[str], max_workers: int = 8, page_size: int = 1000,
+                     all_info: bool = True) -> Iterator[FormExport]:
+        """
+        Reads the responses of many forms concurrently, yielding each form as soon as it finishes. Threads share
+        the authentication and connection pool of this instance: if the session expires, only one of them logs in
+        again while the others wait
+        :param form_ids: ids of the forms
+        :param max_workers: number of forms read concurrently
+        :param page_size: number of responses requested in each page
+        :param all_info: if True, adds RESPONSE_INFO_COLUMNS (ID, start and submit times, email and name)
+        :return: an iterator of FormExport, in the order in which forms finish
+        """
+        # Versions of the own forms, so their cached schemas are checked with a single request
+        versions = {form['id']: form.get('modifiedDate') for form in self.get_forms(include_deleted=True)}
+
+        def export(form_id: str) -> pd.DataFrame:
+            pages = self.iter_form_responses(form_id, page_size=page_size, all_info=all_info,
+                                             version=versions.get(form_id))
+            return pd.concat(pages, ignore_index=True)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(export, form_id): form_id for form_id in form_ids}
+            try:
+                for future in as_completed(futures):
+                    form_id = futures[future]
+                    try:
+                        result = FormExport(form_id, future.result(), None)
+                    except Exception as e:
+                        self.logger.error(f"Error exporting form {form_id}: {e}")
+                        result = FormExport(form_id, None, str(e))
+                    yield result
+            finally:
+                for future in futures:
+                    future.cancel()
+
     def get_public_questions(self, form_id: str) -> dict:
-        url = f"https://forms.office.com/handlers/ResponsePageStartup.ashx?id={form_id}&origin=lprLink&route=shorturl&mobile=false"
-        url = f"https://forms.office.com/handlers/ResponsePageStartup.ashx?id={form_id}"
+        url = f"{self.__base_url}/handlers/ResponsePageStartup.ashx?id={form_id}"
         js = self.__query(url)
         questions = js['data']['form']['questions']
         groups = dict()
@@ -150,23 +420,61 @@ class Forms:
         return result
         pass
 
-    def get_form_questions(self, form_id: str):
+    def __get_questions(self, form_id: str) -> list:
+        """Returns the questions of a form as received from forms api. Questions of forms of other users are read
+        from their response page"""
         resp = self.__query_entity(f"forms('{form_id}')/questions")
-        if "error" in resp:
-            if int(resp['error']['code']) == 707:
-                return self.get_public_questions(form_id=form_id)
-        # Removes sections
-        questions = remove_sections(resp['value'])
-        retval = dict()
-        for q in questions:
-            retval[q['id']] = q['title']
-            # q['subtitle'] is also interesting
-        return retval
-
-    def get_pandas_result(self, form_id: str) -> pd.DataFrame:
-        answers = self.get_form_responses(form_id, all_info=True)
-        df = pd.DataFrame(answers).set_index("Nombre", drop=False)
-        return df
+        if "error" not in resp:
+            return resp['value']
+        if error_code(resp['error']) != OTHER_USER_FORM_ERROR:
+            raise ValueError(f"Error reading questions of form {form_id}: {resp['error']}")
+        url = f"{self.__base_url}/handlers/ResponsePageStartup.ashx?id={form_id}"
+        return self.__query(url)['data']['form']['questions']
+
+    def __get_form_version(self, form_id: str) -> str | None:
+        """Returns the last modification date of a form, that changes whenever its questions do (None if it
+        cannot be read, e.g. for forms of other users)"""
+        resp = self.__query_entity(f"forms('{form_id}')", params={"$select": "id,modifiedDate"})
+        return resp.get('modifiedDate') if "error" not in resp else None
+
+    def get_form_schema(self, form_id: str, version: str = None) -> FormSchema:
+        """
+        Returns the question schema of a form (its questions with the dtypes of their answers), memoized in
+        schema_cache. Once the cached schema expires, it is kept if the modification date of the form did not
+        change, otherwise questions are read again
+        :param form_id: id of the form
+        :param version: optional modifiedDate of the form (e.g. from get_forms), so a cached schema of that same
+        version is used with no request at all
+        :return: a FormSchema
+        """
+        if version is not None:
+            entry = self.schema_cache.get(form_id)
+            if entry is not None and entry.etag != version:
+                self.schema_cache.invalidate(form_id)
+            elif entry is not None and not self.schema_cache.is_fresh(entry):
+                self.schema_cache.put(form_id, entry.value, entry.etag)
+
+        def load(etag: str | None) -> tuple | None:
+            current_version = version or self.__get_form_version(form_id)
+            if etag is not None and current_version == etag:
+                return None
+            return self.__get_questions(form_id), current_version
+
+        return form_schema(self.schema_cache.fetch(form_id, load))
+
+    def get_form_questions(self, form_id: str) -> dict:
+        """Returns the titles of the questions of a form (but sections) indexed by question id. Forms of other users
+        cannot be read from forms api, so for them it returns get_public_questions (titles grouped by section)"""
+        resp = self.__query_entity(f"forms('{form_id}')", params={"$select": "id,modifiedDate"})
+        if "error" in resp and error_code(resp['error']) == OTHER_USER_FORM_ERROR:
+            return self.get_public_questions(form_id)
+        return self.get_form_schema(form_id, version=resp.get('modifiedDate')).titles
+
+    def get_pandas_result(self, form_id: str, page_size: int = 1000) -> pd.DataFrame:
+        """Returns a DataFrame with all responses of a form, indexed by responder name. Responses are read and
+        decoded page by page (see iter_form_responses)"""
+        df = pd.concat(self.iter_form_responses(form_id, page_size=page_size, all_info=True), ignore_index=True)
+        return df.set_index("Nombre", drop=False)
 
     def create_entity(self, entity: str, **kwargs) -> dict:
         """Entity can be forms, forms('id')/questions, etc, etc"""
@@ -194,6 +502,78 @@ class Forms:
         q_question = self.create_entity(entity=f"forms('{form_id}')/questions", **question.payload())
         return q_question
 
+    @staticmethod
+    def __flatten_spec(items: list) -> list:
+        """Flattens the items of a form spec into a list of Section and questions, in form order"""
+        flat = list()
+        for item in items:
+            if isinstance(item, (tuple, list)):
+                section, questions = item
+                flat.append(section)
+                flat.extend(questions)
+            else:
+                flat.append(item)
+        return flat
+
+    def create_form_from_spec(self, spec: dict, max_workers: int = 8) -> dict:
+        """
+        Creates a whole form (sections and questions) at once. Ids and order of all items are computed locally, so
+        they are created concurrently instead of one after another, and menus (QuestionChoice whose choices are
+        sections) are fixed afterwards if the server assigned other ids to the sections. Example:
+            sections = [Section(f"Section {i}", to_the_end=True) for i in range(3)]
+            spec = dict(title="My form", description="Subtitle", items=[
+                (Section("Menu"), [QuestionChoice("Go to", choices=sections)]),
+                *[(section, [QuestionText(f"Question of {section['title']}")]) for section in sections]])
+            form = forms.create_form_from_spec(spec)
+        :param spec: a dict with the title of the form, the list of its items and, optionally, any other argument
+        of create_form (e.g. description). Each item is either a Section, a QuestionChoice, a QuestionText or a
+        tuple of a Section and the list of its questions
+        :param max_workers: number of items created concurrently
+        :return: the created form, with the created items in "questions" (in form order)
+        :raises ValueError: if the form or any of its items cannot be created. A partially created form is deleted
+        """
+        spec = dict(spec)
+        # Items are copied, so orders are set without modifying the spec (that can be used again)
+        items = copy.deepcopy(self.__flatten_spec(spec.pop("items")))
+        order = Order()
+        for item in items:
+            item.question['order'] = order.next()
+        form = self.create_form(**spec)
+        if "error" in form:
+            raise ValueError(f"Error creating form: {form['error']}")
+        form_id = form['id']
+
+        def create(item) -> dict:
+            if isinstance(item, Section):
+                return self.create_section(form_id, item)
+            return self.create_question(form_id, item)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                created = list(executor.map(create, items))
+            errors = [c['error'] for c in created if "error" in c]
+            if errors:
+                raise ValueError(f"Error creating {len(errors)} items of form {form_id}: {errors[0]}")
+        except Exception:
+            # Do not leave a half-created form behind
+            self.logger.error(f"Deleting form {form_id}, that could not be completely created")
+            self.delete_form(form_id)
+            raise
+        # Branches point to local ids of sections, that must be replaced if the server assigned new ones
+        new_ids = {item['id']: c['id'] for item, c in zip(items, created) if item['id'] != c['id']}
+        menus = [(item, c) for item, c in zip(items, created) if isinstance(item, QuestionChoice)] if new_ids else []
+        for item, c in menus:
+            question_info = json.loads(item['questionInfo'])
+            branches = [choice['BranchInfo'] for choice in question_info['Choices'] if "BranchInfo" in choice]
+            if any(branch['TargetQuestionId'] in new_ids for branch in branches):
+                for branch in branches:
+                    branch['TargetQuestionId'] = new_ids.get(branch['TargetQuestionId'], branch['TargetQuestionId'])
+                c['questionInfo'] = serialize_json(question_info)
+                self.__query_entity(f"forms('{form_id}')/questions('{c['id']}')", method="patch",
+                                    json_data=dict(questionInfo=c['questionInfo']))
+        self.logger.debug(f"Created form {form_id} with {len(created)} items")
+        return dict(form, questions=created)
+
     def delete_form(self, form_id: str):
         """Permanently deletes form"""
         self.__query_entity(f"forms('{form_id}')", method="delete")
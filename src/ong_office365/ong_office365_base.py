@@ -1,10 +1,72 @@
 from __future__ import annotations
 
+import json
+import os
+import posixpath
 from abc import abstractmethod
-from ong_office365.msal_token_manager import MsalTokenManager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable, Iterator
+
+import requests
+from office365.runtime.http.http_method import HttpMethod
+from office365.runtime.http.request_options import RequestOptions
+from ong_office365.http_transport import shared_session, connection_stats, ConnectionStats, request_scheduler
+from ong_office365.msal_token_manager import MsalTokenManager, TokenBroker
 from ong_office365 import config, logger as log
 from tqdm import tqdm
 
+SYNC_STATE_FILE = ".ong_sync.json"     # Name of the file that keeps the state of sync_library in local folder
+
+
+def load_transfer_state(path: str) -> dict | None:
+    """Reads a json state file (such as the progress of an upload/download). None if not found or invalid"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_transfer_state(path: str, state: dict):
+    """Writes a json state file atomically, so an interruption never leaves it half written"""
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def remove_transfer_state(path: str):
+    """Removes a json state file, if exists"""
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def write_parquet(frames: Iterable, path: str) -> int:
+    """
+    Writes DataFrames (with index) into a parquet file one by one as they come, so the whole data never needs to be
+    in memory. All frames must have the same columns and dtypes. Needs pyarrow
+    :param frames: an iterable of pandas DataFrames
+    :param path: path of the parquet file
+    :return: number of rows written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("pyarrow is needed to write parquet files. Install it with pip install pyarrow")
+    writer = None
+    rows = 0
+    try:
+        for df in frames:
+            table = pa.Table.from_pandas(df, schema=writer.schema if writer else None, preserve_index=True)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+            rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
 
 class DownloadProgressBar(tqdm):
     """
@@ -80,9 +142,16 @@ class Office365Base:
     def client_id(self) -> str:
         return self.__get_config("client_id")
 
+    @property
+    def token_cache_location(self) -> str | None:
+        """Path of the token cache file, shared by all instances (and processes) that use it. Defaults to
+        config(config_key, "token_cache_location") or, if not configured, to a file in the library cache folder"""
+        return self.__get_config("token_cache_location", None)
+
     def __init__(self, client_id: str = None, email: str = None, server: str | None = None,
                  tenant: str = None, init_context: callable = None,
-                 to_token_response: bool = True, timeout: int = None, logger=None):
+                 to_token_response: bool = True, timeout: int = None, logger=None,
+                 token_broker: TokenBroker = None, session: requests.Session = None):
         """
         Initializes sharepoint instance
         :param client_id: List of client ids could be found in
@@ -97,19 +166,138 @@ class Office365Base:
         :param to_token_response: True (default) to use acquire_token_response or false to use acquire_token
         :param timeout: time for waiting for user login. Defaults to config(config_key, "timeout")
         :param logger: an optional logger. Defaults to library default logger
+        :param token_broker: an optional TokenBroker to get tokens from, shared with other instances. If informed,
+        client_id, email, tenant and timeout are taken from it
+        :param session: optional requests.Session for all http requests of this instance. Defaults to the pooled
+        session shared by all instances (see http_transport.shared_session)
         """
         self.logger = logger or log
+        self._session = session
         client_id = client_id or self.client_id
         email = email or self.email
         tenant = tenant or self.tenant
         server = server or self.server
-        self.token_manager = MsalTokenManager(client_id=client_id, email=email, server=server,
-                                              tenant=tenant, scopes=self.scopes, timeout=timeout or self.timeout,
-                                              logger=self.logger)
+        if token_broker is not None:
+            self.token_manager = token_broker.token_manager(server, self.scopes)
+        else:
+            self.token_manager = MsalTokenManager(client_id=client_id, email=email, server=server,
+                                                  tenant=tenant, scopes=self.scopes, timeout=timeout or self.timeout,
+                                                  logger=self.logger, cache_location=self.token_cache_location)
         if to_token_response:
             self.ctx = init_context(self.token_manager.acquire_token_response)
         else:
             self.ctx = init_context(self.token_manager.acquire_token)
+        self.ctx.with_transport(session=self.session)
+
+    @property
+    def session(self) -> requests.Session:
+        """Session used for all http requests, either of self.ctx or raw (see _request). Unless another one was
+        given, it is the pooled session shared by all instances"""
+        if getattr(self, "_session", None) is None:
+            self._session = shared_session()
+        return self._session
+
+    @property
+    def connection_stats(self) -> ConnectionStats | None:
+        """Counters of connections created and reused by the session (None if it is not a pooled session)"""
+        return connection_stats(self.session)
+
+    @property
+    def request_stats(self) -> dict:
+        """Stats of requests (count, throttled, time waiting...) of the session, as a dict of ResourceStats indexed
+        by resource (host). Empty if the session has no RequestScheduler"""
+        scheduler = request_scheduler(self.session)
+        return scheduler.stats if scheduler is not None else dict()
+
+    def _request(self, url: str, method: str = "get", headers: dict = None, **kwargs) -> requests.Response:
+        """
+        Sends a raw http request authenticated with the same credentials as self.ctx. Used for calls
+        that do not fit into office365 queries, such as streamed or concurrent transfers. It is thread safe,
+        as it does not touch the query queue of self.ctx.
+        As any other request of the session, it is paced by the RequestScheduler of the session (if any), that
+        retries throttled requests after the time told by the Retry-After header
+        :param url: absolute url of the request
+        :param method: http method (get, post...)
+        :param headers: optional additional headers
+        :param kwargs: any other argument for requests.Session.request (data, json, stream...)
+        :return: a requests.Response object, that has already been checked with raise_for_status
+        """
+        options = RequestOptions(url)
+        options.method = HttpMethod(method.upper())
+        # Runs the same handlers as the ctx (authentication and, for sharepoint, form digest)
+        self.ctx.pending_request().beforeExecute(options)
+        options.headers.update(headers or dict())
+        resp = self.session.request(method, url, headers=options.headers, auth=options.auth, **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    def _batch(self, operations: list) -> list:
+        """
+        Sends a list of requests in a single $batch call. Optional hook: child classes that support batches must
+        give it (see Sharepoint and OneDrive), and it is used by _batch_many. Without it, batch methods raise
+        NotImplementedError
+        :param operations: list of requests, as dicts of method, url and optional headers and body
+        :return: a BatchResponse for each request, in the same order
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support $batch requests")
+
+    def _batch_many(self, keys: list, operations: list, batch_size: int, max_workers: int) -> tuple:
+        """
+        Sends many requests grouped in $batch calls of batch_size requests, that are sent concurrently
+        :param keys: a key that identifies each request, e.g. the url of the file it refers to
+        :param operations: list of requests (dicts of method, url and optional headers and body), in the same
+        order as keys
+        :param batch_size: number of requests of each $batch call
+        :param max_workers: number of $batch calls sent concurrently
+        :return: a tuple of two dicts indexed by key: the BatchResponse received for each request (either
+        succeeded or not), and the error of the requests without response (e.g. their whole batch failed)
+        """
+        responses, errors = dict(), dict()
+
+        def send_batch(start: int):
+            batch_keys = keys[start:start + batch_size]
+            try:
+                batch_responses = self._batch(operations[start:start + batch_size])
+            except requests.RequestException as e:
+                self.logger.error(f"Error sending batch: {e}")
+                errors.update((key, str(e)) for key in batch_keys)
+                return
+            responses.update(zip(batch_keys, batch_responses))
+            errors.update((key, "No response received in batch") for key in batch_keys[len(batch_responses):])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(send_batch, range(0, len(operations), batch_size)))
+        return responses, errors
+
+    @staticmethod
+    def _walk(root: str, list_folder: Callable[[str], tuple], max_depth: int = None,
+              max_workers: int = 8) -> Iterator[tuple]:
+        """
+        Walks a folder tree listing folders concurrently: the subfolders of a folder are queued for listing as soon
+        as it is listed, so siblings (and cousins) are listed in parallel instead of one after another
+        :param root: folder to start from
+        :param list_folder: function that receives a folder and returns a tuple (folder, folders, files), where
+        folder is the (normalized) path of the folder and folders and files are dicts of properties indexed by name
+        :param max_depth: maximum depth of folders to list (0 lists only root). None for no limit
+        :param max_workers: number of folders listed concurrently
+        :return: an iterator of the tuples returned by list_folder, in the order in which folders are listed
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {executor.submit(list_folder, root): 0}
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        depth = pending.pop(future)
+                        folder, folders, files = future.result()
+                        if max_depth is None or depth < max_depth:
+                            for name in folders:
+                                pending[executor.submit(list_folder, posixpath.join(folder, name))] = depth + 1
+                        yield folder, folders, files
+            finally:
+                # Generator was closed or failed: do not list folders that nobody will read
+                for future in pending:
+                    future.cancel()
 
     def me(self):
         me = self.ctx.web.current_user.get().execute_query()
@@ -3,7 +3,17 @@ Adaptation of samples of office365.onedrive to use msal token cache
 Uses ms graph. Try what can be done with ms graph in
 https://developer.microsoft.com/en-us/graph/graph-explorer
 """
-from ong_office365.ong_office365_base import Office365Base
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator
+from urllib.parse import quote
+
+import requests
+
+from ong_office365.msal_token_manager import TokenBroker
+from ong_office365.odata_batch import build_graph_batch, parse_graph_batch, GRAPH_BATCH_SIZE
+from ong_office365.ong_office365_base import Office365Base, load_transfer_state, save_transfer_state, SYNC_STATE_FILE
 from office365.onedrive.driveitems.driveItem import DriveItem
 from office365.graph_client import GraphClient
 
@@ -15,10 +25,11 @@ class OneDrive(Office365Base):
         return "onedrive"
 
     def __init__(self, client_id: str = None, email: str = None, tenant: str = None, server=None,
-                 timeout=None, logger=None):
+                 timeout=None, logger=None, token_broker: TokenBroker = None, session: requests.Session = None):
         server = None  # server is not needed in Graph clients, such as Onedrive
         super().__init__(client_id=client_id, email=email, server=server, tenant=tenant,
-                         init_context=GraphClient, to_token_response=False, timeout=timeout, logger=logger)
+                         init_context=GraphClient, to_token_response=False, timeout=timeout, logger=logger,
+                         token_broker=token_broker, session=session)
 
     def drives(self):
         drives = self.ctx.drives.get().top(100).execute_query()
@@ -47,3 +58,226 @@ class OneDrive(Office365Base):
         drives = self.ctx.drives.get().top(100).execute_query()
         for drive in drives:
             self.logger.info("Drive url: {0}".format(drive.web_url))
+
+    def _batch(self, operations: list) -> list:
+        """Sends a list of requests (dicts of method, url and optional headers and body) in a single ms graph $batch
+        call. Returns a BatchResponse for each request"""
+        root_url = self.ctx.service_root_url
+        resp = self._request(f"{root_url}/$batch", "post", json=build_graph_batch(operations, root_url))
+        return parse_graph_batch(resp.json())
+
+    def __item_api_url(self, path: str) -> str:
+        """Returns the ms graph url of a drive item of current user given its path relative to drive root"""
+        return f"{self.ctx.service_root_url}/me/drive/root:/{quote(path.strip('/'))}"
+
+    def __list_folder(self, path: str) -> tuple:
+        """Lists a folder for walk. Returns a tuple of its path and dicts of properties of its subfolders and files
+        indexed by name"""
+        root_url = self.ctx.service_root_url
+        url = f"{self.__item_api_url(path)}:/children" if path else f"{root_url}/me/drive/root/children"
+        params = {"$top": 999}
+        folders, files = dict(), dict()
+        while url:
+            page = self._request(url, params=params).json()
+            for item in page['value']:
+                (folders if "folder" in item else files)[item['name']] = item
+            # Next link already includes all query params
+            url, params = page.get('@odata.nextLink'), None
+        return path, folders, files
+
+    def walk(self, root: str = "", max_depth: int = None, max_workers: int = 8) -> Iterator[tuple]:
+        """
+        Walks the folder tree of root in the drive of current user, like os.walk, yielding a tuple
+        (path, folders, files) for each folder, where folders and files are dicts of properties of drive items
+        (id, name, size, eTag, lastModifiedDateTime...) of its subfolders and files indexed by name.
+        Sibling folders are listed concurrently and each folder is yielded as soon as it is listed, so folders do
+        not come in top-down order (though a folder always comes before its subfolders) and, unlike os.walk,
+        removing entries from folders does not prune the walk
+        :param root: path of the folder to start from relative to drive root, e.g. "Documents". Defaults to root
+        :param max_depth: maximum depth of folders to list (0 lists only root). None for no limit
+        :param max_workers: number of folders listed concurrently
+        :return: an iterator of tuples (path, folders, files)
+        """
+        yield from self._walk(root.strip("/"), self.__list_folder, max_depth, max_workers)
+
+    def get_files_many(self, paths: Iterable[str], batch_size: int = GRAPH_BATCH_SIZE, max_workers: int = 4) -> tuple:
+        """
+        Gets the properties (id, name, size, eTag, lastModifiedDateTime...) of many drive items of current user,
+        sending the requests in $batch requests of batch_size items
+        :param paths: paths of the items relative to drive root, e.g. "Documents/report.xlsx"
+        :param batch_size: number of items requested in each $batch request (20 at most)
+        :param max_workers: number of $batch requests sent concurrently
+        :return: a tuple of two dicts indexed by path: the properties of the items found, and the error of the rest
+        (e.g. not found)
+        """
+        paths = list(paths)
+        operations = [dict(method="get", url=self.__item_api_url(path)) for path in paths]
+        responses, errors = self._batch_many(paths, operations, min(batch_size, GRAPH_BATCH_SIZE), max_workers)
+        properties = dict()
+        for path, response in responses.items():
+            if response.ok:
+                properties[path] = response.body
+            else:
+                errors[path] = response.error
+        return properties, errors
+
+    def exists_many(self, paths: Iterable[str], batch_size: int = GRAPH_BATCH_SIZE, max_workers: int = 4) -> tuple:
+        """
+        Checks if many drive items of current user exist, sending the checks in $batch requests of batch_size items
+        :param paths: paths of the items relative to drive root, e.g. "Documents/report.xlsx"
+        :param batch_size: number of items checked in each $batch request (20 at most)
+        :param max_workers: number of $batch requests sent concurrently
+        :return: a tuple of two dicts indexed by path: True or False for the items that could be checked, and
+        the error of the rest
+        """
+        paths = list(paths)
+        operations = [dict(method="get", url=self.__item_api_url(path) + "?$select=id") for path in paths]
+        responses, errors = self._batch_many(paths, operations, min(batch_size, GRAPH_BATCH_SIZE), max_workers)
+        exists = dict()
+        for path, response in responses.items():
+            if response.ok or response.status == 404:
+                exists[path] = response.ok
+            else:
+                errors[path] = response.error
+        return exists, errors
+
+    def delete_many(self, paths: Iterable[str], batch_size: int = GRAPH_BATCH_SIZE, max_workers: int = 4) -> tuple:
+        """
+        Deletes many drive items of current user, sending the deletions in $batch requests of batch_size items
+        :param paths: paths of the items relative to drive root, e.g. "Documents/report.xlsx"
+        :param batch_size: number of items deleted in each $batch request (20 at most)
+        :param max_workers: number of $batch requests sent concurrently
+        :return: a tuple of the list of paths of deleted items and a dict of errors indexed by path
+        """
+        paths = list(paths)
+        operations = [dict(method="delete", url=self.__item_api_url(path)) for path in paths]
+        responses, errors = self._batch_many(paths, operations, min(batch_size, GRAPH_BATCH_SIZE), max_workers)
+        deleted = list()
+        for path, response in responses.items():
+            if response.ok:
+                deleted.append(path)
+            else:
+                errors[path] = response.error
+        self.logger.info(f"Deleted {len(deleted)} items, {len(errors)} errors")
+        return deleted, errors
+
+    def __read_delta(self, delta_url: str) -> tuple:
+        """Reads all pages of a drive delta query. Returns a tuple of the list of changed items and the delta link
+        for next query"""
+        items = list()
+        url = delta_url
+        while True:
+            page = self._request(url).json()
+            items.extend(page['value'])
+            if "@odata.nextLink" in page:
+                url = page['@odata.nextLink']
+            else:
+                return items, page['@odata.deltaLink']
+
+    def sync_library(self, local_root: str, max_workers: int = 8) -> dict:
+        """
+        Mirrors the drive of current user into local_root, downloading just the files that changed since last call
+        and deleting the local copies of the removed ones. Uses the delta query of ms graph: an index
+        (id -> path/etag/modified/size) and the delta link are kept in local_root/.ong_sync.json, so the cost of each
+        call depends on the number of changes and not on the size of the drive.
+        Delta responses do not tell the path of the items, so it is resolved from the id of their parent folder
+        with the same index
+        :param local_root: local folder of the mirror
+        :param max_workers: number of files downloaded simultaneously
+        :return: a dict with the lists of "downloaded" and "deleted" paths (relative to drive root) and a dict of
+        "errors" indexed by path. Files with errors are retried in the next call
+        """
+        os.makedirs(local_root, exist_ok=True)
+        state_path = os.path.join(local_root, SYNC_STATE_FILE)
+        state = load_transfer_state(state_path) or dict()
+        index = state.get('items', dict())
+        root_id = state.get('root_id')
+        to_download = set(state.get('pending', list()))
+        full_delta_url = f"{self.ctx.service_root_url}/me/drive/root/delta"
+        try:
+            changes, delta_link = self.__read_delta(state.get('delta_link') or full_delta_url)
+            full = not state.get('delta_link')
+        except requests.HTTPError as e:
+            # 410 Gone: delta link expired, a full resync is needed
+            if e.response is None or e.response.status_code != 410:
+                raise
+            self.logger.info("Delta link expired, listing whole drive")
+            changes, delta_link = self.__read_delta(full_delta_url)
+            full = True
+        deleted = list()
+        seen = set()
+        for item in changes:
+            if "root" in item:
+                root_id = item['id']
+                continue
+            seen.add(item['id'])
+            old = index.get(item['id'])
+            if "deleted" in item:
+                if old:
+                    deleted.append(index.pop(item['id']))
+                    if old['type'] == "folder":
+                        # Contents of a deleted folder are gone too, even if delta does not report them
+                        deleted.extend(index.pop(child_id) for child_id, child in list(index.items())
+                                       if child['path'].startswith(old['path'] + "/"))
+                continue
+            parent_id = item['parentReference'].get('id')
+            if parent_id == root_id:
+                parent = ""
+            elif parent_id in index:
+                parent = index[parent_id]['path']
+            else:
+                # Parents come before their children, so this should not happen: fall back to path, if informed
+                self.logger.warning(f"Unknown parent folder of {item['name']}")
+                parent = item['parentReference'].get('path', "").split("root:", 1)[-1].strip("/")
+            path = f"{parent}/{item['name']}".strip("/")
+            entry = dict(path=path, type="folder" if "folder" in item else "file", etag=item.get('eTag'),
+                         modified=item.get('lastModifiedDateTime'), size=item.get('size'))
+            if old and old['path'] != path:
+                old_local = os.path.join(local_root, *old['path'].split("/"))
+                if old['type'] == "folder" and os.path.isdir(old_local):
+                    os.renames(old_local, os.path.join(local_root, *path.split("/")))
+                    for child in index.values():
+                        if child['path'].startswith(old['path'] + "/"):
+                            child['path'] = path + child['path'][len(old['path']):]
+                else:
+                    deleted.append(old)
+            if entry['type'] == "folder":
+                os.makedirs(os.path.join(local_root, *path.split("/")), exist_ok=True)
+            elif not old or old['etag'] != entry['etag'] or \
+                    not os.path.isfile(os.path.join(local_root, *path.split("/"))):
+                to_download.add(item['id'])
+            index[item['id']] = entry
+        if full:
+            # A full listing does not report deleted items: remove the ones not found
+            deleted.extend(index.pop(item_id) for item_id in list(index) if item_id not in seen)
+        for entry in deleted:
+            local_path = os.path.join(local_root, *entry['path'].split("/"))
+            if entry['type'] == "folder":
+                shutil.rmtree(local_path, ignore_errors=True)
+            elif os.path.isfile(local_path):
+                os.remove(local_path)
+
+        def download(item_id: str) -> str:
+            local_path = os.path.join(local_root, *index[item_id]['path'].split("/"))
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with self._request(f"{self.ctx.service_root_url}/me/drive/items/{item_id}/content",
+                               stream=True) as resp, open(local_path, "wb") as local_file:
+                for chunk in resp.iter_content(1024 * 1024):
+                    local_file.write(chunk)
+            return index[item_id]['path']
+
+        downloaded, errors, pending = list(), dict(), list()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(download, item_id): item_id for item_id in to_download if item_id in index}
+            for future in as_completed(futures):
+                item_id = futures[future]
+                try:
+                    downloaded.append(future.result())
+                except Exception as e:
+                    self.logger.warning(f"Could not download {index[item_id]['path']}: {e}")
+                    errors[index[item_id]['path']] = e
+                    pending.append(item_id)
+        save_transfer_state(state_path, dict(delta_link=delta_link, root_id=root_id, items=index, pending=pending))
+        self.logger.info(f"Drive synced: {len(downloaded)} files downloaded, {len(deleted)} items deleted, "
+                         f"{len(errors)} errors")
+        return dict(downloaded=downloaded, deleted=[entry['path'] for entry in deleted], errors=errors)
@@ -1,6 +1,10 @@
 from __future__ import annotations
 
+import requests
+
 from ong_office365 import logger as log
+from ong_office365.metadata_cache import MetadataCache
+from ong_office365.msal_token_manager import TokenBroker
 from ong_office365.ong_sharepoint import Sharepoint
 from ong_office365.selenium_token.office365_selenium import SeleniumTokenManager
 from office365.sharepoint.client_context import ClientContext
@@ -26,12 +30,21 @@ class SeleniumSharepoint(Sharepoint):
         except:
             return self.__get_decoded("aud")
 
-    def __init__(self, server: str = None, logger=None, **kwargs):
+    def __init__(self, server: str = None, logger=None, token_broker: TokenBroker = None,
+                 session: requests.Session = None, metadata_cache: MetadataCache = None, **kwargs):
         """Init class with server url and optionally a logger. Rest of params are ignored
-        parameter that can be also used"""
-        self.token_manager = SeleniumTokenManager()
+        parameter that can be also used. If a token_broker is informed, the browser login is shared with all other
+        SeleniumSharepoint instances using the same broker. Http requests go through session or, if not informed,
+        through the pooled session shared by all instances. The optional metadata_cache is used as in Sharepoint"""
+        if token_broker is not None:
+            self.token_manager = token_broker.selenium_token_manager()
+        else:
+            self.token_manager = SeleniumTokenManager()
         self.logger = logger or log
+        self._session = session
+        self.metadata_cache = metadata_cache
         self.ctx = ClientContext(server or self.server).with_access_token(self.token_manager.get_token_office)
+        self.ctx.with_transport(session=self.session)
 
 
 if __name__ == '__main__':
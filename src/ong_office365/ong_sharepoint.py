@@ -5,10 +5,21 @@ and
 https://blog.darrenjrobinson.com/decoding-azure-ad-access-tokens-with-python/
 Needs pip install msal msal_extensions pyjwt requests datetime
 """
+from __future__ import annotations
+
+import json
 import os.path
-from typing import Optional
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator, NamedTuple, Optional
+from urllib.parse import quote, urlparse
 
 import pandas as pd
+import requests
+from tqdm import tqdm
 from office365.runtime.client_request_exception import ClientRequestException
 from office365.sharepoint.client_context import ClientContext
 from office365.sharepoint.files.file import File
@@ -18,7 +29,99 @@ from office365.sharepoint.listitems.listitem import ListItem
 from office365.sharepoint.lists.list import List
 from office365.sharepoint.webs.web import Web
 
-from ong_office365.ong_office365_base import Office365Base, DownloadProgressBar
+from ong_office365 import get_cache_dir
+from ong_office365.list_cache import ListCache
+from ong_office365.metadata_cache import MetadataCache
+from ong_office365.msal_token_manager import TokenBroker
+from ong_office365.odata_batch import build_sharepoint_batch, parse_sharepoint_batch, SHAREPOINT_BATCH_SIZE
+from ong_office365.ong_office365_base import Office365Base, DownloadProgressBar, load_transfer_state, \
+    save_transfer_state, remove_transfer_state, write_parquet, SYNC_STATE_FILE
+
+
+def odata_string(value: str) -> str:
+    """Formats value as an url-encoded odata string literal, to be used in urls such as
+    GetFileByServerRelativePath(DecodedUrl='value')"""
+    return "'" + quote(value.replace("'", "''"), safe="/") + "'"
+
+
+def file_api_url(site_url: str, server_relative_url: str) -> str:
+    """Returns rest api url of a file given its server relative url"""
+    return (f"{site_url.rstrip('/')}/_api/web/GetFileByServerRelativePath"
+            f"(DecodedUrl={odata_string(server_relative_url)})")
+
+
+# pandas dtypes of sharepoint list field types (TypeAsString). Fields of other types are kept as python objects
+LIST_FIELD_DTYPES = {
+    "Counter": "Int64", "Integer": "Int64", "Lookup": "Int64", "User": "Int64",
+    "Number": "float64", "Currency": "float64",
+    "Boolean": "boolean",
+    "DateTime": "datetime",
+    "Text": "string", "Note": "string", "Choice": "string", "Guid": "string", "ContentTypeId": "string",
+}
+
+
+def convert_list_types(df: pd.DataFrame, field_types: dict) -> pd.DataFrame:
+    """Converts (inplace) the columns of a DataFrame of list items to the dtypes of their sharepoint field types,
+    given as a dict of field type indexed by column name"""
+    for column in df.columns:
+        dtype = LIST_FIELD_DTYPES.get(field_types.get(column))
+        if dtype == "datetime":
+            df[column] = pd.to_datetime(df[column], utc=True)
+        elif dtype is not None:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def list_query_params(columns: list = None, filter: str = None, order_by: str = None) -> dict:
+    """Returns the odata query params of a request of list items that selects columns (ID is always included and
+    lookup properties are given as "Field/Property", which expands Field), filters and sorts items in the server"""
+    params = dict()
+    if columns:
+        columns = ["ID"] + [column for column in columns if column != "ID"]
+        params["$select"] = ",".join(columns)
+        expand = list(dict.fromkeys(column.split("/")[0] for column in columns if "/" in column))
+        if expand:
+            params["$expand"] = ",".join(expand)
+    if filter:
+        params["$filter"] = filter
+    if order_by:
+        params["$orderby"] = order_by
+    return params
+
+
+def flatten_lookups(row: dict, columns: Iterable[str]) -> dict:
+    """Replaces (inplace) the expanded lookup fields of a list item with the requested "Field/Property" columns,
+    e.g. {"Author": {"Title": "John"}} becomes {"Author/Title": "John"}. For multi-value lookups, the column holds
+    the list of values of the property"""
+    lookups = [column.split("/", 1) for column in columns if "/" in column]
+    values = {field: row.pop(field, None) for field, _ in lookups}
+    for field, prop in lookups:
+        value = values[field]
+        if isinstance(value, dict) and "results" in value:
+            value = value['results']        # multi-value lookup in verbose format
+        if isinstance(value, list):
+            row[f"{field}/{prop}"] = [v.get(prop) for v in value]
+        else:
+            row[f"{field}/{prop}"] = (value or dict()).get(prop)
+    return row
+
+
+def local_mirror_path(local_root: str, server_relative_url: str, root_url: str = None) -> str:
+    """Returns the local path that mirrors server_relative_url inside local_root. If root_url is given, path is
+    relative to it, otherwise to the server root"""
+    if root_url and server_relative_url.startswith(root_url.rstrip("/") + "/"):
+        server_relative_url = server_relative_url[len(root_url.rstrip("/")):]
+    return os.path.join(local_root, *server_relative_url.strip("/").split("/"))
+
+
+class ItemRecord(NamedTuple):
+    """Lightweight description of an item (file or folder) of a document library"""
+    url: str                # server relative url
+    type: str               # "file" or "folder"
+    size: int | None        # None for folders
+    modified: str           # last modification timestamp, in iso format
+    etag: str | None        # None for folders
+    id: int                 # id of the item in the library
 
 
 class Sharepoint(Office365Base):
@@ -32,12 +135,16 @@ class Sharepoint(Office365Base):
     #     return ["Sites.FullControl.All"]
     #     return ["AllSites.FullControl"]
 
+    # No metadata cache unless given to __init__ (child classes with their own __init__ might not call it)
+    metadata_cache: MetadataCache | None = None
+
     @staticmethod
     def config_section() -> str:
         return "sharepoint"
 
     def __init__(self, client_id: str = None, email: str = None, server: str = None, tenant: str = None,
-                 timeout=None, logger=None):
+                 timeout=None, logger=None, token_broker: TokenBroker = None, session: requests.Session = None,
+                 metadata_cache: MetadataCache = None):
         """
         Initializes sharepoint instance
         :param client_id: List of client ids could be found in https://portal.azure.com/#view/Microsoft_AAD_RegisteredApps/ApplicationsListBlade
@@ -46,9 +153,16 @@ class Sharepoint(Office365Base):
         :param tenant: tenant name (find it in Ms Entra ID configuration)
         :param timeout: time to wait for user login
         :param logger: a logger to use instead of default library logger
+        :param token_broker: an optional TokenBroker to share sign-in with other instances (see TokenBroker)
+        :param session: optional requests.Session for http requests. Defaults to the pooled session shared by all
+        instances (see http_transport)
+        :param metadata_cache: optional MetadataCache for list_folders, list_files_folder, get_file_properties and
+        exits. Entries are invalidated by writes of this instance (uploads and deletions), but not by changes made
+        by others, that are seen once entries expire
         """
+        self.metadata_cache = metadata_cache
         super().__init__(client_id, email, server, tenant, ClientContext(server or self.server).with_access_token,
-                         timeout=timeout, logger=logger)
+                         timeout=timeout, logger=logger, token_broker=token_broker, session=session)
 
     def __get_folder_obj(self, folder_relative_url=None) -> Folder:
         """Gets a folder object according to given relative url. Returns root folder if no url is given"""
@@ -58,14 +172,71 @@ class Sharepoint(Office365Base):
             folder_obj = self.ctx.web.get_folder_by_server_relative_url(folder_relative_url)
         return folder_obj
 
+    def __server_relative_url(self, url: str) -> str:
+        """Converts a site relative url (e.g. "Shared Documents/file.txt") to server relative"""
+        if url.startswith("/"):
+            return url.rstrip("/")
+        return urlparse(self.ctx.base_url).path.rstrip("/") + "/" + url.strip("/")
+
+    def __cached_get(self, key: str, api_url: str) -> dict | None:
+        """Reads a rest api url (in nometadata format) through metadata_cache. Returns None if not found"""
+
+        def load(etag: str | None) -> tuple | None:
+            headers = {"Accept": "application/json;odata=nometadata"}
+            if etag:
+                headers["If-None-Match"] = etag
+            try:
+                resp = self._request(api_url, headers=headers)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    return None, None
+                raise
+            if resp.status_code == 304:
+                return None
+            return resp.json(), resp.headers.get("ETag")
+
+        return self.metadata_cache.fetch(key, load)
+
+    def __cached_children(self, kind: str, folder_relative_url: str = None) -> list:
+        """Returns properties of subfolders (kind="Folders") or files (kind="Files") of a folder through
+        metadata_cache"""
+        if folder_relative_url is None:
+            api_url = f"{self.ctx.base_url}/_api/web/DefaultDocumentLibrary()/RootFolder/{kind}"
+            folder_relative_url = ""
+        else:
+            folder_relative_url = self.__server_relative_url(folder_relative_url)
+            api_url = (f"{self.ctx.base_url}/_api/web/GetFolderByServerRelativeUrl"
+                       f"({odata_string(folder_relative_url)})/{kind}")
+        return (self.__cached_get(f"{kind.lower()}:{folder_relative_url}", api_url) or dict()).get('value', [])
+
+    @staticmethod
+    def __with_properties(client_object, properties: dict):
+        """Fills (without query) a client object with cached properties"""
+        for name, value in properties.items():
+            client_object.set_property(name, value, False)
+        return client_object
+
+    def __invalidate_metadata(self, file_url: str):
+        """Drops from metadata_cache the entries that a write of file_url changes"""
+        if self.metadata_cache is None or not file_url:
+            return
+        url = self.__server_relative_url(file_url)
+        parent = url.rsplit("/", 1)[0]
+        # Root folder of default library is cached with an empty url
+        self.metadata_cache.invalidate(f"file:{url}", f"files:{parent}", f"folders:{parent}", "files:", "folders:")
+
     def list_folders(self, folder_relative_url=None) -> dict:
         """
         Gets list of folders of a certain resource as a dict indexed by folder relative url
         :param folder_relative_url: optional parameter with the server relative URL. If None, list root folder
         :return: dict of folder objects indexed by folder server relative url
         """
+        if self.metadata_cache is not None:
+            return {row['ServerRelativeUrl']: self.__with_properties(
+                self.ctx.web.get_folder_by_server_relative_url(row['ServerRelativeUrl']), row)
+                for row in self.__cached_children("Folders", folder_relative_url)}
         folders = self.__get_folder_obj(folder_relative_url).folders.get().execute_query()
-        retval = {f.serverRelativeUrl: f for f in folders}
+        retval = {f.server_relative_url: f for f in folders}
         return retval
 
     def list_files_folder(self, folder_relative_url=None):
@@ -74,10 +245,76 @@ class Sharepoint(Office365Base):
         :param folder_relative_url: optional parameter with the server relative URL. If None, list root folder
         :return: dict of folder objects indexed by folder server relative url
         """
+        if self.metadata_cache is not None:
+            return {row['ServerRelativeUrl']: self.__with_properties(
+                self.ctx.web.get_file_by_server_relative_url(row['ServerRelativeUrl']), row)
+                for row in self.__cached_children("Files", folder_relative_url)}
         files = self.__get_folder_obj(folder_relative_url).files.get().execute_query()
-        retval = {f.serverRelativeUrl: f for f in files}
+        retval = {f.server_relative_url: f for f in files}
         return retval
 
+    def _iter_pages(self, url: str, params: dict = None) -> Iterator[list]:
+        """Yields the list of rows of each page of a paged rest api collection, following next links"""
+        headers = {"Accept": "application/json;odata=nometadata"}
+        while url:
+            page = self._request(url, params=params, headers=headers).json()
+            yield page['value']
+            # Next link already includes all query params
+            url, params = page.get('odata.nextLink'), None
+
+    def __list_folder(self, folder_url: str) -> tuple:
+        """Lists a folder for walk. Returns a tuple of its url and dicts of properties of its subfolders and files
+        indexed by name"""
+        api_url = f"{self.ctx.base_url}/_api/web/GetFolderByServerRelativeUrl({odata_string(folder_url)})"
+        folders = {row['Name']: row for page in self._iter_pages(f"{api_url}/Folders") for row in page}
+        files = {row['Name']: row for page in self._iter_pages(f"{api_url}/Files") for row in page}
+        return folder_url, folders, files
+
+    def walk(self, root: str = None, max_depth: int = None, max_workers: int = 8) -> Iterator[tuple]:
+        """
+        Walks the folder tree of root, like os.walk, yielding a tuple (folder_url, folders, files) for each folder,
+        where folders and files are dicts of properties (Name, ServerRelativeUrl, Length, TimeLastModified...) of
+        its subfolders and files indexed by name.
+        Sibling folders are listed concurrently and each folder is yielded as soon as it is listed, so folders do
+        not come in top-down order (though a folder always comes before its subfolders) and, unlike os.walk,
+        removing entries from folders does not prune the walk
+        :param root: server relative url of the folder to start from. Defaults to root folder of default library
+        :param max_depth: maximum depth of folders to list (0 lists only root). None for no limit
+        :param max_workers: number of folders listed concurrently
+        :return: an iterator of tuples (folder_url, folders, files)
+        """
+        if root is None:
+            root = self._request(f"{self.ctx.base_url}/_api/web/DefaultDocumentLibrary()/RootFolder",
+                                 params={"$select": "ServerRelativeUrl"},
+                                 headers={"Accept": "application/json;odata=nometadata"}).json()['ServerRelativeUrl']
+        yield from self._walk(root.rstrip("/"), self.__list_folder, max_depth, max_workers)
+
+    def iter_items(self, page_size: int = 500, limit: int = None, filter: str = None) -> Iterator[ItemRecord]:
+        """
+        Yields an ItemRecord for each folder and file of the default document library, as each page of results
+        arrives. Unlike get_all_folders_files, memory use is bounded by page_size and first results are available
+        before the listing finishes
+        :param page_size: number of items requested to server in each page
+        :param limit: maximum number of items to return (all items if None)
+        :param filter: optional odata filter of the items, e.g. "ID eq 4"
+        :return: an iterator of ItemRecord
+        """
+        url = f"{self.ctx.base_url}/_api/web/DefaultDocumentLibrary()/items"
+        params = {"$select": "ID,FileRef,FSObjType,Modified,File/Length,File/ETag", "$expand": "File",
+                  "$top": min(page_size, limit or page_size)}
+        if filter:
+            params["$filter"] = filter
+        count = 0
+        for page in self._iter_pages(url, params):
+            for row in page:
+                file = row.get('File') or dict()
+                yield ItemRecord(url=row['FileRef'], type="folder" if int(row['FSObjType']) == 1 else "file",
+                                 size=int(file['Length']) if file.get('Length') is not None else None,
+                                 modified=row['Modified'], etag=file.get('ETag'), id=row['ID'])
+                count += 1
+                if count == limit:
+                    return
+
     def get_all_folders_files(self, limit: int = None):
         """Returns a tuple of dicts of ALL folders and files of the site, indexed by relative url"""
         folders = dict()
@@ -94,17 +331,17 @@ class Sharepoint(Office365Base):
         items = items.execute_query()
         for idx, item in enumerate(items):  # type: int, ListItem
             if item.file_system_object_type == FileSystemObjectType.Folder:
-                folders[item.folder.serverRelativeUrl] = item.folder
+                folders[item.folder.server_relative_url] = item.folder
                 self.logger.trace(
                     "({0} of {1})  Folder: {2}".format(
-                        idx, len(items), item.folder.serverRelativeUrl
+                        idx, len(items), item.folder.server_relative_url
                     )
                 )
             else:
-                files[item.file.serverRelativeUrl] = item.file
+                files[item.file.server_relative_url] = item.file
                 self.logger.trace(
                     "({0} of {1}) File: {2}".format(
-                        idx, len(items), item.file.serverRelativeUrl
+                        idx, len(items), item.file.server_relative_url
                     )
                 )
         return folders, files
@@ -140,6 +377,236 @@ class Sharepoint(Office365Base):
                 source_file.download_session(local_file, t.update_to).execute_query()
         self.logger.debug("[Ok] file has been downloaded: {0}".format(destination))
 
+    def download_file_resumable(self, server_relative_url: str, dest_folder: str = None, parallel_ranges: int = 1,
+                                chunk_size: int = 1024 * 1024) -> str:
+        """
+        Downloads a file using http Range requests, so an interrupted download continues where it stopped.
+        Data is written to destination + ".part" and progress is kept in a sidecar file (destination + ".download")
+        with the ETag of the remote file and the offsets already written to disk. If the remote file changed
+        (different ETag), download starts again. When finished, the part file is renamed to destination
+        :param server_relative_url: server relative url of the file
+        :param dest_folder: local folder where file will be stored (current folder if None)
+        :param parallel_ranges: number of byte ranges of the file downloaded concurrently
+        :param chunk_size: size of the chunks read from network (state is saved after each one)
+        :return: local path of the downloaded file
+        """
+        filename = os.path.basename(server_relative_url)
+        destination = os.path.join(dest_folder, filename) if dest_folder else filename
+        part_path = destination + ".part"
+        state_path = destination + ".download"
+        file_url = file_api_url(self.ctx.base_url, server_relative_url)
+        properties = self._request(file_url, headers={"Accept": "application/json;odata=nometadata"}).json()
+        etag, size = properties['ETag'], int(properties['Length'])
+
+        state = load_transfer_state(state_path)
+        if not state or (state['etag'], state['size']) != (etag, size) or not os.path.isfile(part_path) or \
+                os.path.getsize(part_path) != size:
+            # Preallocates file, so each range can be written in its position
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+            range_size = -(-size // max(parallel_ranges, 1)) or 1
+            state = dict(etag=etag, size=size,
+                         ranges=[[start, min(start + range_size, size), start] for start in range(0, size, range_size)])
+            save_transfer_state(state_path, state)
+        else:
+            self.logger.info(f"Resuming download of {server_relative_url}")
+        lock = threading.Lock()
+
+        def download_range(byte_range: list, progress: DownloadProgressBar):
+            """Downloads the pending part of a [start, end, next] range, updating next as data is written"""
+            headers = {"Range": f"bytes={byte_range[2]}-{byte_range[1] - 1}", "If-Range": etag}
+            with self._request(file_url + "/$value", headers=headers, stream=True) as resp:
+                if resp.status_code != 206:
+                    raise ValueError(f"File {server_relative_url} changed while downloading")
+                with open(part_path, "r+b") as local_file:
+                    local_file.seek(byte_range[2])
+                    for chunk in resp.iter_content(chunk_size):
+                        local_file.write(chunk)
+                        local_file.flush()
+                        with lock:
+                            byte_range[2] += len(chunk)
+                            save_transfer_state(state_path, state)
+                            progress.update_to(chunk)
+
+        pending = [r for r in state['ranges'] if r[2] < r[1]]
+        with DownloadProgressBar(total=size, incremental=True) as t:
+            t.update_to(size - sum(r[1] - r[2] for r in pending))
+            with ThreadPoolExecutor(max_workers=max(parallel_ranges, 1)) as pool:
+                for future in [pool.submit(download_range, r, t) for r in pending]:
+                    future.result()
+        os.replace(part_path, destination)
+        remove_transfer_state(state_path)
+        self.logger.debug("[Ok] file has been downloaded: {0}".format(destination))
+        return destination
+
+    def download_many(self, server_relative_urls: Iterable[str], dest_folder: str = None, max_workers: int = 8,
+                      keep_folders: bool = False, chunk_size: int = 1024 * 1024, root_url: str = None) -> tuple:
+        """
+        Downloads many files concurrently, sharing the same authenticated context and token.
+        A single progress bar shows the aggregated downloaded bytes. An error in a file does not stop the rest
+        :param server_relative_urls: iterable of server relative urls of the files (e.g. the keys of the files dict
+        returned by get_all_folders_files)
+        :param dest_folder: local folder for the downloaded files (current folder if None)
+        :param max_workers: number of files downloaded simultaneously
+        :param keep_folders: if True, the remote folder structure is replicated under dest_folder. Otherwise,
+        all files are stored directly in dest_folder (so files with the same name overwrite each other)
+        :param chunk_size: size of the chunks read from the network
+        :param root_url: if keep_folders, the folder structure is replicated relative to this server relative url
+        (e.g. the root folder of a library) instead of relative to the server root
+        :return: a tuple of two dicts indexed by server relative url: local path of the downloaded files and
+        exception raised for the files that could not be downloaded
+        """
+        dest_folder = dest_folder or ""
+        site_url = self.ctx.base_url
+        downloaded = dict()
+        errors = dict()
+        lock = threading.Lock()
+
+        def download(server_relative_url: str, progress: DownloadProgressBar) -> str:
+            if keep_folders:
+                destination = local_mirror_path(dest_folder, server_relative_url, root_url)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+            else:
+                destination = os.path.join(dest_folder, os.path.basename(server_relative_url))
+            url = file_api_url(site_url, server_relative_url) + "/$value"
+            # Written aside and moved at the end, so a failed download never touches an existing local copy
+            part_path = destination + ".part"
+            try:
+                with self._request(url, stream=True) as resp, open(part_path, "wb") as local_file:
+                    with lock:
+                        progress.total = (progress.total or 0) + int(resp.headers.get("Content-Length", 0))
+                        progress.refresh()
+                    for chunk in resp.iter_content(chunk_size):
+                        local_file.write(chunk)
+                        with lock:
+                            progress.update_to(chunk)
+            except Exception:
+                if os.path.isfile(part_path):
+                    os.remove(part_path)
+                raise
+            os.replace(part_path, destination)
+            return destination
+
+        with DownloadProgressBar(total=None, incremental=True) as t:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = {pool.submit(download, url, t): url for url in server_relative_urls}
+                for future in as_completed(futures):
+                    url = futures[future]
+                    try:
+                        downloaded[url] = future.result()
+                    except Exception as e:
+                        self.logger.warning(f"Could not download {url}: {e}")
+                        errors[url] = e
+        self.logger.debug(f"Downloaded {len(downloaded)} files with {len(errors)} errors")
+        return downloaded, errors
+
+    def __get_library_changes(self, library_url: str, change_token: str) -> tuple:
+        """Returns a tuple with the sets of ids of the items changed and of the items deleted in a library
+        after the given change token"""
+        headers = {"Accept": "application/json;odata=nometadata", "Content-Type": "application/json;odata=nometadata"}
+        changed, deleted = set(), set()
+        while True:
+            query = {"Add": True, "Update": True, "DeleteObject": True, "Rename": True, "Move": True,
+                     "Restore": True, "Item": True, "ChangeTokenStart": {"StringValue": change_token}}
+            changes = self._request(f"{library_url}/GetChanges", "post", json={"query": query},
+                                    headers=headers).json()['value']
+            if not changes:
+                return changed, deleted
+            for change in changes:
+                # ChangeType 3 is DeleteObject and 5 is MoveAway (item moved out of the library)
+                if change['ChangeType'] in (3, 5):
+                    changed.discard(change['ItemId'])
+                    deleted.add(change['ItemId'])
+                else:
+                    deleted.discard(change['ItemId'])
+                    changed.add(change['ItemId'])
+            change_token = changes[-1]['ChangeToken']['StringValue']
+
+    def sync_library(self, local_root: str, max_workers: int = 8) -> dict:
+        """
+        Mirrors the default document library into local_root, downloading just the files that changed since last
+        call and deleting the local copies of the removed ones. An index (url -> id/etag/modified/size) and the
+        change token of the library are kept in local_root/.ong_sync.json. The first call (or if the change token
+        is no longer valid) lists the whole library, next calls read the change log of the library, so their cost
+        depends on the number of changes and not on the size of the library
+        :param local_root: local folder of the mirror. Folders are replicated relative to library root folder
+        :param max_workers: number of files downloaded simultaneously
+        :return: a dict with the lists of "downloaded" and "deleted" server relative urls and a dict of "errors"
+        indexed by server relative url. Files with errors are retried in the next call
+        """
+        os.makedirs(local_root, exist_ok=True)
+        headers = {"Accept": "application/json;odata=nometadata"}
+        library_url = f"{self.ctx.base_url}/_api/web/DefaultDocumentLibrary()"
+        state_path = os.path.join(local_root, SYNC_STATE_FILE)
+        state = load_transfer_state(state_path) or dict()
+        # Token is read before the changes, so nothing is lost if library changes in the meantime
+        library = self._request(library_url, headers=headers, params={
+            "$select": "CurrentChangeToken,RootFolder/ServerRelativeUrl", "$expand": "RootFolder"}).json()
+        root_url = library['RootFolder']['ServerRelativeUrl']
+        index = state.get('items', dict())
+        to_download = set(state.get('pending', list()))
+        changes = None
+        if state.get('change_token'):
+            try:
+                changes = self.__get_library_changes(library_url, state['change_token'])
+            except requests.HTTPError as e:
+                self.logger.info(f"Could not read changes of library ({e}), listing whole library")
+        if changes is None:
+            records = {record.url: record for record in self.iter_items()}
+            deleted = [url for url in index if url not in records]
+        else:
+            changed_ids, deleted_ids = changes
+            ids_urls = {entry['id']: url for url, entry in index.items()}
+            deleted = [ids_urls[item_id] for item_id in deleted_ids if item_id in ids_urls]
+            records = dict()
+            changed_ids = sorted(changed_ids)
+            for start in range(0, len(changed_ids), 50):
+                ids = changed_ids[start:start + 50]
+                found = {r.id: r for r in self.iter_items(filter=" or ".join(f"ID eq {i}" for i in ids))}
+                for item_id in ids:
+                    record = found.get(item_id)
+                    old_url = ids_urls.get(item_id)
+                    if record is None:
+                        # Item changed and then deleted
+                        if old_url:
+                            deleted.append(old_url)
+                        continue
+                    records[record.url] = record
+                    if old_url and old_url != record.url:
+                        if record.type == "folder" and os.path.isdir(local_mirror_path(local_root, old_url, root_url)):
+                            # Renamed or moved folder: move local copy and its contents in the index
+                            os.renames(local_mirror_path(local_root, old_url, root_url),
+                                       local_mirror_path(local_root, record.url, root_url))
+                            for url in [url for url in index if url.startswith(old_url + "/")]:
+                                index[record.url + url[len(old_url):]] = index.pop(url)
+                            index.pop(old_url)
+                        else:
+                            deleted.append(old_url)
+        for url in deleted:
+            entry = index.pop(url, None)
+            local_path = local_mirror_path(local_root, url, root_url)
+            if entry and entry['type'] == "folder":
+                # Change log only reports the folder itself, not its contents
+                for child_url in [child_url for child_url in index if child_url.startswith(url + "/")]:
+                    index.pop(child_url)
+                shutil.rmtree(local_path, ignore_errors=True)
+            elif os.path.isfile(local_path):
+                os.remove(local_path)
+        for url, record in records.items():
+            local_path = local_mirror_path(local_root, url, root_url)
+            if record.type == "folder":
+                os.makedirs(local_path, exist_ok=True)
+            elif index.get(url, dict()).get('etag') != record.etag or not os.path.isfile(local_path):
+                to_download.add(url)
+            index[url] = {k: v for k, v in record._asdict().items() if k != "url"}
+        downloaded, errors = self.download_many(sorted(url for url in to_download if url in index), local_root,
+                                                max_workers=max_workers, keep_folders=True, root_url=root_url)
+        save_transfer_state(state_path, dict(change_token=library['CurrentChangeToken']['StringValue'],
+                                             items=index, pending=list(errors)))
+        self.logger.info(f"Library synced: {len(downloaded)} files downloaded, {len(deleted)} items deleted, "
+                         f"{len(errors)} errors")
+        return dict(downloaded=list(downloaded), deleted=deleted, errors=errors)
+
     def get_personal_site(self):
         my_site = self.ctx.web.current_user.get_personal_site().execute_query()
         # print(my_site.url)
@@ -183,7 +650,105 @@ class Sharepoint(Office365Base):
                     f, size_chunk, t.update_to
                 ).execute_query()
 
-        self.logger.debug("File {0} has been uploaded successfully".format(uploaded_file.serverRelativeUrl))
+        self.__invalidate_metadata(uploaded_file.server_relative_url)
+        self.logger.debug("File {0} has been uploaded successfully".format(uploaded_file.server_relative_url))
+
+    def upload_file_chunked(self, local_path: str, target_folder: str = None, min_chunk_size: int = 1024 * 1024,
+                            max_chunk_size: int = 64 * 1024 * 1024, chunk_seconds: float = 4,
+                            resume: bool = True) -> str:
+        """
+        Uploads a large local file through an upload session, faster than upload_file_large:
+        - Chunk size adapts to the measured throughput, so each request takes about chunk_seconds
+        - Next chunk is read from disk while the current one is being sent (upload sessions must receive chunks
+        in order, so they cannot be sent concurrently)
+        - Offset acknowledged by the server is saved in a sidecar file (local_path + ".upload"), so an interrupted
+        upload continues from there in the next call instead of restarting
+        :param local_path: path of the local file
+        :param target_folder: example: "Shared Documents/archive". If None, root folder of Documents is used
+        :param min_chunk_size: size of the first chunk and minimum size of the rest
+        :param max_chunk_size: maximum size of a chunk
+        :param chunk_seconds: target time for sending each chunk
+        :param resume: True (default) to continue a previous interrupted upload of the same file
+        :return: server relative url of the uploaded file
+        """
+        site_url = self.ctx.base_url
+        headers = {"Accept": "application/json;odata=nometadata"}
+        size = os.path.getsize(local_path)
+        state_path = local_path + ".upload"
+        state = load_transfer_state(state_path) if resume else None
+        if state and (state['size'], state['mtime'], state['target_folder']) != \
+                (size, os.path.getmtime(local_path), target_folder):
+            state = None
+        # A state read from disk may point to an upload session that server does not know (e.g. StartUpload got
+        # there but its response did not), so if it fails the upload starts again from scratch
+        resumed = state is not None
+        if state is None:
+            if target_folder is None:
+                folder_url = f"{site_url}/_api/web/lists/GetByTitle('Documents')/RootFolder"
+            else:
+                folder_url = f"{site_url}/_api/web/GetFolderByServerRelativeUrl({odata_string(target_folder)})"
+            add_url = f"{folder_url}/Files/add(url={odata_string(os.path.basename(local_path))},overwrite=true)"
+            if size <= min_chunk_size:
+                # Too small for an upload session
+                with open(local_path, "rb") as f:
+                    file = self._request(add_url, "post", data=f.read(), headers=headers).json()
+                self.__invalidate_metadata(file['ServerRelativeUrl'])
+                return file['ServerRelativeUrl']
+            file = self._request(add_url, "post", data=b"", headers=headers).json()
+            state = dict(upload_id=str(uuid.uuid4()), server_relative_url=file['ServerRelativeUrl'], offset=0,
+                         size=size, mtime=os.path.getmtime(local_path), target_folder=target_folder)
+            save_transfer_state(state_path, state)
+        elif state['offset']:
+            self.logger.info(f"Resuming upload of {local_path} from offset {state['offset']}")
+        file_url = file_api_url(site_url, state['server_relative_url'])
+        upload_id = f"uploadId=guid'{state['upload_id']}'"
+        chunk_size = min_chunk_size
+        try:
+            with open(local_path, "rb") as f, ThreadPoolExecutor(max_workers=1) as reader, \
+                    DownloadProgressBar(total=size) as t:
+                t.update_to(state['offset'])
+                f.seek(state['offset'])
+                next_chunk = reader.submit(f.read, chunk_size)
+                while True:
+                    chunk = next_chunk.result()
+                    offset = state['offset']
+                    if offset + len(chunk) >= size:
+                        self._request(f"{file_url}/FinishUpload({upload_id},fileOffset={offset})", "post",
+                                      data=chunk, headers=headers)
+                        break
+                    # Read next chunk while this one is being sent
+                    next_chunk = reader.submit(f.read, chunk_size)
+                    if offset == 0:
+                        action = f"StartUpload({upload_id})"
+                    else:
+                        action = f"ContinueUpload({upload_id},fileOffset={offset})"
+                    tic = time.perf_counter()
+                    resp = self._request(f"{file_url}/{action}", "post", data=chunk, headers=headers)
+                    elapsed = time.perf_counter() - tic
+                    state['offset'] = int(resp.json()['value'])
+                    resumed = False
+                    save_transfer_state(state_path, state)
+                    t.update_to(state['offset'])
+                    if state['offset'] != offset + len(chunk):
+                        # Server did not acknowledge the whole chunk: read again from the acknowledged offset
+                        next_chunk.result()
+                        f.seek(state['offset'])
+                        next_chunk = reader.submit(f.read, chunk_size)
+                    throughput = len(chunk) / max(elapsed, 1e-3)
+                    chunk_size = int(min(max(throughput * chunk_seconds, min_chunk_size), max_chunk_size,
+                                         2 * chunk_size))
+        except requests.HTTPError as e:
+            if resumed and e.response is not None and 400 <= e.response.status_code < 500:
+                # Upload session expired or unknown for server: start again
+                self.logger.info(f"Upload session of {local_path} could not be resumed, uploading from scratch")
+                remove_transfer_state(state_path)
+                return self.upload_file_chunked(local_path, target_folder, min_chunk_size, max_chunk_size,
+                                                chunk_seconds, resume=False)
+            raise
+        remove_transfer_state(state_path)
+        self.__invalidate_metadata(state['server_relative_url'])
+        self.logger.debug("File {0} has been uploaded successfully".format(state['server_relative_url']))
+        return state['server_relative_url']
 
     def upload_file(self, local_path: str, target_folder=None):
         """
@@ -199,7 +764,8 @@ class Sharepoint(Office365Base):
         folder = self.get_folder(target_folder)
         with open(local_path, "rb") as f:
             file = folder.files.upload(f).execute_query()
-        self.logger.debug("File has been uploaded into: {0}".format(file.serverRelativeUrl))
+        self.__invalidate_metadata(file.server_relative_url)
+        self.logger.debug("File has been uploaded into: {0}".format(file.server_relative_url))
 
     def delete(self, file_url):
         """
@@ -208,7 +774,28 @@ class Sharepoint(Office365Base):
         :return: None
         """
         file = self.ctx.web.get_file_by_server_relative_url(file_url)
-        file.delete_object().execute_query()
+        try:
+            file.delete_object().execute_query()
+        finally:
+            self.__invalidate_metadata(file_url)
+
+    def get_file_properties(self, file_url: str) -> dict | None:
+        """
+        Gets the properties of a file (Name, ServerRelativeUrl, Length, ETag, TimeLastModified...), through
+        metadata_cache if any
+        :param file_url: example -> "Shared Documents/Financial Sample.xlsx"
+        :return: a dict of properties, or None if file does not exist
+        """
+        url = self.__server_relative_url(file_url)
+        api_url = file_api_url(self.ctx.base_url, url)
+        if self.metadata_cache is not None:
+            return self.__cached_get(f"file:{url}", api_url)
+        try:
+            return self._request(api_url, headers={"Accept": "application/json;odata=nometadata"}).json()
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
 
     def exits(self, file_url: str):
         """
@@ -216,6 +803,8 @@ class Sharepoint(Office365Base):
         :param file_url: example -> "Shared Documents/Financial Sample.xlsx"
         :return: True or False
         """
+        if self.metadata_cache is not None:
+            return self.get_file_properties(file_url) is not None
 
         def try_get_file(web, url):
             # type: (Web, str) -> Optional[File]
@@ -230,6 +819,106 @@ class Sharepoint(Office365Base):
         file = try_get_file(self.ctx.web, file_url)
         return file is not None
 
+    def __batch_get(self, urls: list, api_urls: list, params: str, batch_size: int, max_workers: int) -> tuple:
+        """Sends a GET for each rest api url (with the same query params) in $batch calls. Returns a tuple of two
+        dicts indexed by url: the BatchResponse of each request, and the error of requests without response"""
+        operations = [dict(method="get", url=f"{api_url}?{params}" if params else api_url) for api_url in api_urls]
+        return self._batch_many(urls, operations, min(batch_size, SHAREPOINT_BATCH_SIZE), max_workers)
+
+    def exists_many(self, file_urls: Iterable[str], batch_size: int = SHAREPOINT_BATCH_SIZE,
+                    max_workers: int = 4) -> tuple:
+        """
+        Checks if many files exist, sending the checks in $batch requests of batch_size files
+        :param file_urls: server relative urls of the files
+        :param batch_size: number of files checked in each $batch request (100 at most)
+        :param max_workers: number of $batch requests sent concurrently
+        :return: a tuple of two dicts indexed by file url: True or False for the files that could be checked, and
+        the error of the rest
+        """
+        file_urls = list(file_urls)
+        site_url = self.ctx.base_url
+        responses, errors = self.__batch_get(file_urls, [file_api_url(site_url, url) for url in file_urls],
+                                             "$select=Exists", batch_size, max_workers)
+        exists = dict()
+        for url, response in responses.items():
+            if response.ok:
+                exists[url] = response.body.get('Exists', True) if isinstance(response.body, dict) else True
+            elif response.status == 404:
+                exists[url] = False
+            else:
+                errors[url] = response.error
+        return exists, errors
+
+    def get_files_many(self, file_urls: Iterable[str], batch_size: int = SHAREPOINT_BATCH_SIZE,
+                       max_workers: int = 4) -> tuple:
+        """
+        Gets the properties of many files (Name, Length, TimeLastModified, ETag...), sending the requests in $batch
+        requests of batch_size files
+        :param file_urls: server relative urls of the files
+        :param batch_size: number of files requested in each $batch request (100 at most)
+        :param max_workers: number of $batch requests sent concurrently
+        :return: a tuple of two dicts indexed by file url: the properties of the files found, and the error of the
+        rest (e.g. not found)
+        """
+        file_urls = list(file_urls)
+        site_url = self.ctx.base_url
+        responses, errors = self.__batch_get(file_urls, [file_api_url(site_url, url) for url in file_urls],
+                                             None, batch_size, max_workers)
+        properties = dict()
+        for url, response in responses.items():
+            if response.ok:
+                properties[url] = response.body
+            else:
+                errors[url] = response.error
+        return properties, errors
+
+    def list_folders_many(self, folder_urls: Iterable[str], batch_size: int = SHAREPOINT_BATCH_SIZE,
+                          max_workers: int = 4) -> tuple:
+        """
+        Lists the subfolders of many folders, sending the requests in $batch requests of batch_size folders
+        :param folder_urls: server relative urls of the folders
+        :param batch_size: number of folders listed in each $batch request (100 at most)
+        :param max_workers: number of $batch requests sent concurrently
+        :return: a tuple of two dicts indexed by folder url: for each folder listed, a dict of the properties of
+        its subfolders indexed by their server relative url, and the error of the rest
+        """
+        folder_urls = list(folder_urls)
+        api_urls = [f"{self.ctx.base_url}/_api/web/GetFolderByServerRelativeUrl({odata_string(url)})/Folders"
+                    for url in folder_urls]
+        responses, errors = self.__batch_get(folder_urls, api_urls, None, batch_size, max_workers)
+        folders = dict()
+        for url, response in responses.items():
+            if response.ok:
+                folders[url] = {folder['ServerRelativeUrl']: folder for folder in response.body['value']}
+            else:
+                errors[url] = response.error
+        return folders, errors
+
+    def delete_many(self, file_urls: Iterable[str], batch_size: int = SHAREPOINT_BATCH_SIZE,
+                    max_workers: int = 4) -> tuple:
+        """
+        Deletes many files, sending the deletions in $batch requests of batch_size files. Each deletion is
+        independent of the rest, so a failure does not stop the others
+        :param file_urls: server relative urls of the files
+        :param batch_size: number of files deleted in each $batch request (100 at most)
+        :param max_workers: number of $batch requests sent concurrently
+        :return: a tuple of the list of urls of deleted files and a dict of errors indexed by url
+        """
+        file_urls = list(file_urls)
+        operations = [dict(method="delete", url=file_api_url(self.ctx.base_url, url), headers={"IF-MATCH": "*"})
+                      for url in file_urls]
+        responses, errors = self._batch_many(file_urls, operations, min(batch_size, SHAREPOINT_BATCH_SIZE),
+                                             max_workers)
+        deleted = list()
+        for url, response in responses.items():
+            if response.ok:
+                deleted.append(url)
+            else:
+                errors[url] = response.error
+            self.__invalidate_metadata(url)
+        self.logger.info(f"Deleted {len(deleted)} files, {len(errors)} errors")
+        return deleted, errors
+
     def get_lists(self) -> dict:
         """Returns a dict, indexed by title, of objects representing lists of site"""
         result = (
@@ -240,28 +929,56 @@ class Sharepoint(Office365Base):
         )
         return {r.title: r for r in result}
 
-    def read_list(self, list_title: str = None, list_id: str = None, list_obj: List = None) -> pd.DataFrame:
+    def read_list(self, list_title: str = None, list_id: str = None, list_obj: List = None, columns: list = None,
+                  filter: str = None, order_by: str = None, max_workers: int = 1,
+                  window_size: int = 5000) -> pd.DataFrame:
         """
         Reads a list either with list title (it might not work if name has spaces), list id
         or the list object. Only one of the three must be informed. Returns list as a pandas DataFrame
         :param list_title: name of the list
         :param list_id: guid of the list
         :param list_obj: a list object (such one returned by get_list)
+        :param columns: optional list of columns to read (all if None). Properties of lookup/person fields are
+        requested as "Field/Property" (e.g. "Author/Title") and returned as a column with that name
+        :param filter: optional odata filter evaluated in the server, e.g. "Status eq 'Open'"
+        :param order_by: optional odata sort order, e.g. "Modified desc"
+        :param max_workers: if greater than 1, the range of IDs of the list is split in windows of window_size ids
+        that are read concurrently by max_workers threads, and then merged in ID order. Not compatible with order_by
+        :param window_size: number of consecutive IDs in each window read when max_workers > 1
         :return:
         """
 
         if sum(i is not None for i in [list_title, list_id, list_obj]) != 1:
             raise ValueError("Only one parameter must be informed")
+        params = list_query_params(columns, filter, order_by)
+        if max_workers > 1:
+            if order_by:
+                raise ValueError("order_by cannot be used with max_workers > 1, as items are returned in ID order")
+            list_url = self._list_api_url(list_title, list_id, list_obj)
+            retval = [flatten_lookups(row, columns or [])
+                      for row in self.__read_list_windows(list_url, params, max_workers, window_size)]
+            df = pd.DataFrame(retval, columns=["ID"] + [c for c in columns if c != "ID"] if columns else None)
+            return df.set_index("ID")
 
         def query_large_list(target_list):
             data = []
             # type: (List) -> None
+            items = target_list.items
+            if "$select" in params:
+                items = items.select(params['$select'].split(","))
+            if "$expand" in params:
+                items = items.expand(params['$expand'].split(","))
+            if filter:
+                items = items.filter(filter)
+            if order_by:
+                # items.order_by() sends "$order_by", that sharepoint ignores
+                items.query_options.custom["$orderby"] = order_by
             with DownloadProgressBar(total=target_list.item_count) as t:
                 paged_items = (
-                    target_list.items.paged(500, page_loaded=t.update_to).get().execute_query()
+                    items.paged(500, page_loaded=t.update_to).get().execute_query()
                 )
             for index, item in enumerate(paged_items):  # type: int, ListItem
-                data.append(item.properties)
+                data.append(flatten_lookups(dict(item.properties), columns or []))
             return data
 
         if list_obj is not None:
@@ -275,12 +992,244 @@ class Sharepoint(Office365Base):
             lists = self.get_lists()
             for name, list_obj in lists.items():
                 if name == list_title:
-                    return self.read_list(list_obj=list_obj)
+                    return self.read_list(list_obj=list_obj, columns=columns, filter=filter, order_by=order_by)
             raise ValueError(f"List {list_title} not found")
         retval = query_large_list(large_list)
-        df = pd.DataFrame(retval)
+        df = pd.DataFrame(retval, columns=["ID"] + [c for c in columns if c != "ID"] if columns else None)
         df = df.set_index("ID")
         return df
 
+    def __read_list_windows(self, list_url: str, params: dict, max_workers: int, window_size: int) -> list:
+        """Returns all rows of the items of a list, read concurrently in windows of window_size consecutive IDs
+        (filtered with "ID ge x and ID lt y", besides the filter in params). Rows are returned in ID order"""
+        headers = {"Accept": "application/json;odata=nometadata"}
+
+        def first_id(order: str) -> int | None:
+            rows = self._request(f"{list_url}/items", headers=headers,
+                                 params={"$select": "ID", "$orderby": f"ID {order}", "$top": 1}).json()['value']
+            return rows[0]['ID'] if rows else None
+
+        min_id, max_id = first_id("asc"), first_id("desc")
+        if min_id is None:
+            return []
+        user_filter = params.get("$filter")
+
+        def read_window(start: int) -> list:
+            window = f"ID ge {start} and ID lt {start + window_size}"
+            window_params = dict(params, **{"$filter": f"({user_filter}) and {window}" if user_filter else window,
+                                            "$top": min(window_size, 5000)})
+            rows = [row for page in self._iter_pages(f"{list_url}/items", window_params) for row in page]
+            progress.update(len(rows))
+            return rows
+
+        with tqdm(desc="Reading list", unit=" items") as progress:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                windows = list(executor.map(read_window, range(min_id, max_id + 1, window_size)))
+        self.logger.debug(f"Read {sum(len(rows) for rows in windows)} items in {len(windows)} windows")
+        return [row for rows in windows for row in rows]
+
+    def _list_api_url(self, list_title: str = None, list_id: str = None, list_obj: List = None) -> str:
+        """Returns the rest api url of a list given either by title, id or list object (only one of them)"""
+        if sum(i is not None for i in [list_title, list_id, list_obj]) != 1:
+            raise ValueError("Only one parameter must be informed")
+        if list_obj is not None:
+            list_id = list_obj.id
+        if list_id is not None:
+            return f"{self.ctx.base_url}/_api/web/lists(guid'{list_id}')"
+        return f"{self.ctx.base_url}/_api/web/lists/GetByTitle({odata_string(list_title)})"
+
+    def _list_field_types(self, list_url: str) -> dict:
+        """Returns a dict of field types (TypeAsString) of a list, indexed by the name of the field in the json of
+        items (lookup and user fields are received as their ids, in a field named after the field plus "Id")"""
+        field_types = dict()
+        fields = self._request(f"{list_url}/fields", headers={"Accept": "application/json;odata=nometadata"},
+                               params={"$select": "InternalName,TypeAsString"}).json()['value']
+        for field in fields:
+            name = field['InternalName']
+            if field['TypeAsString'] in ("Lookup", "User"):
+                name += "Id"
+            field_types[name] = field['TypeAsString']
+        return field_types
 
+    def iter_list_pages(self, list_title: str = None, list_id: str = None, list_obj: List = None,
+                        page_size: int = 500, columns: list = None, filter: str = None,
+                        order_by: str = None) -> Iterator[pd.DataFrame]:
+        """
+        Reads a list (given either by title, id or list object, only one of them) page by page, yielding a
+        DataFrame indexed by ID for each page as it arrives. Columns are typed according to the field types of the
+        list (e.g. Int64, float64, boolean, datetime and string), so memory is bounded by page size
+        :param list_title: name of the list
+        :param list_id: guid of the list
+        :param list_obj: a list object (such one returned by get_list)
+        :param page_size: number of items requested in each page
+        :param columns: optional list of columns to read, see read_list
+        :param filter: optional odata filter evaluated in the server, see read_list
+        :param order_by: optional odata sort order, see read_list
+        :return: an iterator of DataFrames
+        """
+        list_url = self._list_api_url(list_title, list_id, list_obj)
+        field_types = self._list_field_types(list_url)
+        params = dict(list_query_params(columns, filter, order_by), **{"$top": page_size})
+        for rows in self._iter_pages(f"{list_url}/items", params=params):
+            if not rows:
+                continue
+            if columns:
+                rows = [flatten_lookups(row, columns) for row in rows]
+            df = convert_list_types(pd.DataFrame.from_records(rows), field_types)
+            self.logger.trace(f"Read page of {len(df)} items")
+            yield df.set_index("ID")
+
+    def read_list_columnar(self, list_title: str = None, list_id: str = None, list_obj: List = None,
+                           page_size: int = 500, parquet_path: str = None, columns: list = None,
+                           filter: str = None, order_by: str = None) -> pd.DataFrame | None:
+        """
+        Same as read_list, but each page is converted into typed columns as it arrives (see iter_list_pages), so
+        memory does not peak at several times the size of the result. Optionally, pages are streamed straight to a
+        parquet file (needs pyarrow), so memory used does not depend on the size of the list
+        :param list_title: name of the list
+        :param list_id: guid of the list
+        :param list_obj: a list object (such one returned by get_list)
+        :param page_size: number of items requested in each page
+        :param parquet_path: path of a parquet file to write the list into. If informed, nothing is returned
+        :param columns: optional list of columns to read, see read_list
+        :param filter: optional odata filter evaluated in the server, see read_list
+        :param order_by: optional odata sort order, see read_list
+        :return: a DataFrame indexed by ID or None if parquet_path was informed
+        """
+        pages = self.iter_list_pages(list_title, list_id, list_obj, page_size=page_size, columns=columns,
+                                     filter=filter, order_by=order_by)
+        if parquet_path is None:
+            frames = list(pages)
+            return pd.concat(frames) if frames else pd.DataFrame()
+
+        def json_objects(df: pd.DataFrame) -> pd.DataFrame:
+            # Python objects (e.g. multi-value lookups) are stored as json, so every page has the same schema
+            for column in df.columns[df.dtypes == object]:
+                df[column] = df[column].map(lambda v: v if v is None or isinstance(v, str) else
+                                            json.dumps(v)).astype("string")
+            return df
+
+        write_parquet(map(json_objects, pages), parquet_path)
+        return None
+
+    def read_list_cached(self, list_title: str = None, list_id: str = None, list_obj: List = None,
+                         cache_dir: str = None, page_size: int = 5000) -> pd.DataFrame:
+        """
+        Same as read_list_columnar, but items are kept in a local cache (a sqlite file per list id), so each call
+        only reads the items modified since the previous one (Modified ge latest Modified in cache) plus the IDs
+        of all items, to drop from the cache those deleted in the server
+        :param list_title: name of the list
+        :param list_id: guid of the list
+        :param list_obj: a list object (such one returned by get_list)
+        :param cache_dir: folder of the cache files. Defaults to a "lists" folder in the library cache folder
+        :param page_size: number of items requested in each page
+        :return: a DataFrame indexed by ID
+        """
+        list_url = self._list_api_url(list_title, list_id, list_obj)
+        headers = {"Accept": "application/json;odata=nometadata"}
+        if list_obj is not None:
+            list_id = list_obj.id
+        elif list_id is None:
+            list_id = self._request(list_url, headers=headers, params={"$select": "Id"}).json()['Id']
+        cache_path = os.path.join(cache_dir or get_cache_dir("lists"), f"{list_id}.sqlite")
+        with ListCache(cache_path) as cache:
+            last_modified = cache.last_modified
+            params = {"$top": page_size}
+            if last_modified:
+                params["$filter"] = f"Modified ge datetime'{last_modified}'"
+            changed = 0
+            for rows in self._iter_pages(f"{list_url}/items", params):
+                cache.upsert(rows)
+                changed += len(rows)
+            deleted = set()
+            if last_modified:
+                server_ids = {row['ID'] for rows in self._iter_pages(f"{list_url}/items",
+                                                                     {"$select": "ID", "$top": page_size})
+                              for row in rows}
+                deleted = cache.ids() - server_ids
+                cache.delete(deleted)
+            self.logger.debug(f"Refreshed cache of list {list_id}: {changed} items changed, {len(deleted)} deleted")
+            rows = cache.rows()
+        if not rows:
+            return pd.DataFrame()
+        df = convert_list_types(pd.DataFrame.from_records(rows), self._list_field_types(list_url))
+        return df.set_index("ID")
+
+    def _batch(self, operations: list) -> list:
+        """Sends a list of requests (dicts of method, url and optional headers and body) in a single $batch call.
+        Returns a BatchResponse for each request"""
+        content_type, body = build_sharepoint_batch(operations)
+        resp = self._request(f"{self.ctx.base_url}/_api/$batch", "post", headers={"Content-Type": content_type},
+                             data=body)
+        return parse_sharepoint_batch(resp.headers['Content-Type'], resp.content)
+
+    def write_list(self, df: pd.DataFrame, list_title: str = None, list_id: str = None, list_obj: List = None,
+                   mode: str = "insert", key: str = None, batch_size: int = SHAREPOINT_BATCH_SIZE,
+                   max_workers: int = 4) -> tuple:
+        """
+        Writes the rows of a DataFrame as items of a list (given either by title, id or list object, only one of
+        them), sending them in $batch requests of batch_size items, that are sent concurrently
+        :param df: DataFrame whose columns are internal names of list fields (use "FieldId" for lookup and person
+        fields). Column ID, if present, is not written
+        :param list_title: name of the list
+        :param list_id: guid of the list
+        :param list_obj: a list object (such one returned by get_list)
+        :param mode: "insert" to create a new item for each row or "upsert" to update the items whose key is
+        already in the list and create the rest
+        :param key: column (or name of the index) that identifies items in upsert mode, e.g. "ID" or "Title"
+        :param batch_size: number of items written in each $batch request (100 at most)
+        :param max_workers: number of $batch requests sent concurrently
+        :return: a tuple of two dicts indexed by the index of df: ID of the items written, and error of the rows
+        that could not be written
+        """
+        if mode not in ("insert", "upsert"):
+            raise ValueError(f"Invalid mode {mode}, it must be either 'insert' or 'upsert'")
+        if mode == "upsert" and key is None:
+            raise ValueError("A key column is needed for upserts")
+        list_url = self._list_api_url(list_title, list_id, list_obj)
+        # to_json converts NaN/NA to null and timestamps to iso format
+        records = json.loads(df.to_json(orient="records", date_format="iso"))
+        existing_ids = dict()
+        if mode == "upsert":
+            keys = df[key].tolist() if key in df.columns else df.index.tolist()
+            for page in self._iter_pages(f"{list_url}/items", {"$select": f"ID,{key}", "$top": 5000}):
+                existing_ids.update((row[key], row['ID']) for row in page)
+        else:
+            keys = [None] * len(df)
+        operations = list()
+        for index, key_value, record in zip(df.index, keys, records):
+            record.pop("ID", None)
+            if (item_id := existing_ids.get(key_value)) is not None:
+                request = dict(method="patch", url=f"{list_url}/items({item_id})", headers={"IF-MATCH": "*"},
+                               body=record)
+            else:
+                request = dict(method="post", url=f"{list_url}/items", body=record)
+            operations.append((index, item_id, request))
+        written, errors = dict(), dict()
+
+        def write_batch(batch: list):
+            try:
+                responses = self._batch([request for _, _, request in batch])
+            except requests.RequestException as e:
+                responses = [None] * len(batch)
+                self.logger.error(f"Error sending batch: {e}")
+                for index, _, _ in batch:
+                    errors[index] = str(e)
+            for (index, item_id, _), response in zip(batch, responses):
+                if response is None:
+                    continue
+                if response.ok:
+                    written[index] = item_id if item_id is not None else response.body['ID']
+                else:
+                    errors[index] = response.error
+            for index, _, _ in batch[len(responses):]:
+                errors[index] = "No response received in batch"
+            progress.update(len(batch))
 
+        batch_size = min(batch_size, SHAREPOINT_BATCH_SIZE)
+        batches = [operations[i:i + batch_size] for i in range(0, len(operations), batch_size)]
+        with tqdm(total=len(operations), desc="Writing list", unit=" items") as progress:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(write_batch, batches))
+        self.logger.info(f"Written {len(written)} items in {len(batches)} batches, {len(errors)} errors")
+        return written, errors
@@ -0,0 +1,183 @@
+"""
+Scheduler of the http requests of a transport (see http_transport), that keeps clients under the throttling limits
+of sharepoint and ms graph instead of failing when they are hit. Requests to each resource (host, that identifies
+both tenant and service, e.g. contoso.sharepoint.com or graph.microsoft.com) are paced by:
+- Retry-After: once a request is throttled (429 or 503), no request to that resource is sent until the time told by
+the server has passed, and the throttled request is retried
+- AIMD concurrency control: the number of requests in flight per resource is halved when throttled and increased
+by one for each window of successful requests, so it converges to what the server accepts
+- An optional token bucket that limits requests per second per resource
+"""
+from __future__ import annotations
+
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple
+from urllib.parse import urlparse
+
+import requests
+
+THROTTLING_STATUS = (429, 503)
+
+
+def retry_after_seconds(response: requests.Response, attempt: int) -> float:
+    """Returns seconds to wait before retrying a throttled response (429 or 503), as told by its Retry-After
+    header (either seconds or a http date). Defaults to an exponential backoff based on the number of attempt"""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0., float(retry_after))
+        except ValueError:
+            try:
+                return max(0., parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return float(2 ** attempt)
+
+
+class ResourceStats(NamedTuple):
+    """Snapshot of the counters of the requests to a resource"""
+    requests: int               # requests sent, including retries
+    throttled: int              # responses with 429 or 503
+    wait_time: float            # seconds that requests waited for their turn, added up
+    concurrency_limit: int      # current maximum of requests in flight
+
+
+class ResourceLimiter:
+    """Limits the requests to a single resource. Thread safe"""
+
+    def __init__(self, max_concurrency: int, rate: float = None, burst: int = None):
+        """
+        :param max_concurrency: maximum (and initial) number of requests in flight
+        :param rate: maximum requests per second (None for no limit)
+        :param burst: requests that can be sent at once before rate applies. Defaults to max_concurrency
+        """
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst or max_concurrency
+        self.__condition = threading.Condition()
+        self.__limit = float(max_concurrency)
+        self.__in_flight = 0
+        self.__tokens = float(self.burst)
+        self.__refilled = time.monotonic()
+        self.__paused_until = 0.
+        self.__requests = 0
+        self.__throttled = 0
+        self.__wait_time = 0.
+
+    def __refill(self, now: float):
+        if self.rate:
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__refilled) * self.rate)
+        self.__refilled = now
+
+    def acquire(self):
+        """Blocks until a request can be sent"""
+        tic = time.monotonic()
+        with self.__condition:
+            while True:
+                now = time.monotonic()
+                self.__refill(now)
+                if self.__paused_until > now:
+                    self.__condition.wait(self.__paused_until - now)
+                elif self.__in_flight >= int(self.__limit):
+                    self.__condition.wait()
+                elif self.rate and self.__tokens < 1:
+                    self.__condition.wait((1 - self.__tokens) / self.rate)
+                else:
+                    break
+            if self.rate:
+                self.__tokens -= 1
+            self.__in_flight += 1
+            self.__requests += 1
+            self.__wait_time += now - tic
+
+    def release(self, retry_after: float = None):
+        """
+        Tells that a request finished
+        :param retry_after: None if request succeeded, otherwise seconds to wait before next request as it was
+        throttled
+        """
+        with self.__condition:
+            self.__in_flight -= 1
+            now = time.monotonic()
+            if retry_after is None:
+                # Additive increase: one more request in flight after a whole window of successful requests
+                self.__limit = min(self.max_concurrency, self.__limit + 1 / self.__limit)
+            else:
+                self.__throttled += 1
+                if self.__paused_until <= now:
+                    # Multiplicative decrease, once per throttling episode (requests in flight at the time
+                    # are probably throttled as well)
+                    self.__limit = max(1., self.__limit / 2)
+                self.__paused_until = max(self.__paused_until, now + retry_after)
+            self.__condition.notify_all()
+
+    @property
+    def stats(self) -> ResourceStats:
+        with self.__condition:
+            return ResourceStats(requests=self.__requests, throttled=self.__throttled, wait_time=self.__wait_time,
+                                 concurrency_limit=int(self.__limit))
+
+
+class RequestScheduler:
+    """
+    Schedules the requests of a transport, with a ResourceLimiter per host. Usage:
+        scheduler.acquire(url)
+        response = send(request)
+        retry = scheduler.release(url, response, attempt)
+    """
+
+    def __init__(self, max_concurrency: int, rate: float = None, burst: int = None, max_retries: int = 5):
+        """
+        :param max_concurrency: maximum (and initial) number of requests in flight per resource
+        :param rate: maximum requests per second per resource (None for no limit)
+        :param burst: requests per resource that can be sent at once before rate applies
+        :param max_retries: times that a throttled request is retried
+        """
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.__limiters = dict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def resource(url: str) -> str:
+        """Resource of an url (its host, that identifies both tenant and service)"""
+        return urlparse(url).netloc.lower()
+
+    def limiter(self, url: str) -> ResourceLimiter:
+        """Returns the limiter of the resource of an url (created on first use)"""
+        resource = self.resource(url)
+        with self.__lock:
+            if resource not in self.__limiters:
+                self.__limiters[resource] = ResourceLimiter(self.max_concurrency, self.rate, self.burst)
+            return self.__limiters[resource]
+
+    def acquire(self, url: str):
+        """Blocks until a request to url can be sent"""
+        self.limiter(url).acquire()
+
+    def release(self, url: str, response: requests.Response | None, attempt: int) -> float | None:
+        """
+        Tells that a request to url finished
+        :param url: url of the request
+        :param response: the response received (None if request failed without response)
+        :param attempt: number of attempt of the request, starting at 0
+        :return: None if request must not be retried, otherwise seconds to wait before retrying (retries wait
+        anyway in acquire until resource is available)
+        """
+        if response is None or response.status_code not in THROTTLING_STATUS:
+            self.limiter(url).release()
+            return None
+        delay = retry_after_seconds(response, attempt)
+        self.limiter(url).release(retry_after=delay)
+        return delay if attempt < self.max_retries else None
+
+    @property
+    def stats(self) -> dict:
+        """Stats of the requests of each resource, as a dict of ResourceStats indexed by resource"""
+        with self.__lock:
+            limiters = dict(self.__limiters)
+        return {resource: limiter.stats for resource, limiter in limiters.items()}
@@ -0,0 +1,69 @@
+"""
+Local copy of the responses of ms forms in a sqlite database, with a cursor per form (the last response read), so
+polling a form reads only the responses submitted since last time (see Forms.get_new_responses)
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+from typing import NamedTuple
+
+
+class ResponseCursor(NamedTuple):
+    """Where the next poll of a form starts from"""
+    last_id: int | None             # id of the last response read (None if none was read yet)
+    last_submit_date: str | None    # submitDate of that response (in the format received from server)
+
+
+class ResponseCache:
+    """
+    Stores the responses of forms (as received from forms api, unchanged) indexed by form id and response id,
+    along with the cursor of each form. Usage:
+    with ResponseCache(path) as cache:
+        cache.add(form_id, responses)
+        responses = cache.responses(form_id)
+    Changes are committed when the context is exited without errors
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cursors (form_id TEXT PRIMARY KEY, last_id INTEGER, "
+                          "last_submit_date TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (form_id TEXT, id INTEGER, data TEXT, "
+                          "PRIMARY KEY (form_id, id))")
+
+    def cursor(self, form_id: str) -> ResponseCursor:
+        """Returns the cursor of a form"""
+        row = self.conn.execute("SELECT last_id, last_submit_date FROM cursors WHERE form_id = ?",
+                                (form_id,)).fetchone()
+        return ResponseCursor(*row) if row else ResponseCursor(None, None)
+
+    def add(self, form_id: str, responses: list):
+        """Inserts or replaces responses of a form, moving its cursor to the last one"""
+        if not responses:
+            return
+        self.conn.executemany("INSERT OR REPLACE INTO responses (form_id, id, data) VALUES (?, ?, ?)",
+                              [(form_id, response['id'], json.dumps(response)) for response in responses])
+        last = max(responses, key=lambda response: response['id'])
+        if last['id'] > (self.cursor(form_id).last_id or 0):
+            self.conn.execute("INSERT OR REPLACE INTO cursors (form_id, last_id, last_submit_date) VALUES (?, ?, ?)",
+                              (form_id, last['id'], last.get('submitDate')))
+
+    def responses(self, form_id: str) -> list:
+        """Returns all cached responses of a form as a list of dicts, in id order"""
+        return [json.loads(row[0]) for row in self.conn.execute(
+            "SELECT data FROM responses WHERE form_id = ? ORDER BY id", (form_id,))]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.close()
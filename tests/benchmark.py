@@ -0,0 +1,20 @@
+"""
+Reporting of the results of benchmark tests. They are only shown if ONG_OFFICE365_BENCHMARK environment variable is
+set (e.g. ONG_OFFICE365_BENCHMARK=1 python -m pytest -k benchmark -s), so regular test runs stay quiet.
+Slow benchmarks that compare memory of several implementations only run when it is set (see skip_unless_benchmark),
+so regular test runs stay fast. Tests never assert on timings, that depend on the load of the machine
+"""
+import os
+import unittest
+
+from ong_office365 import logger
+
+BENCHMARK = bool(os.environ.get("ONG_OFFICE365_BENCHMARK"))
+# Decorator of slow benchmark tests, that are skipped unless benchmarks are enabled
+skip_unless_benchmark = unittest.skipUnless(BENCHMARK, "set ONG_OFFICE365_BENCHMARK to run benchmarks")
+
+
+def report(message: str):
+    """Logs a benchmark result, if benchmarks are enabled"""
+    if BENCHMARK:
+        logger.info(message)
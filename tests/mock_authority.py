@@ -0,0 +1,150 @@
+"""
+Local stand-in of the microsoft identity platform (authority discovery and token endpoint), used to test
+MsalTokenManager with real msal applications and token caches, without network nor a real tenant.
+Refresh tokens are strictly single use, so any process that refreshes with a stale copy of the cache fails
+"""
+from __future__ import annotations
+
+import base64
+import itertools
+import json
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+import requests
+
+from ong_office365.msal_token_manager import MsalTokenManager
+
+AUTHORITY_HOST = "https://login.microsoftonline.com"
+TENANT = "contoso"
+TENANT_ID = "9188040d-6c67-4c5b-b112-36a304b66dad"
+CLIENT_ID = "6731de76-14a6-49ae-97bc-6eba6914391e"
+EMAIL = "someone@contoso.com"
+RESERVED_SCOPES = {"openid", "profile", "offline_access"}
+
+
+def encode_jwt(claims: dict) -> str:
+    return jwt.encode(claims, "secret" * 8, algorithm="HS256")
+
+
+class MockAuthorityHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, value: dict, status: int = 200):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.endswith("/discovery/instance"):
+            return self.send_json({
+                "tenant_discovery_endpoint": f"{AUTHORITY_HOST}/{TENANT_ID}/v2.0/.well-known/openid-configuration",
+                "api-version": "1.1",
+                "metadata": [{"preferred_network": "login.microsoftonline.com",
+                              "preferred_cache": "login.windows.net",
+                              "aliases": ["login.microsoftonline.com", "login.windows.net"]}]})
+        if path.endswith("/v2.0/.well-known/openid-configuration"):
+            base = f"{AUTHORITY_HOST}/{path.split('/')[1]}"
+            return self.send_json({"authorization_endpoint": f"{base}/oauth2/v2.0/authorize",
+                                   "token_endpoint": f"{base}/oauth2/v2.0/token",
+                                   "device_authorization_endpoint": f"{base}/oauth2/v2.0/devicecode",
+                                   "issuer": f"{AUTHORITY_HOST}/{TENANT_ID}/v2.0"})
+        self.send_json({"error": "not_found"}, status=404)
+
+    def do_POST(self):
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode()).items()}
+        if not urlparse(self.path).path.endswith("/oauth2/v2.0/token") or form.get("grant_type") != "refresh_token":
+            return self.send_json({"error": "unsupported_grant_type"}, status=400)
+        server = self.server
+        with server.lock:
+            if form.get("refresh_token") not in server.refresh_tokens:
+                server.invalid_grants += 1
+                return self.send_json({"error": "invalid_grant",
+                                       "error_description": "AADSTS70000: refresh token already used"}, status=400)
+            server.refresh_tokens.remove(form["refresh_token"])
+            server.token_requests += 1
+            refresh_token = server.issue_refresh_token()
+        now = int(time.time())
+        scope = " ".join(s for s in form.get("scope", "").split() if s not in RESERVED_SCOPES)
+        client_info = base64.urlsafe_b64encode(json.dumps({"uid": "user", "utid": TENANT_ID}).encode()).decode()
+        id_token = encode_jwt({"aud": CLIENT_ID, "iss": f"{AUTHORITY_HOST}/{TENANT_ID}/v2.0", "iat": now,
+                               "nbf": now, "exp": now + 3600, "sub": "user", "oid": "user", "tid": TENANT_ID,
+                               "preferred_username": EMAIL})
+        access_token = encode_jwt({"aud": scope.rsplit("/", 1)[0], "exp": now + server.expires_in,
+                                   "scp": "AllSites.Read", "jti": str(uuid.uuid4())})
+        self.send_json({"token_type": "Bearer", "scope": scope, "expires_in": server.expires_in,
+                        "access_token": access_token, "refresh_token": refresh_token, "id_token": id_token,
+                        "client_info": client_info})
+
+
+class MockAuthorityServer(ThreadingHTTPServer):
+    """Http server running in a background thread. Use it as a context manager"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), MockAuthorityHandler)
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.refresh_tokens = set()     # refresh tokens issued and not used yet
+        self.token_requests = 0         # number of successful token requests
+        self.invalid_grants = 0         # number of token requests with an invalid (e.g. already used) refresh token
+        self.expires_in = 3600          # lifetime of issued access tokens
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def issue_refresh_token(self) -> str:
+        refresh_token = f"refresh_token_{next(self.counter)}"
+        self.refresh_tokens.add(refresh_token)
+        return refresh_token
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class MockAuthoritySession(requests.Session):
+    """Session that sends the requests for the microsoft identity platform to a MockAuthorityServer"""
+
+    def __init__(self, authority_url: str):
+        super().__init__()
+        self.authority_url = authority_url
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, url.replace(AUTHORITY_HOST, self.authority_url, 1), *args, **kwargs)
+
+
+def mock_token_manager(cache_location: str, authority_url: str) -> MsalTokenManager:
+    """Returns a MsalTokenManager for graph whose msal application talks to a MockAuthorityServer"""
+    return MsalTokenManager(client_id=CLIENT_ID, email=EMAIL, server=None, tenant=TENANT,
+                            cache_location=cache_location, http_client=MockAuthoritySession(authority_url))
+
+
+def token_worker(cache_location: str, authority_url: str, start_at: float, renewals: int) -> list:
+    """Body of each process of the stress test: waits until start_at, gets a token and then forces renewals.
+    Returns the access tokens obtained"""
+    manager = mock_token_manager(cache_location, authority_url)
+    manager.msal_cache_accounts()   # authority discovery, out of the measured part
+    time.sleep(max(0., start_at - time.time()))
+    tokens = [manager.acquire_token()['access_token']]
+    for _ in range(renewals):
+        # Token never lasts that long, so it is always renewed
+        result = manager.refresh_token_silent(refresh_before=10 ** 9)
+        tokens.append(result['access_token'])
+    return tokens
@@ -0,0 +1,263 @@
+"""
+Local stand-in of the (un-documented) ms forms api, used to test and benchmark without a real tenant
+"""
+from __future__ import annotations
+
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+from requests import Session
+
+from ong_office365.ong_forms import Forms
+
+ANTIFORGERY_HEADER = "__requestverificationtoken"
+
+
+def sample_questions(n_questions: int) -> list:
+    """Returns questions (as received from forms api) of a sample form, cycling through the usual types"""
+    types = ["Question.Choice", "Question.TextField", "Question.Rating", "Question.DateTime"]
+    return [dict(id="r" + uuid.uuid4().hex, title=f"Question {i}", type=types[i % len(types)],
+                 order=1000500 + i * 1000000, questionInfo=None) for i in range(n_questions)]
+
+
+def sample_answer(question: dict, response_id: int) -> str:
+    """Returns a plausible answer1 of a question"""
+    if question['type'] == "Question.Rating":
+        return str(response_id % 5 + 1)
+    if question['type'] == "Question.DateTime":
+        return f"2024-{response_id % 12 + 1}-{response_id % 28 + 1}"
+    if question['type'] == "Question.Choice":
+        return ["One", "Two", "Three"][response_id % 3]
+    return f"Free text answer number {response_id} to {question['title']}"
+
+
+def sample_responses(questions: list, n_responses: int, first_id: int = 1) -> list:
+    """Returns responses (as received from forms api, with answers as a json string) of a sample form. Each
+    response leaves one question unanswered"""
+    responses = []
+    for response_id in range(first_id, first_id + n_responses):
+        answers = [dict(questionId=q['id'], answer1=sample_answer(q, response_id)) for i, q in enumerate(questions)
+                   if i != response_id % max(len(questions), 1)]
+        submit = time.gmtime(1704067200 + response_id * 60)
+        responses.append(dict(id=response_id, startDate=time.strftime("%Y-%m-%dT%H:%M:00Z", submit),
+                              submitDate=time.strftime("%Y-%m-%dT%H:%M:30Z", submit),
+                              responder=f"user{response_id % 7}@test.com", responderName=f"User {response_id % 7}",
+                              answers=json.dumps(answers)))
+    return responses
+
+
+class MockFormsHandler(BaseHTTPRequestHandler):
+    """Answers to the subset of forms api used in tests. Forms are read from server.forms, a dict of forms
+    (with their questions and responses) indexed by id"""
+    protocol_version = "HTTP/1.1"
+    form_pattern = re.compile(r"/formapi/api/forms(\('(?P<id>[^']+)'\))?(?P<action>/.*)?$")
+    public_path = "/handlers/ResponsePageStartup.ashx"
+    question_pattern = re.compile(r"/(questions|descriptiveQuestions)(\('(?P<id>[^']+)'\))?$")
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, value, status: int = 200):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def dispatch(self, method: str):
+        """Checks authentication and finds the form of the request, then answers with method_<method>"""
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.paths.append(self.path)
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            body = self.read_json()
+            with self.server.lock:
+                if self.server.expire_token_after is not None:
+                    self.server.expire_token_after -= 1
+                    if self.server.expire_token_after < 0:
+                        self.server.expire_token_after = None
+                        self.server.expire_token()
+            if self.headers.get(ANTIFORGERY_HEADER) != self.server.token:
+                return self.send_json({"error": {"code": "400", "message": "AntiForgery token validation error"}},
+                                      status=400)
+            parsed = urlparse(self.path)
+            if method == "get" and parsed.path == self.public_path:
+                return self.get_public_form(parse_qs(parsed.query)["id"][0])
+            match = self.form_pattern.match(unquote(parsed.path))
+            if match is None:
+                return self.send_json({"error": {"code": "501", "message": "Not implemented"}}, status=501)
+            form = None
+            if match["id"] is not None:
+                form = self.server.forms.get(match["id"])
+                if form is None:
+                    return self.send_json({"error": {"code": "404", "message": "Form not found"}}, status=404)
+                if match["id"] in self.server.other_user_forms:
+                    return self.send_json({"error": {"code": "707", "message": "Form of another user"}}, status=403)
+            getattr(self, f"{method}_form")(form, match["action"] or "", parse_qs(parsed.query), body)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def do_GET(self):
+        self.dispatch("get")
+
+    def do_POST(self):
+        self.dispatch("post")
+
+    def do_PATCH(self):
+        self.dispatch("patch")
+
+    def do_DELETE(self):
+        self.dispatch("delete")
+
+    def get_public_form(self, form_id: str):
+        """Questions of a form as shown in its response page, where sections are groups of questions"""
+        form = self.server.forms.get(form_id)
+        if form is None:
+            return self.send_json({"error": {"code": "404", "message": "Form not found"}}, status=404)
+        questions = [dict(id=q['id'], title=q['title'], formsProRTQuestionTitle=q['title'],
+                          groupId=q.get('groupId')) for q in form['questions']]
+        self.send_json({"data": {"form": {"id": form_id, "questions": questions}}})
+
+    def get_form(self, form: dict | None, action: str, query: dict, body):
+        if form is None:
+            return self.send_json({"value": [f['properties'] for f in self.server.forms.values()]})
+        if not action:
+            return self.send_json(form['properties'])
+        if action == "/questions":
+            return self.send_json({"value": form['questions']})
+        if action == "/responses":
+            responses = form['responses']
+            if "$filter" in query:
+                last_id = int(re.fullmatch(r"id gt (\d+)", query["$filter"][0]).group(1))
+                responses = [r for r in responses if r['id'] > last_id]
+            skip = int(query.get("$skip", ["0"])[0])
+            top = int(query.get("$top", [str(len(responses))])[0])
+            return self.send_json({"value": responses[skip:skip + top]})
+        self.send_json({"error": {"code": "501", "message": "Not implemented"}}, status=501)
+
+    def post_form(self, form: dict | None, action: str, query: dict, body):
+        if form is None:
+            form_id = uuid.uuid4().hex
+            properties = dict(body, id=form_id, softDeleted=0, modifiedDate=self.server.now(), rowCount=0)
+            self.server.forms[form_id] = dict(properties=properties, questions=[], responses=[])
+            return self.send_json(properties, status=201)
+        if match := self.question_pattern.fullmatch(action):
+            if body['title'] in self.server.failing_titles:
+                return self.send_json({"error": {"code": "500", "message": "Internal server error"}}, status=500)
+            question = dict(body)
+            if self.server.assign_ids or "id" not in question:
+                question['id'] = "r" + uuid.uuid4().hex
+            with self.server.lock:
+                form['questions'].append(question)
+                form['questions'].sort(key=lambda q: q['order'])
+                form['properties']['modifiedDate'] = self.server.now()
+            return self.send_json(question, status=201)
+        self.send_json({"error": {"code": "501", "message": "Not implemented"}}, status=501)
+
+    def patch_form(self, form: dict, action: str, query: dict, body):
+        if not action:
+            form['properties'].update(body)
+        elif match := self.question_pattern.fullmatch(action):
+            question = next(q for q in form['questions'] if q['id'] == match["id"])
+            question.update(body)
+        form['properties']['modifiedDate'] = self.server.now()
+        self.send_json(None, status=200)
+
+    def delete_form(self, form: dict, action: str, query: dict, body):
+        del self.server.forms[form['properties']['id']]
+        self.send_json(None, status=200)
+
+
+class MockFormsServer(ThreadingHTTPServer):
+    """Http server running in a background thread. Use it as a context manager"""
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0, handler=MockFormsHandler):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.forms = dict()             # forms, indexed by id (see add_form)
+        self.token = "antiforgery_0"    # antiforgery token that requests must send
+        self.expire_token_after = None  # number of requests answered before simulating that token expired
+        self.assign_ids = False         # True to ignore ids of new questions sent by clients
+        self.other_user_forms = set()   # ids of forms of other users, that can only be read from their response page
+        self.failing_titles = set()     # titles of questions whose creation fails with a 500 error
+        self.requests = 0
+        self.paths = []                 # paths of all requests
+        self.active = 0                 # number of requests being answered
+        self.max_active = 0             # maximum number of requests answered at once
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @staticmethod
+    def now() -> str:
+        return time.strftime("%Y-%m-%dT%H:%M:%S") + f".{time.time_ns() % 1000000000:09d}Z"
+
+    def add_form(self, title: str, questions: list, responses: list) -> str:
+        """Adds a form with the given questions and responses. Returns id of the new form"""
+        form_id = uuid.uuid4().hex
+        self.forms[form_id] = dict(properties=dict(id=form_id, title=title, softDeleted=0,
+                                                   modifiedDate=self.now(), rowCount=len(responses)),
+                                   questions=questions, responses=responses)
+        return form_id
+
+    def add_responses(self, form_id: str, responses: list):
+        self.forms[form_id]['responses'].extend(responses)
+        self.forms[form_id]['properties']['rowCount'] = len(self.forms[form_id]['responses'])
+
+    def expire_token(self):
+        """Simulates that antiforgery token is no longer valid"""
+        self.token = f"antiforgery_{int(self.token.split('_')[1]) + 1}"
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class MockFormsTokenManager:
+    """Stand-in of SeleniumTokenManager that logs in a MockFormsServer with no browser"""
+
+    def __init__(self, server: MockFormsServer, login_time: float = 0):
+        self.server = server
+        self.login_time = login_time
+        self.logins = 0
+
+    def clear_cache(self):
+        pass
+
+    def get_auth_forms_session(self, session: Session = None, timeout_headless=4) -> Session:
+        time.sleep(self.login_time)
+        self.logins += 1
+        session = session or Session()
+        session.cookies.set("OIDCAuth.forms", "cookie")
+        session.headers.update({ANTIFORGERY_HEADER: self.server.token})
+        return session
+
+
+class MockForms(Forms):
+    """Forms client for a MockFormsServer"""
+
+    def __init__(self, server: MockFormsServer, logger=None, token_manager: MockFormsTokenManager = None):
+        super().__init__(logger=logger, base_url=server.url, token_manager=token_manager or
+                         MockFormsTokenManager(server))
@@ -0,0 +1,284 @@
+"""
+Local stand-in of the ms graph api of onedrive, used to test and benchmark without a real tenant
+"""
+from __future__ import annotations
+
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlparse
+
+import requests
+from office365.graph_client import GraphClient
+
+from ong_office365 import logger
+from ong_office365.ong_onedrive import OneDrive
+
+ROOT_ID = "root-id"
+
+
+class MockGraphHandler(BaseHTTPRequestHandler):
+    """Answers to the subset of ms graph api of drives used in tests. Drive items are read from server.items,
+    a dict of items indexed by id (see MockGraphServer.put_file)"""
+    protocol_version = "HTTP/1.1"
+    root_pattern = re.compile(r"/me/drive/root(:/(?P<path>[^:]+):?)?(?P<action>/(children|delta|content))?$")
+    item_pattern = re.compile(r"/me/drive/items/(?P<id>[^/]+)(?P<action>/(children|content))?$")
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status: int, body=None):
+        if isinstance(body, bytes):
+            content_type = "application/octet-stream"
+        else:
+            content_type = "application/json"
+            body = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, method: str):
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.paths.append(self.path)
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length)) if length else None
+            if self.headers.get("Authorization") != "Bearer fake_token":
+                return self.send(401, error("InvalidAuthenticationToken", "Access token is empty"))
+            parsed = urlparse(self.path)
+            path = unquote(parsed.path)
+            if not path.startswith("/v1.0/"):
+                return self.send(404, error("BadRequest", "Invalid version"))
+            if method == "post" and path == "/v1.0/$batch":
+                return self.send(*self.batch(body))
+            self.send(*self.server.answer(method, path[len("/v1.0"):], parse_qs(parsed.query)))
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def batch(self, body: dict) -> tuple:
+        """Answers each request of a json $batch as if it were sent alone"""
+        if len(body['requests']) > self.server.batch_size:
+            return 400, error("BadRequest", f"Too many requests in batch: {len(body['requests'])}")
+        with self.server.lock:
+            self.server.batches += 1
+        responses = []
+        for request in body['requests']:
+            parsed = urlparse(request['url'])
+            status, response_body = self.server.answer(request['method'].lower(), unquote(parsed.path),
+                                                       parse_qs(parsed.query))
+            responses.append(dict(id=request['id'], status=status, headers={"Content-Type": "application/json"},
+                                  body=response_body))
+        # Graph does not keep the order of the requests
+        return 200, dict(responses=responses[::-1])
+
+    def do_GET(self):
+        self.dispatch("get")
+
+    def do_POST(self):
+        self.dispatch("post")
+
+    def do_DELETE(self):
+        self.dispatch("delete")
+
+
+def error(code: str, message: str) -> dict:
+    """Body of an error response of ms graph"""
+    return {"error": {"code": code, "message": message}}
+
+
+class MockGraphServer(ThreadingHTTPServer):
+    """Http server running in a background thread. Use it as a context manager"""
+    daemon_threads = True
+
+    def __init__(self, files: dict = None, latency: float = 0, handler=MockGraphHandler):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.items = {ROOT_ID: dict(id=ROOT_ID, name="root", parent=None, content=None, version=1)}
+        self.changes = list()           # change log of the drive, as ids of changed items
+        self.page_size = 200            # maximum number of items of each page of children and delta
+        self.batch_size = 20            # maximum number of requests of a $batch
+        self.failing = set()            # paths of items answered with a 503 error
+        self.requests = 0
+        self.batches = 0                # number of $batch requests
+        self.paths = []                 # paths of all requests
+        self.active = 0                 # number of requests being answered
+        self.max_active = 0             # maximum number of requests answered at once
+        self.lock = threading.RLock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        for path, contents in (files or dict()).items():
+            self.put_file(path, contents)
+
+    def path_of(self, item_id: str) -> str:
+        """Path of an item relative to drive root"""
+        item = self.items[item_id]
+        if item['parent'] is None:
+            return ""
+        return f"{self.path_of(item['parent'])}/{item['name']}".strip("/")
+
+    def find(self, path: str) -> dict | None:
+        """Item of a path relative to drive root (None if not found)"""
+        item = self.items[ROOT_ID]
+        for name in filter(None, path.strip("/").split("/")):
+            item = next((child for child in self.items.values() if child['parent'] == item['id']
+                         and child['name'] == name), None)
+            if item is None:
+                return None
+        return item
+
+    def children(self, item_id: str) -> list:
+        return sorted((item for item in self.items.values() if item['parent'] == item_id),
+                      key=lambda item: item['name'])
+
+    def put_file(self, path: str, contents: bytes):
+        """Creates or updates a file (and its parent folders), logging the changes"""
+        with self.lock:
+            parent = self.items[ROOT_ID]
+            *folders, name = path.strip("/").split("/")
+            for folder in folders:
+                parent = self.find(f"{self.path_of(parent['id'])}/{folder}") or self.add_item(parent, folder, None)
+            item = self.find(path)
+            if item is None:
+                self.add_item(parent, name, contents)
+            else:
+                item.update(content=contents, version=item['version'] + 1)
+                self.changes.append(item['id'])
+
+    def add_item(self, parent: dict, name: str, contents: bytes | None) -> dict:
+        item = dict(id=uuid.uuid4().hex, name=name, parent=parent['id'], content=contents, version=1)
+        self.items[item['id']] = item
+        self.changes.append(item['id'])
+        return item
+
+    def rename(self, path: str, name: str):
+        """Renames an item. As in ms graph, only the item itself (not its children) is logged as changed"""
+        with self.lock:
+            item = self.find(path)
+            item.update(name=name, version=item['version'] + 1)
+            self.changes.append(item['id'])
+
+    def delete(self, path: str):
+        """Deletes an item and, if it is a folder, its contents, logging all of them"""
+        with self.lock:
+            item = self.find(path)
+            for child in self.children(item['id']):
+                self.delete(self.path_of(child['id']))
+            del self.items[item['id']]
+            self.changes.append(item['id'])
+
+    def files(self) -> dict:
+        """Contents of all files indexed by path"""
+        return {self.path_of(item['id']): item['content'] for item in list(self.items.values())
+                if item['content'] is not None}
+
+    def properties(self, item: dict) -> dict:
+        """Drive item as returned by ms graph. As in delta queries, parentReference has no path"""
+        properties = dict(id=item['id'], name=item['name'], eTag=f'"{{{item["id"]}}},{item["version"]}"',
+                          lastModifiedDateTime=f"2024-01-01T00:00:{item['version'] % 60:02}Z")
+        if item['parent'] is None:
+            properties.update(root=dict(), folder=dict(childCount=len(self.children(item['id']))))
+            return properties
+        properties['parentReference'] = dict(driveId="drive-id", id=item['parent'])
+        if item['content'] is None:
+            properties['folder'] = dict(childCount=len(self.children(item['id'])))
+        else:
+            properties.update(file=dict(), size=len(item['content']))
+        return properties
+
+    def page(self, items: list, query: dict, link: str) -> dict:
+        """A page of a collection of items, with a next link to the following page"""
+        skip = int(query.get("skip", ["0"])[0])
+        top = min(int(query.get("$top", [str(self.page_size)])[0]), self.page_size)
+        page = dict(value=items[skip:skip + top])
+        if skip + top < len(items):
+            page['@odata.nextLink'] = f"{self.url}/v1.0{quote(link)}?" + urlencode(dict(
+                {k: v[0] for k, v in query.items()}, skip=skip + top))
+        return page
+
+    def delta(self, query: dict) -> dict:
+        """Items changed since the token of the query (all items, parents first, without token)"""
+        with self.lock:
+            if "token" in query:
+                changed = list(dict.fromkeys(self.changes[int(query["token"][0]):]))
+            else:
+                changed = sorted(self.items, key=lambda item_id: self.path_of(item_id).count("/") +
+                                 bool(self.path_of(item_id)))
+            items = [self.properties(self.items[item_id]) if item_id in self.items
+                     else dict(id=item_id, deleted=dict(state="deleted")) for item_id in changed]
+            page = self.page(items, query, "/me/drive/root/delta")
+            if "@odata.nextLink" not in page:
+                page['@odata.deltaLink'] = f"{self.url}/v1.0/me/drive/root/delta?token={len(self.changes)}"
+        return page
+
+    def answer(self, method: str, path: str, query: dict) -> tuple:
+        """Answers a request (either alone or inside a $batch) given its method, path (relative to /v1.0) and
+        parsed query. Returns a tuple of status and body"""
+        if match := MockGraphHandler.root_pattern.fullmatch(path):
+            if match["action"] == "/delta":
+                return 200, self.delta(query)
+            item_path = match["path"] or ""
+            item = self.find(item_path)
+        elif match := MockGraphHandler.item_pattern.fullmatch(path):
+            item = self.items.get(match["id"])
+            item_path = self.path_of(item['id']) if item else ""
+        else:
+            return 501, error("NotImplemented", "Not implemented")
+        if item_path in self.failing:
+            return 503, error("serviceNotAvailable", "Service unavailable")
+        if item is None:
+            return 404, error("itemNotFound", "The resource could not be found.")
+        if method == "delete":
+            self.delete(item_path)
+            return 204, None
+        if match["action"] == "/children":
+            return 200, self.page([self.properties(child) for child in self.children(item['id'])], query, path)
+        if match["action"] == "/content":
+            return 200, item['content']
+        properties = self.properties(item)
+        if "$select" in query:
+            properties = {k: v for k, v in properties.items() if k in query["$select"][0].split(",")}
+        return 200, properties
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class MockGraphClient(GraphClient):
+    """GraphClient whose api root is a MockGraphServer"""
+
+    def __init__(self, service_root_url: str, token_callback):
+        super().__init__(token_callback=token_callback)
+        self._service_root_url = service_root_url
+
+    @property
+    def service_root_url(self) -> str:
+        return self._service_root_url
+
+
+class MockOneDrive(OneDrive):
+    """OneDrive client for a MockGraphServer, with a fake token instead of msal"""
+
+    def __init__(self, server: MockGraphServer, logger=None, session: requests.Session = None):
+        self.logger = logger or globals()["logger"]
+        self._session = session
+        token = dict(access_token="fake_token", token_type="Bearer")
+        self.ctx = MockGraphClient(server.url + "/v1.0", lambda: token)
+        self.ctx.with_transport(session=self.session)
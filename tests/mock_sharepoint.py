@@ -0,0 +1,523 @@
+"""
+Local stand-in of the sharepoint rest api, used to test and benchmark without a real tenant
+"""
+from __future__ import annotations
+
+import email
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+import requests
+from office365.runtime.auth.token_response import TokenResponse
+from office365.sharepoint.client_context import ClientContext
+
+from ong_office365 import logger
+from ong_office365.metadata_cache import MetadataCache
+from ong_office365.ong_sharepoint import Sharepoint
+
+
+def odata_filter(expression: str):
+    """Converts a simple odata filter (comparisons joined with and/or, with optional parentheses) to a function
+    that receives a row and returns True if row passes filter"""
+    operators = {"eq": "==", "ne": "!=", "gt": ">", "ge": ">=", "lt": "<", "le": "<=", "and": "and", "or": "or"}
+    tokens = re.findall(r"datetime'[^']*'|'(?:[^']|'')*'|\(|\)|[\w/.:-]+", expression)
+    python = []
+    for token in tokens:
+        if token in operators:
+            python.append(operators[token])
+        elif token in ("(", ")") or re.fullmatch(r"-?\d+(\.\d+)?", token) or token in ("true", "false", "null"):
+            python.append({"true": "True", "false": "False", "null": "None"}.get(token, token))
+        elif token.startswith("datetime'"):
+            python.append(repr(token[9:-1]))
+        elif token.startswith("'"):
+            python.append(repr(token[1:-1].replace("''", "'")))
+        else:
+            python.append(f"row.get({token!r})")
+    code = compile(" ".join(python), "<filter>", "eval")
+    return lambda row: eval(code, {"row": row})
+
+
+def odata_select(row: dict, select: list) -> dict:
+    """Returns the fields of row in select (expanded fields given as Field/Property). Without select, returns
+    all fields but the expanded ones"""
+    if not select:
+        return {k: v for k, v in row.items() if not isinstance(v, dict) and
+                not (isinstance(v, list) and v and isinstance(v[0], dict))}
+    retval = dict()
+    for column in select:
+        if "/" in column:
+            field, prop = column.split("/", 1)
+            value = row.get(field)
+            if isinstance(value, list):
+                retval.setdefault(field, [dict() for _ in value])
+                for target, source in zip(retval[field], value):
+                    target[prop] = source.get(prop)
+            else:
+                retval.setdefault(field, dict())[prop] = (value or dict()).get(prop)
+        else:
+            retval[column] = row.get(column)
+    return retval
+
+
+class MockSharepointHandler(BaseHTTPRequestHandler):
+    """Answers to the subset of sharepoint rest api used in tests. Files are read from server.files, a dict
+    of contents indexed by server relative url"""
+    protocol_version = "HTTP/1.1"
+    file_patterns = [
+        re.compile(r"GetFileByServerRelativePath\(DecodedUrl='(?P<url>.*?)'\)(?P<action>/.*)?$", re.IGNORECASE),
+        re.compile(r"GetFileByServerRelativeUrl\('(?P<url>.*?)'\)(?P<action>/.*)?$", re.IGNORECASE),
+    ]
+    folder_patterns = [
+        re.compile(r"GetFolderByServerRelativeUrl\('(?P<url>.*?)'\)(?P<action>/.*)?$", re.IGNORECASE),
+        re.compile(r"lists/GetByTitle\('(?P<list>.*?)'\)/RootFolder(?P<action>/.*)?$", re.IGNORECASE),
+        re.compile(r"DefaultDocumentLibrary(\(\))?/RootFolder(?P<action>/.*)?$", re.IGNORECASE),
+    ]
+    list_patterns = [
+        re.compile(r"/_api/web/lists\(guid'(?P<id>[\w-]+)'\)(?P<action>/.*)?$", re.IGNORECASE),
+        re.compile(r"/_api/web/lists/GetById\('(?P<id>[\w-]+)'\)(?P<action>/.*)?$", re.IGNORECASE),
+        re.compile(r"/_api/web/lists/GetByTitle\('(?P<title>.*?)'\)(?P<action>/.*)?$", re.IGNORECASE),
+    ]
+    upload_pattern = re.compile(r"/(?P<method>StartUpload|ContinueUpload|FinishUpload)"
+                                r"\(uploadId=guid'(?P<id>[\w-]+)'(,fileOffset=(?P<offset>\d+))?\)$", re.IGNORECASE)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, value: dict, status: int = 200, headers: dict = None):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;odata=verbose")
+        self.send_header("Content-Length", str(len(body)))
+        for key, header_value in (headers or dict()).items():
+            self.send_header(key, header_value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_bytes(self, body: bytes, status: int = 200, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for key, header_value in (headers or dict()).items():
+            self.send_header(key, header_value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self):
+        self.send_json({"error": {"code": "-2130575338", "message": "File Not Found."}}, status=404)
+
+    def send_not_implemented(self):
+        self.send_json({"error": "not implemented"}, status=501)
+
+    def throttled(self) -> bool:
+        """Sends a 429 response if server has to simulate throttling. Returns True in that case"""
+        with self.server.lock:
+            if self.server.throttle_requests <= 0:
+                return False
+            self.server.throttle_requests -= 1
+            self.server.throttled += 1
+        self.send_json({"error": "throttled"}, status=429, headers={"Retry-After": str(self.server.retry_after)})
+        return True
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    @staticmethod
+    def match(patterns: list, path: str):
+        """Returns match object of the first pattern matching path (with unquoted url) or None"""
+        for pattern in patterns:
+            if match := pattern.search(unquote(path)):
+                return match
+        return None
+
+    def server_relative_url(self, url: str) -> str:
+        """Converts a site relative url to server relative"""
+        url = url.replace("''", "'")
+        return url if url.startswith("/") else self.server.site_path + "/" + url
+
+    def folder_url(self, match: re.Match) -> str:
+        """Server relative url of the folder of a match of folder_patterns (root folders are the library's)"""
+        if match.groupdict().get("url") is None:
+            return self.server.site_path + "/Shared Documents"
+        return self.server_relative_url(match["url"])
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.headers.get("X-HTTP-Method", "").upper() == "DELETE":
+            return self.do_DELETE()
+        if "X-Batch-Part" not in self.headers:
+            time.sleep(self.server.latency)
+        path = urlparse(self.path).path
+        if path.endswith("/_api/$batch"):
+            return self.batch(body)
+        if path.lower().endswith("/_api/contextinfo"):
+            info = {"FormDigestValue": "digest", "FormDigestTimeoutSeconds": 1800}
+            return self.send_json(info if "nometadata" in self.headers.get("Accept", "")
+                                  else {"d": {"GetContextWebInformation": info}})
+        if folder := self.match(self.folder_patterns, path):
+            if match := re.match(r"/Files/add\((overwrite=true,)?url='(?P<name>.*?)'(,overwrite=true)?\)$",
+                                 folder["action"] or "", re.IGNORECASE):
+                url = self.folder_url(folder) + "/" + match["name"].replace("''", "'")
+                self.server.files[url] = body
+                return self.send_json({"ServerRelativeUrl": url, "Length": str(len(body))})
+        elif path.endswith("/_api/web/DefaultDocumentLibrary()/GetChanges"):
+            start = int(json.loads(body)["query"]["ChangeTokenStart"]["StringValue"])
+            if start > len(self.server.changes):
+                return self.send_json({"error": "invalid change token"}, status=400)
+            changes = [{"ChangeType": change_type, "ItemId": item_id, "ChangeToken": {"StringValue": str(token)}}
+                       for token, (change_type, item_id) in enumerate(self.server.changes, 1)]
+            return self.send_json({"value": changes[start:start + 3]})
+        elif file := self.match(self.file_patterns, path):
+            if upload := self.upload_pattern.match(file["action"] or ""):
+                return self.upload_chunk(self.server_relative_url(file["url"]), upload, body)
+        elif sp_list := self.match(self.list_patterns, path):
+            return self.write_list_item(sp_list, "POST", body)
+        self.send_not_implemented()
+
+    def do_PATCH(self):
+        body = self.read_body()
+        if sp_list := self.match(self.list_patterns, urlparse(self.path).path):
+            return self.write_list_item(sp_list, "PATCH", body)
+        self.send_not_implemented()
+
+    def do_DELETE(self):
+        if "X-Batch-Part" not in self.headers:
+            time.sleep(self.server.latency)
+        file = self.match(self.file_patterns, urlparse(self.path).path)
+        if file is None or file["action"]:
+            return self.send_not_implemented()
+        url = self.server_relative_url(file["url"])
+        if url not in self.server.files:
+            return self.send_not_found()
+        del self.server.files[url]
+        self.send_bytes(b"")
+
+    def upload_chunk(self, url: str, upload: re.Match, body: bytes):
+        """Handles StartUpload, ContinueUpload and FinishUpload of upload sessions"""
+        server = self.server
+        if server.fail_upload_after is not None:
+            if server.fail_upload_after == 0:
+                return self.send_json({"error": "simulated failure"}, status=500)
+            server.fail_upload_after -= 1
+        method, upload_id = upload["method"].lower(), upload["id"]
+        if method == "startupload":
+            if upload_id in server.uploads:
+                return self.send_json({"error": "upload session already started"}, status=400)
+            server.uploads[upload_id] = bytearray()
+        elif upload_id not in server.uploads or int(upload["offset"]) != len(server.uploads[upload_id]):
+            return self.send_json({"error": "invalid upload session or offset"}, status=400)
+        server.uploads[upload_id] += body
+        if server.lose_upload_responses:
+            # Chunk is processed, but the connection drops before the client gets the response
+            server.lose_upload_responses -= 1
+            self.close_connection = True
+            return
+        if method == "finishupload":
+            server.files[url] = bytes(server.uploads.pop(upload_id))
+            return self.send_json({"ServerRelativeUrl": url, "Length": str(len(server.files[url]))})
+        self.send_json({"value": str(len(server.uploads[upload_id]))})
+
+    def etag(self, url: str) -> str:
+        return '"{%s},1"' % hashlib.md5(self.server.files[url]).hexdigest()
+
+    def send_file(self, url: str):
+        """Sends file contents, honouring Range and If-Range headers"""
+        contents = self.server.files[url]
+        status, headers = 200, {"ETag": self.etag(url), "Accept-Ranges": "bytes"}
+        byte_range = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if byte_range and self.headers.get("If-Range", headers["ETag"]) == headers["ETag"]:
+            start = int(byte_range[1])
+            end = int(byte_range[2]) + 1 if byte_range[2] else len(contents)
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(contents)}"
+            status, contents = 206, contents[start:end]
+        if self.server.truncate_downloads is not None:
+            # Simulates a network failure: announces the whole body but sends just a part
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(contents)))
+            self.end_headers()
+            self.wfile.write(contents[:self.server.truncate_downloads])
+            self.close_connection = True
+            return
+        self.send_bytes(contents, status, headers)
+
+    def library_items(self) -> list:
+        """Items of the default document library (files of server and their folders), sorted by id"""
+        library_url = self.server.site_path + "/Shared Documents"
+        items = dict()
+        for url in list(self.server.files):
+            if not url.startswith(library_url + "/"):
+                continue
+            items[url] = dict(FileRef=url, FSObjType=0, Modified=self.server.modified.get(url, "2024-01-01T00:00:00Z"),
+                              File=dict(Length=str(len(self.server.files[url])), ETag=self.etag(url)))
+            folder = os.path.dirname(url)
+            while folder != library_url and folder not in items:
+                items[folder] = dict(FileRef=folder, FSObjType=1, Modified="2024-01-01T00:00:00Z", File=None)
+                folder = os.path.dirname(folder)
+        for url, item in items.items():
+            item['ID'] = self.server.item_ids.setdefault(url, len(self.server.item_ids) + 1)
+        return sorted(items.values(), key=lambda item: item['ID'])
+
+    def send_page(self, rows: list, query: dict):
+        """Sends a page of rows according to $top and $skiptoken query parameters, in verbose or nometadata format
+        according to Accept header"""
+        top = int(query.get("$top", ["100"])[0])
+        skip = int(query.get("$skiptoken", ["0"])[0])
+        next_link = None
+        if skip + top < len(rows):
+            query = {**{k: v[0] for k, v in query.items()}, "$skiptoken": skip + top}
+            next_link = f"{self.server.url}{urlparse(self.path).path.split(self.server.site_path, 1)[1]}" \
+                        f"?{urlencode(query)}"
+        rows = rows[skip:skip + top]
+        if "nometadata" in self.headers.get("Accept", ""):
+            page = {"value": rows}
+            if next_link:
+                page["odata.nextLink"] = next_link
+        else:
+            page = {"d": {"results": [{"__metadata": {"type": "SP.Data.ListItem"}, **row} for row in rows]}}
+            if next_link:
+                page["d"]["__next"] = next_link
+        self.send_json(page)
+
+    def find_list(self, match: re.Match) -> dict | None:
+        """Returns the list given by id or title in a match of list_patterns (None if not found)"""
+        if "id" in match.groupdict():
+            return self.server.lists.get(match["id"])
+        return next((sp_list for sp_list in self.server.lists.values()
+                     if sp_list["title"] == match["title"].replace("''", "'")), None)
+
+    def write_list_item(self, match: re.Match, method: str, body: bytes):
+        """Creates (POST to items) or updates (PATCH to items(id)) an item of a list"""
+        sp_list = self.find_list(match)
+        action = re.match(r"/items(\((?P<id>\d+)\))?$", match["action"] or "", re.IGNORECASE)
+        if sp_list is None or action is None or (method == "PATCH") != bool(action["id"]):
+            return self.send_not_implemented()
+        values = json.loads(body)
+        valid = {f["InternalName"] + ("Id" if f["TypeAsString"] in ("Lookup", "User") else "")
+                 for f in sp_list["fields"]} - {"ID"}
+        numeric = {f["InternalName"] for f in sp_list["fields"] if f["TypeAsString"] in ("Number", "Integer")}
+        if invalid := [k for k in values if k not in valid]:
+            message = f"Column '{invalid[0]}' does not exist. It may have been deleted by another user."
+        elif invalid := [k for k in values if k in numeric and isinstance(values[k], str)]:
+            message = f"Cannot convert a primitive value to the expected type 'Edm.Double' for '{invalid[0]}'."
+        if invalid:
+            return self.send_json({"odata.error": {"code": "-2146232832", "message": {"lang": "en-US",
+                                                                                      "value": message}}}, 400)
+        with self.server.lock:
+            if method == "PATCH":
+                item = next((i for i in sp_list["items"] if i["ID"] == int(action["id"])), None)
+                if item is None:
+                    return self.send_json({"odata.error": {"message": {"value": "Item does not exist"}}}, 404)
+                item.update(values)
+                return self.send_bytes(b"", status=204)
+            item = dict(values, ID=max((i["ID"] for i in sp_list["items"]), default=0) + 1)
+            sp_list["items"].append(item)
+        return self.send_json(item, status=201)
+
+    def batch(self, body: bytes):
+        """Answers a $batch request, sending each of its requests to this same server"""
+        message = email.message_from_bytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body,
+                                           policy=HTTP)
+        parts = []
+        for part in message.walk():
+            if part.get_content_type() != "application/http":
+                continue
+            head, _, content = part.get_payload(decode=True).partition(b"\r\n\r\n")
+            request_line, *header_lines = head.decode().split("\r\n")
+            method, url, _ = request_line.split(" ")
+            headers = dict(line.split(": ", 1) for line in header_lines if line)
+            headers.update({"X-Batch-Part": "1", "Authorization": self.headers.get("Authorization", "")})
+            resp = requests.request(method, url, headers=headers, data=content.strip() or None)
+            parts.append("\r\n".join(["--batchresponse", "Content-Type: application/http",
+                                       "Content-Transfer-Encoding: binary", "",
+                                       f"HTTP/1.1 {resp.status_code} {resp.reason}",
+                                       f"Content-Type: {resp.headers.get('Content-Type', 'text/plain')}", "",
+                                       resp.text]))
+        self.server.batches += 1
+        response = "\r\n".join(parts + ["--batchresponse--", ""]).encode()
+        self.send_bytes(response, headers={"Content-Type": "multipart/mixed; boundary=batchresponse"})
+
+    def send_list(self, match: re.Match, query: dict):
+        """Answers requests to lists given by id or title"""
+        sp_list = self.find_list(match)
+        if sp_list is None:
+            return self.send_json({"error": "list not found"}, status=404)
+        action = (match["action"] or "").lower()
+        if action == "/fields":
+            return self.send_json({"value": sp_list["fields"]})
+        if action == "/items":
+            items = sp_list["items"]
+            if "$filter" in query:
+                items = list(filter(odata_filter(query["$filter"][0]), items))
+            if "$orderby" in query:
+                field, *direction = query["$orderby"][0].split()
+                items = sorted(items, key=lambda row: row.get(field), reverse=direction == ["desc"])
+            select = [c for c in query.get("$select", [""])[0].split(",") if c]
+            return self.send_page([odata_select(row, select) for row in items], query)
+        if not action:
+            properties = {"Id": sp_list["id"], "Title": sp_list["title"], "ItemCount": len(sp_list["items"])}
+            return self.send_json(properties if "nometadata" in self.headers.get("Accept", "") else {"d": properties})
+        self.send_not_implemented()
+
+    def send_folder(self, match: re.Match):
+        """Answers requests for the properties, subfolders (/Folders) or files (/Files) of a folder"""
+        folder_url = self.folder_url(match)
+        action = (match["action"] or "").lower()
+        if not action:
+            properties = {"ServerRelativeUrl": folder_url, "Name": folder_url.split("/")[-1]}
+            return self.send_json(properties if "nometadata" in self.headers.get("Accept", "") else {"d": properties})
+        children = {url[len(folder_url) + 1:].split("/")[0] for url in self.server.files
+                    if url.startswith(folder_url + "/")}
+        if action == "/folders":
+            urls = [folder_url + "/" + name for name in sorted(children)]
+            rows = [dict(ServerRelativeUrl=url, Name=url.split("/")[-1]) for url in urls
+                    if url not in self.server.files]
+        elif action == "/files":
+            urls = [folder_url + "/" + name for name in sorted(children)]
+            rows = [dict(ServerRelativeUrl=url, Name=url.split("/")[-1], Length=str(len(self.server.files[url])),
+                         ETag=self.etag(url)) for url in urls if url in self.server.files]
+        else:
+            return self.send_not_implemented()
+        self.send_json({"value": rows} if "nometadata" in self.headers.get("Accept", "") else {"d": {"results": rows}})
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            self.get()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def get(self):
+        if "X-Batch-Part" not in self.headers:
+            time.sleep(self.server.latency)
+        self.server.requests += 1
+        self.server.paths.append(self.path)
+        if self.throttled():
+            return
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path.endswith("/_api/web/DefaultDocumentLibrary()/items"):
+            items = self.library_items()
+            if "$filter" in query:
+                ids = {int(i) for i in re.findall(r"ID eq (\d+)", query["$filter"][0])}
+                items = [item for item in items if item["ID"] in ids]
+            return self.send_page(items, query)
+        if parsed.path.endswith("/_api/web/DefaultDocumentLibrary()"):
+            return self.send_json({"CurrentChangeToken": {"StringValue": str(len(self.server.changes))},
+                                   "RootFolder": {"ServerRelativeUrl": self.server.site_path + "/Shared Documents"}})
+        if sp_list := self.match(self.list_patterns, parsed.path):
+            return self.send_list(sp_list, query)
+        if folder := self.match(self.folder_patterns, parsed.path):
+            return self.send_folder(folder)
+        file = self.match(self.file_patterns, parsed.path)
+        if file is None or (file["action"] or "/$value") != "/$value":
+            return self.send_not_implemented()
+        url = self.server_relative_url(file["url"])
+        if url not in self.server.files:
+            self.send_not_found()
+        elif file["action"]:
+            self.send_file(url)
+        elif self.headers.get("If-None-Match") == self.etag(url):
+            self.send_bytes(b"", status=304, headers={"ETag": self.etag(url)})
+        else:
+            properties = {"ServerRelativeUrl": url, "Length": str(len(self.server.files[url])),
+                          "Name": url.split("/")[-1], "ETag": self.etag(url)}
+            self.send_json(properties if "nometadata" in self.headers.get("Accept", "") else {"d": properties},
+                           headers={"ETag": self.etag(url)})
+
+
+class MockSharepointServer(ThreadingHTTPServer):
+    """Http server running in a background thread. Use it as a context manager"""
+    daemon_threads = True
+    site_path = "/sites/test"
+
+    def __init__(self, files: dict = None, latency: float = 0, handler=MockSharepointHandler):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.files = files or dict()
+        self.latency = latency
+        self.requests = 0
+        self.paths = []                 # paths of GET requests
+        self.uploads = dict()
+        self.item_ids = dict()          # ids of library items, indexed by url
+        self.modified = dict()          # modification timestamps of files, indexed by url
+        self.changes = list()           # change log of library, as tuples of (change type, item id)
+        self.lists = dict()             # lists, indexed by id (see add_list)
+        self.fail_upload_after = None   # number of upload chunks accepted before simulating a failure
+        self.lose_upload_responses = 0  # number of next upload chunks processed whose response is not sent
+        self.truncate_downloads = None  # number of bytes of file contents sent before simulating a failure
+        self.throttle_requests = 0      # number of next requests answered with 429 to simulate throttling
+        self.retry_after = 1            # value of Retry-After header of throttled requests
+        self.throttled = 0              # number of requests answered with 429
+        self.batches = 0                # number of $batch requests
+        self.active = 0                 # number of GET requests being answered
+        self.max_active = 0             # maximum number of GET requests answered at once
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def add_list(self, title: str, fields: dict, items: list) -> str:
+        """Adds a list with the given fields (dict of TypeAsString indexed by InternalName) and items (list of dicts).
+        Returns id of the new list"""
+        list_id = str(uuid.uuid4())
+        self.lists[list_id] = dict(id=list_id, title=title, items=items,
+                                   fields=[dict(InternalName=k, TypeAsString=v) for k, v in fields.items()])
+        return list_id
+
+    def put_file(self, url: str, contents: bytes):
+        """Creates or updates a file, logging the change"""
+        change_type = 2 if url in self.files else 1
+        self.files[url] = contents
+        self.changes.append((change_type, self.item_ids.setdefault(url, len(self.item_ids) + 1)))
+
+    def delete_file(self, url: str):
+        """Deletes a file, logging the change"""
+        del self.files[url]
+        self.changes.append((3, self.item_ids[url]))
+
+    def delete_folder(self, url: str):
+        """Deletes a folder and its files. As in sharepoint, only the folder is logged as changed"""
+        for file_url in [file_url for file_url in self.files if file_url.startswith(url + "/")]:
+            del self.files[file_url]
+        self.changes.append((3, self.item_ids[url]))
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}{self.site_path}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSeleniumBroker:
+    """Stand-in of a TokenBroker for SeleniumSharepoint, whose token manager gives a fake token with no browser"""
+
+    def selenium_token_manager(self):
+        return self
+
+    @staticmethod
+    def get_token_office() -> TokenResponse:
+        return TokenResponse.from_json(dict(access_token="fake_token", token_type="Bearer"))
+
+
+class MockSharepoint(Sharepoint):
+    """Sharepoint client for a MockSharepointServer, with a fake token instead of msal"""
+
+    def __init__(self, server: str, logger=None, session: requests.Session = None,
+                 metadata_cache: MetadataCache = None):
+        self.logger = logger or globals()["logger"]
+        self.metadata_cache = metadata_cache
+        self._session = session
+        token = TokenResponse.from_json(dict(access_token="fake_token", token_type="Bearer"))
+        self.ctx = ClientContext(server).with_access_token(lambda: token).with_transport(session=self.session)
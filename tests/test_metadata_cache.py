@@ -0,0 +1,79 @@
+"""
+Tests of MetadataCache: LRU eviction, TTL, revalidation with ETags and persistence in sqlite
+"""
+import os
+import tempfile
+import time
+import unittest
+
+from ong_office365.metadata_cache import MetadataCache
+
+
+class Loader:
+    """Stand-in of a server: returns value and etag, or None if the etag it receives is still valid"""
+
+    def __init__(self, value, etag=None):
+        self.value = value
+        self.etag = etag
+        self.calls = []
+
+    def __call__(self, etag):
+        self.calls.append(etag)
+        if etag is not None and etag == self.etag:
+            return None
+        return self.value, self.etag
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def test_ttl(self):
+        """Fresh entries are hits, expired ones are revalidated if they have an etag and read again otherwise"""
+        cache = MetadataCache(ttl=0.1)
+        with_etag, without_etag = Loader({"a": 1}, '"1"'), Loader([1, 2])
+        for _ in range(3):
+            self.assertEqual(cache.fetch("with_etag", with_etag), {"a": 1})
+            self.assertEqual(cache.fetch("without_etag", without_etag), [1, 2])
+        self.assertEqual(cache.stats.hits, 4)
+        self.assertEqual(cache.stats.misses, 2)
+        time.sleep(0.15)
+        self.assertEqual(cache.fetch("with_etag", with_etag), {"a": 1})
+        self.assertEqual(cache.fetch("without_etag", without_etag), [1, 2])
+        self.assertEqual(with_etag.calls, [None, '"1"'])
+        self.assertEqual(without_etag.calls, [None, None])
+        self.assertEqual(cache.stats.revalidations, 1)
+        self.assertEqual(cache.stats.misses, 3)
+        # A modified value replaces cached one
+        time.sleep(0.15)
+        with_etag.value, with_etag.etag = {"a": 2}, '"2"'
+        self.assertEqual(cache.fetch("with_etag", with_etag), {"a": 2})
+        self.assertEqual(cache.get("with_etag").etag, '"2"')
+
+    def test_lru(self):
+        cache = MetadataCache(max_entries=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a").value, 1)
+        self.assertEqual(cache.stats.entries, 2)
+        cache.invalidate("a", "missing")
+        self.assertIsNone(cache.get("a"))
+
+    def test_sqlite(self):
+        """Entries outlive the cache object when it is backed by a file"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metadata.sqlite")
+            cache = MetadataCache(path=path)
+            cache.put("a", {"Name": "a.txt"}, '"1"')
+            cache.put("b", None)
+            cache.invalidate("b")
+            cache.close()
+            cache = MetadataCache(path=path)
+            self.assertEqual(cache.get("a"), cache.get("a")._replace(value={"Name": "a.txt"}, etag='"1"'))
+            self.assertIsNone(cache.get("b"))
+            cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+"""
+Tests (and microbenchmark) of MsalTokenManager with a stand-in of msal.PublicClientApplication, so they need
+neither network nor a real tenant
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import jwt
+
+from msal_extensions import LockError
+
+from ong_office365.msal_token_manager import MsalTokenManager, TokenBroker, process_lock
+from ong_office365.ong_onedrive import OneDrive
+from ong_office365.ong_sharepoint import Sharepoint
+from tests.benchmark import report
+from tests.mock_authority import MockAuthorityServer, MockAuthoritySession, mock_token_manager, token_worker, \
+    CLIENT_ID, EMAIL, TENANT
+
+
+token_ids = itertools.count()
+
+
+def fake_token(expires_in: float) -> str:
+    """Returns a (unique) jwt access token that expires in the given seconds"""
+    return jwt.encode({"exp": int(time.time() + expires_in), "scp": "AllSites.Read", "jti": next(token_ids)},
+                      "secret" * 8, algorithm="HS256")
+
+
+class FakePublicClientApplication:
+    """Stand-in of msal.PublicClientApplication that counts instances and token requests. It takes some time
+    to be created (as authority discovery does) and to return tokens (as reading the persisted cache does)"""
+    instances = 0
+    discovery_time = 0.05
+    cache_read_time = 0.005
+    token_expires_in = 3600
+
+    def __init__(self, **kwargs):
+        time.sleep(self.discovery_time)
+        FakePublicClientApplication.instances += 1
+        self.silent_calls = 0
+        self.refreshes = 0
+        self.last_result = None
+
+    def get_accounts(self, username=None):
+        time.sleep(self.cache_read_time)
+        return [dict(username=username)]
+
+    def acquire_token_silent_with_error(self, scopes, account):
+        time.sleep(self.cache_read_time)
+        self.silent_calls += 1
+        self.last_result = dict(access_token=fake_token(self.token_expires_in), token_type="Bearer",
+                                expires_in=self.token_expires_in)
+        return self.last_result
+
+    def acquire_token_silent(self, scopes, account, force_refresh=False):
+        """Returns last token (as if it were in the cache) unless force_refresh"""
+        time.sleep(self.cache_read_time)
+        if force_refresh or self.last_result is None:
+            self.refreshes += 1
+            self.last_result = dict(access_token=fake_token(self.token_expires_in), token_type="Bearer",
+                                    expires_in=self.token_expires_in)
+        return self.last_result
+
+
+class TestMsalTokenManager(unittest.TestCase):
+
+    def setUp(self):
+        FakePublicClientApplication.instances = 0
+        FakePublicClientApplication.token_expires_in = 3600
+        patcher = patch("msal.PublicClientApplication", FakePublicClientApplication)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.manager = MsalTokenManager(client_id="client_id", email="someone@contoso.com", server=None,
+                                        tenant="contoso",
+                                        cache_location=os.path.join(self.tmp_dir.name, "token_cache.bin"))
+
+    def test_token_reused(self):
+        """Token is returned from memory while it does not expire, and application is created only once"""
+        token = self.manager.acquire_token()['access_token']
+        for _ in range(100):
+            self.assertEqual(self.manager.acquire_token()['access_token'], token)
+        self.assertEqual(FakePublicClientApplication.instances, 1)
+        self.assertEqual(self.manager.app.silent_calls, 1)
+        self.assertAlmostEqual(self.manager.token_expires_in, 3600, delta=5)
+
+    def test_token_renewed_before_expiry(self):
+        """A token about to expire is renewed with the same application"""
+        FakePublicClientApplication.token_expires_in = MsalTokenManager.TOKEN_EXPIRY_MARGIN - 1
+        self.manager.acquire_token()
+        self.manager.acquire_token()
+        self.assertEqual(self.manager.app.silent_calls, 2)
+        self.assertEqual(FakePublicClientApplication.instances, 1)
+
+    def test_single_flight(self):
+        """Threads asking for a token at once wait for a single request"""
+        FakePublicClientApplication.cache_read_time = 0.1
+        self.addCleanup(setattr, FakePublicClientApplication, "cache_read_time", 0.005)
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(self.manager.acquire_token()['access_token']))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(tokens)), 1)
+        self.assertEqual(self.manager.app.silent_calls, 1)
+
+    def test_background_refresh(self):
+        """Token is renewed in background before it expires, so callers get the new one straight from memory"""
+        refresh_before = 600
+        FakePublicClientApplication.token_expires_in = refresh_before + 1
+        token = self.manager.acquire_token()['access_token']
+        FakePublicClientApplication.token_expires_in = 3600
+        self.manager.start_background_refresh(refresh_before=refresh_before)
+        self.addCleanup(self.manager.stop_background_refresh)
+        time.sleep(2)
+        self.assertEqual(self.manager.app.refreshes, 1)
+        new_token = self.manager.acquire_token()['access_token']
+        self.assertNotEqual(new_token, token)
+        self.assertEqual(self.manager.app.silent_calls, 1)
+        self.assertEqual(self.manager.refresh_token_silent(refresh_before)['access_token'], new_token)
+        self.assertEqual(self.manager.app.refreshes, 1)
+
+    def test_benchmark_acquire_token(self):
+        """Compares latency of first token acquisition and of the following ones"""
+        tic = time.perf_counter()
+        self.manager.acquire_token_response()
+        cold = time.perf_counter() - tic
+        n_calls = 10_000
+        tic = time.perf_counter()
+        for _ in range(n_calls):
+            self.manager.acquire_token_response()
+        hot = (time.perf_counter() - tic) / n_calls
+        report(f"acquire_token_response: first call {cold * 1e3:.2f}ms, next calls {hot * 1e6:.2f}us")
+        # Next calls are answered from memory, without asking msal
+        self.assertEqual(self.manager.app.silent_calls, 1)
+        self.assertEqual(FakePublicClientApplication.instances, 1)
+
+
+class TestSharedTokenCache(unittest.TestCase):
+    """Real msal applications in several processes sharing a token cache, against a local authority"""
+
+    n_processes = 8
+    renewals = 5
+
+    def setUp(self):
+        self.server = MockAuthorityServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cache_location = os.path.join(self.tmp_dir.name, "token_cache.bin")
+        # Seeds cache with an account and an expired access token
+        self.server.expires_in = 0
+        manager = mock_token_manager(self.cache_location, self.server.url)
+        manager.app.acquire_token_by_refresh_token(self.server.issue_refresh_token(), scopes=manager.scopes)
+        self.server.expires_in = 3600
+
+    def test_stress_processes(self):
+        """Processes refreshing at once share a single refresh token without corrupting the cache"""
+        start_at = time.time() + 5      # time for processes to start
+        args = [(self.cache_location, self.server.url, start_at, self.renewals)] * self.n_processes
+        with multiprocessing.get_context("spawn").Pool(self.n_processes) as pool:
+            results = pool.starmap(token_worker, args)
+        self.assertEqual(self.server.invalid_grants, 0)
+        # Seed, plus the expired token renewed by a single process (the rest found it, or a newer one, in the
+        # cache), plus forced renewals
+        self.assertEqual(self.server.token_requests, 2 + self.n_processes * self.renewals)
+        renewed = [token for tokens in results for token in tokens[1:]]
+        self.assertEqual(len(set(renewed)), len(renewed))
+        with open(self.cache_location) as f:
+            self.assertEqual(len(json.load(f)["RefreshToken"]), 1)
+
+
+class TestTokenBroker(unittest.TestCase):
+    """A broker issues tokens for several resources from a single account"""
+
+    def setUp(self):
+        self.server = MockAuthorityServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.broker = TokenBroker(client_id=CLIENT_ID, email=EMAIL, tenant=TENANT,
+                                  cache_location=os.path.join(self.tmp_dir.name, "token_cache.bin"),
+                                  http_client=MockAuthoritySession(self.server.url))
+        manager = self.broker.token_manager(None)
+        manager.app.acquire_token_by_refresh_token(self.server.issue_refresh_token(), scopes=manager.scopes)
+
+    def test_token_per_resource(self):
+        servers = {None: "https://graph.microsoft.com",
+                   "https://contoso.sharepoint.com/sites/a": "https://contoso.sharepoint.com",
+                   "https://contoso.sharepoint.com/sites/b": "https://contoso.sharepoint.com",
+                   "https://contoso-my.sharepoint.com/personal/someone": "https://contoso-my.sharepoint.com"}
+        managers = {server: self.broker.token_manager(server) for server in servers}
+        self.assertIs(managers["https://contoso.sharepoint.com/sites/a"],
+                      managers["https://contoso.sharepoint.com/sites/b"])
+        self.assertEqual(len({manager.app for manager in managers.values()}), 1)
+        for _ in range(3):
+            for server, audience in servers.items():
+                self.assertEqual(managers[server].last_decoded_token["aud"], audience)
+        # Seed plus one token for sharepoint and another for onedrive (graph token came with the seed)
+        self.assertEqual(self.server.token_requests, 3)
+        self.assertEqual(self.server.invalid_grants, 0)
+
+    def test_clients_share_broker(self):
+        sharepoint = Sharepoint(server="https://contoso.sharepoint.com/sites/a", token_broker=self.broker)
+        onedrive = OneDrive(token_broker=self.broker)
+        self.assertIs(sharepoint.token_manager, self.broker.token_manager("https://contoso.sharepoint.com/"))
+        self.assertIs(onedrive.token_manager, self.broker.token_manager(None))
+        self.assertIs(sharepoint.token_manager.app, onedrive.token_manager.app)
+
+    def test_token_manager_cached(self):
+        """Known resources get their manager without building a new one"""
+        manager = self.broker.token_manager("https://contoso.sharepoint.com/sites/a")
+        with patch("ong_office365.msal_token_manager.MsalTokenManager") as token_manager_class:
+            for _ in range(3):
+                self.assertIs(self.broker.token_manager("https://contoso.sharepoint.com/sites/b"), manager)
+        token_manager_class.assert_not_called()
+
+
+class TestProcessLock(unittest.TestCase):
+    """Lock files left by killed processes do not block token acquisition"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = os.path.join(self.tmp_dir.name, "token_cache.bin.acquire.lockfile")
+
+    def write_lock(self, pid: int, age: float = 0):
+        with open(self.path, "w") as f:
+            f.write(f"{pid} killed_process.py")
+        os.utime(self.path, (time.time() - age, time.time() - age))
+
+    @unittest.skipIf(sys.platform == "win32", "pid of a lock cannot be checked in Windows")
+    def test_lock_of_dead_process(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        self.write_lock(process.pid)
+        with process_lock(self.path, timeout=60):
+            with open(self.path) as f:
+                self.assertEqual(int(f.read().split()[0]), os.getpid())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_old_lock(self):
+        self.write_lock(os.getpid(), age=120)
+        with process_lock(self.path, timeout=60):
+            pass
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_lock_held(self):
+        """A lock of a running process is not removed: it fails instead of going on without lock"""
+        self.write_lock(os.getpid())
+        with self.assertRaises(LockError):
+            with process_lock(self.path, timeout=0.5):
+                pass
+        self.assertTrue(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
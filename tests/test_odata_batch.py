@@ -0,0 +1,53 @@
+"""
+Tests of the builders and parsers of sharepoint and ms graph $batch requests
+"""
+import unittest
+
+from ong_office365.odata_batch import build_graph_batch, parse_graph_batch, build_sharepoint_batch, \
+    parse_sharepoint_batch
+
+GRAPH_ROOT = "https://graph.microsoft.com/v1.0"
+
+
+class TestODataBatch(unittest.TestCase):
+
+    def test_graph_batch(self):
+        requests = [dict(method="get", url=f"{GRAPH_ROOT}/me/drive/root:/a.txt"),
+                    dict(method="patch", url="/me/drive/items/1", body={"name": "b.txt"}),
+                    dict(method="delete", url=f"{GRAPH_ROOT}/me/drive/items/2", headers={"If-Match": "*"})]
+        batch = build_graph_batch(requests, GRAPH_ROOT)
+        self.assertEqual(batch["requests"], [
+            dict(id="0", method="GET", url="/me/drive/root:/a.txt"),
+            dict(id="1", method="PATCH", url="/me/drive/items/1", body={"name": "b.txt"},
+                 headers={"Content-Type": "application/json"}),
+            dict(id="2", method="DELETE", url="/me/drive/items/2", headers={"If-Match": "*"})])
+        # Responses come in any order
+        responses = parse_graph_batch({"responses": [
+            dict(id="2", status=204),
+            dict(id="0", status=404, body={"error": {"code": "itemNotFound", "message": "Item not found"}}),
+            dict(id="1", status=200, headers={"Content-Type": "application/json"}, body={"id": "1"})]})
+        self.assertEqual([response.status for response in responses], [404, 200, 204])
+        self.assertEqual(responses[0].error, "404: Item not found")
+        self.assertEqual(responses[1].body, {"id": "1"})
+        self.assertTrue(responses[2].ok)
+        self.assertIsNone(responses[2].error)
+
+    def test_sharepoint_batch(self):
+        requests = [dict(method="get", url="https://contoso.sharepoint.com/_api/web/lists"),
+                    dict(method="post", url="https://contoso.sharepoint.com/_api/web/lists/items", body={"a": 1})]
+        content_type, body = build_sharepoint_batch(requests)
+        self.assertTrue(content_type.startswith("multipart/mixed; boundary="))
+        self.assertEqual(body.count(b"changeset_"), 3)
+        response = b"\r\n".join([
+            b"--batchresponse", b"Content-Type: application/http", b"Content-Transfer-Encoding: binary", b"",
+            b"HTTP/1.1 200 OK", b"Content-Type: application/json", b"", b'{"value": []}',
+            b"--batchresponse", b"Content-Type: application/http", b"Content-Transfer-Encoding: binary", b"",
+            b"HTTP/1.1 400 Bad Request", b"Content-Type: application/json", b"",
+            b'{"odata.error": {"message": {"value": "Wrong"}}}', b"--batchresponse--", b""])
+        responses = parse_sharepoint_batch("multipart/mixed; boundary=batchresponse", response)
+        self.assertEqual(responses[0].body, {"value": []})
+        self.assertEqual(responses[1].error, "400: Wrong")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Tests (and benchmark) of AsyncSharepoint against a local stand-in of sharepoint rest api, so they do not need
+a real tenant nor authentication
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+import httpx
+
+from ong_office365.ong_async_sharepoint import AsyncSharepoint
+from tests.mock_sharepoint import MockSharepointServer, MockSharepoint
+
+
+class FakeTokenManager:
+    """Stand-in of MsalTokenManager that always has a valid token in memory"""
+    TOKEN_EXPIRY_MARGIN = 300
+    token_expires_in = 3600
+    last_token = "fake_token"
+
+
+class FailingTokenManager(FakeTokenManager):
+    """Stand-in of MsalTokenManager whose token expired and cannot be renewed"""
+    token_expires_in = 0
+
+    @staticmethod
+    def acquire_token() -> dict:
+        return dict(error="invalid_grant", error_description="AADSTS70043: The refresh token has expired")
+
+
+class TestAsyncSharepoint(unittest.TestCase):
+
+    n_files = 40
+    latency = 0.05      # simulated server round trip, in seconds
+    max_concurrency = 8
+
+    def setUp(self):
+        self.files = {f"/sites/test/Shared Documents/folder {i % 3}/file_{i}.bin": os.urandom(1000 + i)
+                      for i in range(self.n_files)}
+        self.server = MockSharepointServer(self.files, latency=self.latency).__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def run_async(self, coroutine_function, *args, **kwargs):
+        """Runs coroutine_function(sharepoint, *args, **kwargs) in a new event loop with a new AsyncSharepoint"""
+        async def main():
+            async with AsyncSharepoint(server=self.server.url, token_manager=FakeTokenManager(),
+                                       max_concurrency=self.max_concurrency) as sharepoint:
+                return await coroutine_function(sharepoint, *args, **kwargs)
+        return asyncio.run(main())
+
+    def test_list_folders_files(self):
+        folders = self.run_async(AsyncSharepoint.list_folders)
+        self.assertEqual(list(folders), [f"/sites/test/Shared Documents/folder {i}" for i in range(3)])
+        files = self.run_async(AsyncSharepoint.list_files_folder, "/sites/test/Shared Documents/folder 1")
+        self.assertEqual(set(files), {url for url in self.files if "/folder 1/" in url})
+        url = next(iter(files))
+        self.assertEqual(int(files[url]['Length']), len(self.files[url]))
+
+    def test_download_files(self):
+        """Downloads all files concurrently, never exceeding max_concurrency requests in flight"""
+        async def download_all(sharepoint):
+            return await asyncio.gather(*(sharepoint.download_file(url, self.tmp_dir.name) for url in self.files))
+
+        local_paths = self.run_async(download_all)
+        self.assertGreater(self.server.max_active, 1)
+        self.assertLessEqual(self.server.max_active, self.max_concurrency)
+        self.assertEqual(self.server.requests, len(self.files))
+        for url, local_path in zip(self.files, local_paths):
+            with open(local_path, "rb") as f:
+                self.assertEqual(f.read(), self.files[url], f"Wrong contents for {url}")
+
+    def test_download_throttled(self):
+        """Throttled downloads are retried, and they do not hold a slot while waiting"""
+        self.server.throttle_requests = 1
+        self.server.retry_after = 0.5
+        url = next(iter(self.files))
+        free_slots = []
+
+        async def download(sharepoint):
+            task = asyncio.create_task(sharepoint.download_file(url, self.tmp_dir.name))
+            while not self.server.throttled:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+            free_slots.append(sharepoint._AsyncSharepoint__concurrency_limit()._value)
+            return await task
+
+        local_path = self.run_async(download)
+        self.assertEqual(free_slots, [self.max_concurrency])
+        self.assertEqual(self.server.throttled, 1)
+        with open(local_path, "rb") as f:
+            self.assertEqual(f.read(), self.files[url])
+        # Errors are raised before anything is written
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.run_async(AsyncSharepoint.download_file, url + ".missing", self.tmp_dir.name)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, os.path.basename(url) + ".missing")))
+
+    def test_upload_file(self):
+        """Small files are uploaded at once and large ones in chunks"""
+        contents = dict(small=os.urandom(1000), large=os.urandom(2500))
+        for name, data in contents.items():
+            with open(os.path.join(self.tmp_dir.name, f"{name}.bin"), "wb") as f:
+                f.write(data)
+
+        async def upload_all(sharepoint):
+            sharepoint.LARGE_FILE_SIZE = 2000
+            sharepoint.UPLOAD_CHUNK_SIZE = 1000
+            return await asyncio.gather(
+                sharepoint.upload_file(os.path.join(self.tmp_dir.name, "small.bin")),
+                sharepoint.upload_file(os.path.join(self.tmp_dir.name, "large.bin"), "Shared Documents/folder 0"))
+
+        urls = self.run_async(upload_all)
+        self.assertEqual(urls, ["/sites/test/Shared Documents/small.bin",
+                                "/sites/test/Shared Documents/folder 0/large.bin"])
+        self.assertEqual(self.files[urls[0]], contents["small"])
+        self.assertEqual(self.files[urls[1]], contents["large"])
+
+    def test_exits(self):
+        url = next(iter(self.files))
+        self.assertTrue(self.run_async(AsyncSharepoint.exits, url))
+        self.assertFalse(self.run_async(AsyncSharepoint.exits, url + ".missing"))
+
+    def test_token_error(self):
+        """Errors of msal are raised with their description"""
+        async def main():
+            async with AsyncSharepoint(server=self.server.url, token_manager=FailingTokenManager()) as sharepoint:
+                return await sharepoint.exits(next(iter(self.files)))
+        with self.assertRaisesRegex(ValueError, "invalid_grant: AADSTS70043"):
+            asyncio.run(main())
+        self.assertEqual(self.server.requests, 0)
+
+    def test_read_list(self):
+        """Gives the same results as Sharepoint.read_list, either by pages or by concurrent windows of IDs"""
+        fields = dict(ID="Counter", Title="Text", Amount="Number", Author="User")
+        items = [dict(ID=i, Title=f"Item {i}", Amount=i * 1.5, AuthorId=i % 5,
+                      Author=dict(Title=f"User {i % 5}", EMail=f"user{i % 5}@test.com"))
+                 for i in range(1, 1001)]
+        list_id = self.server.add_list("Sample list", fields, items)
+        columns = ["Title", "Amount", "Author/Title"]
+        expected = MockSharepoint(self.server.url).read_list(list_id=list_id, columns=columns,
+                                                             filter="Amount gt 100")
+        df = self.run_async(AsyncSharepoint.read_list, list_id=list_id, columns=columns, filter="Amount gt 100",
+                            page_size=100)
+        self.assertTrue(df.equals(expected))
+        df = self.run_async(AsyncSharepoint.read_list, list_title="Sample list", columns=columns,
+                            filter="Amount gt 100", window_size=100)
+        self.assertTrue(df.equals(expected))
+        with self.assertRaises(ValueError):
+            self.run_async(AsyncSharepoint.read_list, list_id=list_id, order_by="Title", window_size=100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+"""
+Tests (and benchmarks) of Forms against a local stand-in of forms api, so they do not need a real tenant
+nor a browser to log in
+"""
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+import pandas as pd
+
+from ong_office365.forms_objects.questions import Section, QuestionChoice, QuestionText
+from ong_office365.ong_forms import error_code
+from ong_office365.response_cache import ResponseCache
+from tests.benchmark import report, skip_unless_benchmark
+from tests.mock_forms import MockFormsServer, MockForms, MockFormsTokenManager, sample_questions, sample_responses
+
+
+class TestFormsMock(unittest.TestCase):
+
+    latency = 0.01      # simulated server round trip, in seconds
+
+    def setUp(self):
+        self.server = MockFormsServer(latency=self.latency).__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.forms = MockForms(self.server)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def add_form(self, n_questions: int = 8, n_responses: int = 100) -> str:
+        questions = sample_questions(n_questions)
+        return self.server.add_form("Sample form", questions, sample_responses(questions, n_responses))
+
+    def test_iter_form_responses(self):
+        """Pages have the same columns and, put together, the same answers as get_form_responses"""
+        form_id = self.add_form(n_responses=250)
+        pages = list(self.forms.iter_form_responses(form_id, page_size=100, all_info=True))
+        self.assertEqual([len(page) for page in pages], [100, 100, 50])
+        self.assertTrue(all(page.columns.equals(pages[0].columns) for page in pages))
+        df = pd.concat(pages, ignore_index=True)
+        self.assertEqual(df['ID'].tolist(), list(range(1, 251)))
+        expected = pd.DataFrame(self.forms.get_form_responses(form_id, all_info=True))
+        for column in expected.columns:
+            if str(df[column].dtype) == "string":
+                self.assertEqual(df[column].fillna("").tolist(), expected[column].fillna("").tolist(), column)
+        self.assertEqual(len(self.forms.get_pandas_result(form_id, page_size=100)), 250)
+
+    def test_export_form_responses(self):
+        form_id = self.add_form(n_responses=120)
+        expected = self.forms.get_pandas_result(form_id).reset_index(drop=True)
+        csv_path = os.path.join(self.tmp_dir.name, "responses.csv")
+        self.assertEqual(self.forms.export_form_responses(form_id, csv_path, page_size=50), 120)
+        self.assertEqual(pd.read_csv(csv_path)['ID'].tolist(), expected['ID'].tolist())
+        parquet_path = os.path.join(self.tmp_dir.name, "responses.parquet")
+        self.assertEqual(self.forms.export_form_responses(form_id, parquet_path, page_size=50), 120)
+        self.assertTrue(pd.read_parquet(parquet_path).reset_index(drop=True).equals(expected))
+        with self.assertRaises(ValueError):
+            self.forms.export_form_responses(form_id, os.path.join(self.tmp_dir.name, "responses.xlsx"))
+        # A form without responses still gets its columns
+        empty_id = self.add_form(n_responses=0)
+        self.assertEqual(len(self.forms.get_pandas_result(empty_id).columns), 5 + 8)
+
+    def test_get_new_responses(self):
+        """Each poll only reads the responses submitted since the previous one"""
+        questions = sample_questions(6)
+        form_id = self.server.add_form("Polled form", questions, sample_responses(questions, 300))
+        cache_dir = self.tmp_dir.name
+        df = self.forms.get_new_responses(form_id, page_size=100, cache_dir=cache_dir)
+        self.assertEqual(df['ID'].tolist(), list(range(1, 301)))
+        self.assertEqual(len(self.forms.get_new_responses(form_id, page_size=100, cache_dir=cache_dir)), 0)
+        self.server.add_responses(form_id, sample_responses(questions, 5, first_id=301))
+        requests_before = self.server.requests
+        df = self.forms.get_new_responses(form_id, page_size=100, cache_dir=cache_dir)
+        self.assertEqual(df['ID'].tolist(), list(range(301, 306)))
+        self.assertEqual(df.columns.tolist()[5:], [q['title'] for q in questions])
+        response_paths = [path for path in self.server.paths[requests_before:] if "/responses" in path]
+        self.assertEqual(len(response_paths), 1)
+        self.assertIn("id+gt+300", response_paths[0])
+        cached = self.forms.get_cached_responses(form_id, cache_dir=cache_dir)
+        self.assertEqual(cached['ID'].tolist(), list(range(1, 306)))
+        # Responses are cached as received, and each form has its own cursor
+        other_id = self.add_form(n_responses=20)
+        self.assertEqual(len(self.forms.get_new_responses(other_id, cache_dir=cache_dir)), 20)
+        with ResponseCache(os.path.join(cache_dir, "responses.sqlite")) as cache:
+            self.assertEqual(cache.responses(form_id), self.server.forms[form_id]['responses'])
+            self.assertEqual(cache.cursor(form_id), (305, self.server.forms[form_id]['responses'][-1]['submitDate']))
+            self.assertEqual(cache.cursor(other_id).last_id, 20)
+
+    def test_get_new_responses_since(self):
+        """First poll can start at a response id or at a submit date"""
+        form_id = self.add_form(n_responses=50)
+        df = self.forms.get_new_responses(form_id, since=40, cache_dir=self.tmp_dir.name)
+        self.assertEqual(df['ID'].tolist(), list(range(41, 51)))
+        other_dir = os.path.join(self.tmp_dir.name, "other")
+        os.makedirs(other_dir)
+        since = pd.Timestamp(sample_responses(sample_questions(1), 1, first_id=45)[0]['submitDate'])
+        df = self.forms.get_new_responses(form_id, since=since.tz_localize(None).isoformat(), cache_dir=other_dir)
+        self.assertEqual(df['ID'].tolist(), list(range(46, 51)))
+
+    def test_typed_columns(self):
+        """Answers are converted to the type of their questions"""
+        form_id = self.add_form(n_questions=4, n_responses=20)
+        df = self.forms.get_pandas_result(form_id)
+        self.assertEqual([str(dtype) for dtype in df.dtypes.iloc[5:8]], ["string", "string", "Int64"])
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(df['Question 3']))
+        self.assertEqual(df['Question 2'].iloc[0], 2)
+        self.assertEqual(df['Question 3'].iloc[0], pd.Timestamp("2024-02-02"))
+        self.assertTrue(df['Question 1'].isna().iloc[0])
+
+    def test_schema_cache(self):
+        """Questions are read once per form version"""
+        form_id = self.add_form(n_responses=10)
+        for _ in range(3):
+            self.forms.get_pandas_result(form_id)
+        question_reads = [path for path in self.server.paths if path.endswith("/questions")]
+        self.assertEqual(len(question_reads), 1)
+        self.assertEqual(self.forms.schema_cache.stats.hits, 2)
+        # Once expired, schema is revalidated with modification date of the form
+        self.forms.schema_cache.ttl = 0
+        self.forms.get_pandas_result(form_id)
+        self.assertEqual(self.forms.schema_cache.stats.revalidations, 1)
+        self.assertEqual(len([path for path in self.server.paths if path.endswith("/questions")]), 1)
+        # A new question changes form version, so it is read again
+        new_question = dict(sample_questions(1)[0], title="New question", order=10 ** 10)
+        self.server.forms[form_id]['questions'].append(new_question)
+        self.server.forms[form_id]['properties']['modifiedDate'] = self.server.now()
+        self.assertEqual(self.forms.get_pandas_result(form_id).columns[-1], "New question")
+        # With a known version, no request is needed at all
+        self.forms.schema_cache.ttl = 300
+        version = self.forms.get_form_by(title="Sample form")[0]['modifiedDate']
+        requests_before = self.server.requests
+        self.assertIn(new_question['id'], self.forms.get_form_schema(form_id, version=version).columns)
+        self.assertEqual(self.server.requests, requests_before)
+
+    def test_get_form_questions(self):
+        """Questions of own forms are indexed by id, those of forms of other users are grouped by section"""
+        form_id = self.add_form(n_questions=3)
+        questions = self.server.forms[form_id]['questions']
+        self.assertEqual(self.forms.get_form_questions(form_id), {q['id']: q['title'] for q in questions})
+        self.server.other_user_forms.add(form_id)
+        self.assertEqual(self.forms.get_form_questions(form_id), {None: [q['title'] for q in questions]})
+        self.assertTrue(self.server.paths[-1].startswith("/handlers/ResponsePageStartup.ashx"))
+        self.assertEqual(error_code(b'{"error": {"code": "707", "message": "Form of another user"}}'), 707)
+        self.assertIsNone(error_code(b"<html>Not json</html>"))
+
+    def test_export_forms(self):
+        """Forms are exported concurrently and yielded as they finish"""
+        self.server.latency = 0.05
+        form_ids = [self.add_form(n_responses=10 * (i + 1)) for i in range(12)]
+        exports = list(self.forms.export_forms(form_ids + ["missing"], max_workers=8, page_size=20))
+        results = {export.form_id: export for export in exports}
+        self.assertEqual(set(results), set(form_ids + ["missing"]))
+        for i, form_id in enumerate(form_ids):
+            self.assertIsNone(results[form_id].error)
+            self.assertEqual(len(results[form_id].data), 10 * (i + 1))
+        self.assertIsNotNone(results["missing"].error)
+        # Requests of several forms are sent at once
+        self.assertGreater(self.server.max_active, 1)
+
+    def test_export_forms_relogin(self):
+        """When the session expires, a single thread logs in again while the rest wait for it"""
+        token_manager = MockFormsTokenManager(self.server, login_time=0.2)
+        forms = MockForms(self.server, token_manager=token_manager)
+        form_ids = [self.add_form(n_responses=30) for _ in range(8)]
+        # Token expires right after the list of forms is read
+        self.server.expire_token_after = 1
+        exports = list(forms.export_forms(form_ids, max_workers=8))
+        self.assertEqual([export.error for export in exports], [None] * len(form_ids))
+        self.assertEqual(token_manager.logins, 2)
+
+    @staticmethod
+    def menu_spec(n_sections: int, n_questions: int) -> dict:
+        """Spec of a form with a menu that jumps to n_sections sections of n_questions questions each"""
+        sections = [Section(f"Section {i}", to_the_end=True) for i in range(n_sections)]
+        return dict(title="Spec form", description="Created from a spec", items=[
+            (Section("Menu"), [QuestionChoice("Go to", choices=sections)]),
+            *[(section, [QuestionText(f"Question {j} of {section['title']}") for j in range(n_questions)])
+              for section in sections]])
+
+    def test_create_form_from_spec(self):
+        """Items keep the order of the spec and menus jump to the sections, even if server assigns other ids"""
+        for assign_ids in (False, True):
+            self.server.assign_ids = assign_ids
+            form = self.forms.create_form_from_spec(self.menu_spec(3, 2))
+            questions = self.server.forms[form['id']]['questions']
+            self.assertEqual(self.server.forms[form['id']]['properties']['description'], "Created from a spec")
+            self.assertEqual([q['title'] for q in questions], [q['title'] for q in form['questions']])
+            self.assertEqual([q['title'] for q in questions[:4]],
+                             ["Menu", "Go to", "Section 0", "Question 0 of Section 0"])
+            section_ids = [q['id'] for q in questions if q['title'].startswith("Section")]
+            menu = json.loads(questions[1]['questionInfo'])
+            self.assertEqual([choice['BranchInfo']['TargetQuestionId'] for choice in menu['Choices']], section_ids)
+
+    def test_create_form_from_spec_reused(self):
+        """A spec is not modified, so it creates the same form every time it is used"""
+        spec = self.menu_spec(3, 2)
+        items = [item for section, questions in spec['items'] for item in [section, *questions]]
+        payloads = json.dumps([item.payload() for item in items])
+        forms = [self.forms.create_form_from_spec(spec) for _ in range(2)]
+        self.assertEqual(json.dumps([item.payload() for item in items]), payloads)
+        questions = [self.server.forms[form['id']]['questions'] for form in forms]
+        self.assertEqual([(q['title'], q['order']) for q in questions[0]],
+                         [(q['title'], q['order']) for q in questions[1]])
+
+    def test_create_form_from_spec_failed(self):
+        """If any item cannot be created, the partially created form is deleted"""
+        self.server.failing_titles.add("Question 1 of Section 2")
+        with self.assertRaises(ValueError) as context:
+            self.forms.create_form_from_spec(self.menu_spec(3, 2))
+        self.assertEqual(self.server.forms, dict())
+        self.assertIn("1 items of form", str(context.exception))
+
+    def test_benchmark_create_form_from_spec(self):
+        """Items are created concurrently, so it is much faster than creating them one by one"""
+        self.server.latency = 0.02
+        spec = self.menu_spec(10, 10)
+        requests_before = self.server.requests
+        tic = time.perf_counter()
+        form = self.forms.create_form_from_spec(spec, max_workers=8)
+        report(f"Forms.create_form_from_spec: {len(form['questions'])} items in {time.perf_counter() - tic:.2f}s")
+        self.assertEqual(len(self.server.forms[form['id']]['questions']), 2 + 10 * 11)
+        # One request for the form and one per item, several of them at once
+        self.assertEqual(self.server.requests - requests_before, 1 + 2 + 10 * 11)
+        self.assertGreater(self.server.max_active, 1)
+
+    @skip_unless_benchmark
+    def test_benchmark_export(self):
+        """Paged export to parquet needs a fraction of the memory of reading all responses at once"""
+        self.server.latency = 0
+        form_id = self.add_form(n_questions=20, n_responses=20000)
+        parquet_path = os.path.join(self.tmp_dir.name, "responses.parquet")
+        results = dict()
+        for name, export in [
+            ("get_form_responses", lambda: pd.DataFrame(self.forms.get_form_responses(form_id, all_info=True))),
+            ("export_form_responses", lambda: self.forms.export_form_responses(form_id, parquet_path,
+                                                                               page_size=1000))]:
+            tracemalloc.start()
+            tic = time.perf_counter()
+            export()
+            elapsed = time.perf_counter() - tic
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = peak
+            report(f"{name}: 20000 responses in {elapsed:.2f}s, peak memory {peak / 2 ** 20:.1f}MB")
+        self.assertLess(results["export_form_responses"], results["get_form_responses"] / 2)
+        self.assertEqual(len(pd.read_parquet(parquet_path)), 20000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+Tests of OneDrive against a local stand-in of ms graph api, so they do not need a real tenant nor authentication
+"""
+import os
+import tempfile
+import unittest
+
+from ong_office365.ong_office365_base import SYNC_STATE_FILE
+from tests.mock_onedrive import MockGraphServer, MockOneDrive
+
+
+class TestOneDriveMock(unittest.TestCase):
+
+    n_files = 30
+    latency = 0.01      # simulated server round trip, in seconds
+
+    def setUp(self):
+        self.files = {f"Documents/folder {i % 3}/file_{i}.bin": os.urandom(100 + i) for i in range(self.n_files)}
+        self.server = MockGraphServer(self.files, latency=self.latency).__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.onedrive = MockOneDrive(self.server)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def assert_mirror(self, local_root: str):
+        """Checks that local_root contains exactly the files of the server"""
+        local_files = dict()
+        for folder, _, filenames in os.walk(local_root):
+            for filename in filenames:
+                if filename != SYNC_STATE_FILE:
+                    with open(os.path.join(folder, filename), "rb") as f:
+                        relative = os.path.relpath(os.path.join(folder, filename), local_root).replace(os.sep, "/")
+                        local_files[relative] = f.read()
+        self.assertEqual(local_files, self.server.files())
+
+    def test_sync_library(self):
+        """Files are mirrored in their folders (delta items do not have parent paths), and next syncs only get
+        the changes, including renamed and deleted folders"""
+        self.server.put_file("file_0.bin", b"same name as a nested file")
+        self.server.put_file("Documents/folder 0/deep/nested.bin", b"nested")
+        local_root = os.path.join(self.tmp_dir.name, "mirror")
+        result = self.onedrive.sync_library(local_root)
+        self.assertEqual(len(result["downloaded"]), self.n_files + 2)
+        self.assert_mirror(local_root)
+        self.assertEqual(self.onedrive.sync_library(local_root), dict(downloaded=[], deleted=[], errors=dict()))
+
+        self.server.put_file("Documents/folder 1/file_1.bin", b"changed")
+        self.server.put_file("Documents/new folder/deep/new file.bin", b"added")
+        self.server.rename("Documents/folder 0", "renamed folder")
+        self.server.delete("Documents/folder 2")
+        requests_before = self.server.requests
+        result = self.onedrive.sync_library(local_root)
+        self.assertEqual(sorted(result["downloaded"]), ["Documents/folder 1/file_1.bin",
+                                                        "Documents/new folder/deep/new file.bin"])
+        self.assertIn("Documents/folder 2", result["deleted"])
+        self.assert_mirror(local_root)
+        self.assertTrue(os.path.isfile(os.path.join(local_root, "Documents", "renamed folder", "deep", "nested.bin")))
+        # Just the delta and the changed files
+        self.assertEqual(self.server.requests - requests_before, 3)
+
+    def test_walk(self):
+        """Walks nested folders following the next links of paged children, honouring max_depth"""
+        for i in range(3):
+            for j in range(4):
+                self.server.put_file(f"Documents/folder {i}/sub {j}/deep/file.bin", b"deep")
+        self.server.page_size = 3
+        walked = {folder: (folders, files) for folder, folders, files in self.onedrive.walk(max_workers=8)}
+        self.assertEqual(len(walked), 1 + 1 + 3 + 12 + 12)
+        listed = {f"{folder}/{name}".strip("/") for folder, (_, files) in walked.items() for name in files}
+        self.assertEqual(listed, set(self.server.files()))
+        self.assertEqual(set(walked["Documents"][0]), {f"folder {i}" for i in range(3)})
+        # Folders of 10 files and 4 subfolders come in several pages
+        self.assertEqual(len(walked["Documents/folder 0"][1]), 10)
+        self.assertEqual(set(walked["Documents/folder 0"][0]), {f"sub {j}" for j in range(4)})
+        self.assertEqual(walked["Documents/folder 0/sub 0/deep"][1]["file.bin"]["size"], 4)
+        self.assertTrue(any("skip=" in path for path in self.server.paths))
+        self.assertGreater(self.server.max_active, 1)
+        shallow = [folder for folder, _, _ in self.onedrive.walk("/Documents/folder 1/", max_depth=1)]
+        self.assertEqual(shallow[0], "Documents/folder 1")
+        self.assertEqual(set(shallow[1:]), {f"Documents/folder 1/sub {j}" for j in range(4)})
+
+    def test_exists_many(self):
+        """Checks are sent in $batch requests of 20 at most, giving the same results as one by one"""
+        missing = [f"Documents/missing_{i}.bin" for i in range(10)]
+        paths = list(self.files) + missing
+        exists, errors = self.onedrive.exists_many(paths, batch_size=50)
+        self.assertEqual(errors, dict())
+        self.assertEqual(exists, {path: path in self.files for path in paths})
+        # Batch size is capped to the limit of ms graph, that rejects bigger batches
+        self.assertEqual(self.server.batches, 2)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_get_files_many(self):
+        """A failed request inside a successful $batch is reported for its item only"""
+        failing = "Documents/folder 1/file_1.bin"
+        self.server.failing.add(failing)
+        paths = ["Documents/missing.bin"] + list(self.files)
+        properties, errors = self.onedrive.get_files_many(paths, batch_size=7)
+        self.assertEqual(set(errors), {"Documents/missing.bin", failing})
+        self.assertTrue(errors["Documents/missing.bin"].startswith("404"))
+        self.assertTrue(errors[failing].startswith("503"))
+        self.assertEqual({path: p['size'] for path, p in properties.items()},
+                         {path: len(contents) for path, contents in self.files.items() if path != failing})
+        self.assertEqual(self.server.batches, 5)
+
+    def test_delete_many(self):
+        """Each deletion is independent, so missing items are reported without stopping the rest"""
+        paths = list(self.files)[:25]
+        missing = "Documents/missing.bin"
+        deleted, errors = self.onedrive.delete_many([missing] + paths)
+        self.assertEqual(set(deleted), set(paths))
+        self.assertEqual(list(errors), [missing])
+        self.assertTrue(errors[missing].startswith("404"))
+        self.assertEqual(set(self.server.files()), set(self.files) - set(paths))
+        self.assertEqual(self.server.batches, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
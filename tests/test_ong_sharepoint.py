@@ -1,6 +1,7 @@
 import datetime
 import unittest
 import os
+import tempfile
 from typing import Type
 
 from ong_office365.ong_office365_base import Office365Base
@@ -61,6 +62,14 @@ class TestSharepoint(TestOngOffice365Base):
         self.assertTrue(len(folders) > 0)
         self.assertTrue(len(files) > 0, "Site has no files")
 
+    @iterate_client_ids
+    def test_130_iter_items(self, client_id: str, sharepoint: Sharepoint):
+        """Tests that streamed items match those of get_all_folders_files"""
+        folders, files = sharepoint.get_all_folders_files()
+        items = list(sharepoint.iter_items())
+        self.assertEqual({i.url for i in items if i.type == "folder"}, set(folders))
+        self.assertEqual({i.url for i in items if i.type == "file"}, set(files))
+
     @iterate_client_ids
     def test_200_download_files(self, client_id: str, sharepoint: Sharepoint):
         """Tests that client_id can download files in the endpoint. Lists all files and
@@ -88,6 +97,17 @@ class TestSharepoint(TestOngOffice365Base):
                              msg=f"Wrong downloaded size for file {relative_url}")
             os.remove(filename)
 
+    @iterate_client_ids
+    def test_210_download_many(self, client_id: str, sharepoint: Sharepoint):
+        """Tests that client_id can download several files concurrently"""
+        all_folders, all_files = sharepoint.get_all_folders_files(limit=50)
+        with tempfile.TemporaryDirectory() as dest_folder:
+            downloaded, errors = sharepoint.download_many(all_files, dest_folder, keep_folders=True)
+            self.assertEqual(len(errors), 0, f"Errors found: {errors}")
+            for relative_url, local_path in downloaded.items():
+                self.assertEqual(os.stat(local_path).st_size, all_files[relative_url].length,
+                                 msg=f"Wrong downloaded size for file {relative_url}")
+
     @iterate_client_ids
     def test_300_upload_files(self, client_id: str, sharepoint: Sharepoint):
         # Create a temp file and upload to sharepoint
@@ -0,0 +1,537 @@
+"""
+Tests (and benchmarks) of Sharepoint against a local stand-in of sharepoint rest api, so they do not need
+a real tenant nor authentication
+"""
+import importlib.util
+import os
+import tempfile
+import time
+import tracemalloc
+import unittest
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import requests
+
+from ong_office365.http_transport import create_session
+from ong_office365.metadata_cache import MetadataCache
+from ong_office365.ong_office365_base import SYNC_STATE_FILE
+from ong_office365.ong_selenium_sharepoint import SeleniumSharepoint
+from ong_office365.ong_sharepoint import load_transfer_state
+from tests.benchmark import report, skip_unless_benchmark
+from tests.mock_sharepoint import MockSharepointServer, MockSharepoint, FakeSeleniumBroker
+
+
+class TestSharepointMock(unittest.TestCase):
+
+    n_files = 40
+    latency = 0.05      # simulated server round trip, in seconds
+
+    def setUp(self):
+        self.files = {f"/sites/test/Shared Documents/folder {i % 3}/file_{i}.bin": os.urandom(1000 + i)
+                      for i in range(self.n_files)}
+        self.server = MockSharepointServer(self.files, latency=self.latency).__enter__()
+        self.sharepoint = MockSharepoint(self.server.url)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.__exit__()
+        self.tmp_dir.cleanup()
+
+    def test_download_many(self):
+        """Downloads all files keeping folders and checks contents"""
+        self.files["/sites/test/Shared Documents/O'Brien.txt"] = b"quote in name"
+        downloaded, errors = self.sharepoint.download_many(self.files, self.tmp_dir.name, keep_folders=True)
+        self.assertEqual(errors, dict())
+        self.assertEqual(set(downloaded), set(self.files))
+        for url, local_path in downloaded.items():
+            with open(local_path, "rb") as f:
+                self.assertEqual(f.read(), self.files[url], f"Wrong contents for {url}")
+
+    def test_download_many_errors(self):
+        """A missing file is reported in errors, but does not stop the batch"""
+        missing = "/sites/test/Shared Documents/missing.bin"
+        downloaded, errors = self.sharepoint.download_many([missing, *self.files], self.tmp_dir.name,
+                                                           keep_folders=True)
+        self.assertEqual(list(errors), [missing])
+        self.assertEqual(errors[missing].response.status_code, 404)
+        self.assertEqual(len(downloaded), len(self.files))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "sites/test/Shared Documents/missing.bin")))
+
+    def test_download_many_keeps_local_copy(self):
+        """A failed download leaves the local copy of the file as it was"""
+        url = next(iter(self.files))
+        local_path = os.path.join(self.tmp_dir.name, os.path.basename(url))
+        with open(local_path, "wb") as f:
+            f.write(b"local copy")
+        for failure in ("truncated", "missing"):
+            if failure == "truncated":
+                self.server.truncate_downloads = 10
+            else:
+                self.server.truncate_downloads = None
+                del self.server.files[url]
+            downloaded, errors = self.sharepoint.download_many([url], self.tmp_dir.name)
+            self.assertEqual(list(errors), [url], failure)
+            with open(local_path, "rb") as f:
+                self.assertEqual(f.read(), b"local copy", failure)
+            self.assertEqual(os.listdir(self.tmp_dir.name), [os.path.basename(url)], failure)
+
+    def test_iter_items(self):
+        """Iterates library items in several pages"""
+        items = list(self.sharepoint.iter_items(page_size=7))
+        files = {item.url: item for item in items if item.type == "file"}
+        folders = {item.url for item in items if item.type == "folder"}
+        self.assertEqual(set(files), set(self.files))
+        self.assertEqual(folders, {f"/sites/test/Shared Documents/folder {i}" for i in range(3)})
+        for url, item in files.items():
+            self.assertEqual(item.size, len(self.files[url]))
+            self.assertIsNotNone(item.etag)
+        self.assertEqual(len(list(self.sharepoint.iter_items(page_size=7, limit=10))), 10)
+
+    def test_iter_items_streams(self):
+        """First item is available after reading just the first page"""
+        iterator = self.sharepoint.iter_items(page_size=5)
+        requests_before = self.server.requests
+        next(iterator)
+        self.assertEqual(self.server.requests - requests_before, 1)
+
+    def assert_mirror(self, local_root: str):
+        """Checks that local_root contains exactly the files of the server"""
+        local_files = dict()
+        for folder, _, filenames in os.walk(local_root):
+            for filename in filenames:
+                if filename != SYNC_STATE_FILE:
+                    with open(os.path.join(folder, filename), "rb") as f:
+                        relative = os.path.relpath(os.path.join(folder, filename), local_root).replace(os.sep, "/")
+                        local_files["/sites/test/Shared Documents/" + relative] = f.read()
+        self.assertEqual(local_files, self.server.files)
+
+    def test_sync_library(self):
+        """First sync downloads everything, next ones only the changes"""
+        local_root = os.path.join(self.tmp_dir.name, "mirror")
+        result = self.sharepoint.sync_library(local_root)
+        self.assertEqual(len(result["downloaded"]), self.n_files)
+        self.assert_mirror(local_root)
+        result = self.sharepoint.sync_library(local_root)
+        self.assertEqual(result, dict(downloaded=[], deleted=[], errors=dict()))
+
+        changed = "/sites/test/Shared Documents/folder 1/file_1.bin"
+        added = "/sites/test/Shared Documents/new folder/new file.bin"
+        removed = "/sites/test/Shared Documents/folder 2/file_2.bin"
+        self.server.put_file(changed, b"changed")
+        self.server.put_file(added, b"added")
+        self.server.delete_file(removed)
+        requests_before = self.server.requests
+        result = self.sharepoint.sync_library(local_root)
+        self.assertEqual(sorted(result["downloaded"]), sorted([changed, added]))
+        self.assertEqual(result["deleted"], [removed])
+        self.assert_mirror(local_root)
+        self.assertLess(self.server.requests - requests_before, 10)
+
+        # Contents of a deleted folder are dropped from the index along with the folder
+        removed_folder = "/sites/test/Shared Documents/folder 0"
+        self.server.delete_folder(removed_folder)
+        result = self.sharepoint.sync_library(local_root)
+        self.assertEqual(result["deleted"], [removed_folder])
+        self.assert_mirror(local_root)
+        index = load_transfer_state(os.path.join(local_root, SYNC_STATE_FILE))["items"]
+        self.assertFalse([url for url in index if url.startswith(removed_folder)])
+
+    def test_sync_library_invalid_token(self):
+        """If change token is not valid, whole library is listed again"""
+        local_root = os.path.join(self.tmp_dir.name, "mirror")
+        self.server.put_file("/sites/test/Shared Documents/folder 1/file_1.bin", b"changed")
+        self.sharepoint.sync_library(local_root)
+        self.server.delete_file("/sites/test/Shared Documents/folder 0/file_0.bin")
+        self.server.changes.clear()
+        result = self.sharepoint.sync_library(local_root)
+        self.assertEqual(result["deleted"], ["/sites/test/Shared Documents/folder 0/file_0.bin"])
+        self.assert_mirror(local_root)
+
+    def add_list(self, n_items: int) -> str:
+        """Adds a sample list to server, returning its id"""
+        fields = dict(ID="Counter", Title="Text", Amount="Number", Units="Integer", Done="Boolean",
+                      Modified="DateTime", Author="User", Tags="MultiChoice")
+        items = [dict(ID=i, Title=f"Item {i}", Amount=i * 1.5, Units=i % 7 or None, Done=i % 2 == 0,
+                      Modified=f"2024-01-{i % 28 + 1:02}T10:00:00Z", AuthorId=i % 5, Tags=["a", "b"][:i % 3],
+                      Author=dict(Title=f"User {i % 5}", EMail=f"user{i % 5}@test.com"))
+                 for i in range(1, n_items + 1)]
+        return self.server.add_list("Sample list", fields, items)
+
+    def test_read_list_columnar(self):
+        """Columns are typed according to list fields"""
+        list_id = self.add_list(1234)
+        df = self.sharepoint.read_list_columnar(list_id=list_id, page_size=100)
+        self.assertEqual(len(df), 1234)
+        self.assertEqual(df.index.tolist(), list(range(1, 1235)))
+        self.assertEqual({column: str(df[column].dtype) for column in ("Title", "Units", "Done", "AuthorId")},
+                         dict(Title="string", Units="Int64", Done="boolean", AuthorId="Int64"))
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(df["Modified"]))
+        df_title = self.sharepoint.read_list_columnar(list_title="Sample list", page_size=100)
+        self.assertTrue(df.equals(df_title))
+
+    def test_read_list_columns_filter(self):
+        """Columns, filter and order are applied in the server and lookups are flattened"""
+        list_id = self.add_list(100)
+        columns = ["Title", "Amount", "Author/Title"]
+        for read in self.sharepoint.read_list, self.sharepoint.read_list_columnar:
+            df = read(list_id=list_id, columns=columns, filter="Done eq true and Amount gt 100",
+                      order_by="ID desc")
+            self.assertEqual(df.columns.tolist(), columns)
+            self.assertEqual(df.index.tolist(), list(range(100, 67, -2)))
+            self.assertEqual(df.loc[70, "Author/Title"], "User 0")
+        query = parse_qs(urlparse(self.server.paths[-1]).query)
+        self.assertEqual(query["$select"], ["ID,Title,Amount,Author/Title"])
+        self.assertEqual(query["$expand"], ["Author"])
+        self.assertEqual(str(df["Amount"].dtype), "float64")
+
+    def test_read_list_parallel(self):
+        """Windows of IDs read concurrently give the same result as sequential pages"""
+        list_id = self.add_list(5000)
+        df = self.sharepoint.read_list(list_id=list_id)
+        self.assertEqual(self.server.max_active, 1)
+        df_parallel = self.sharepoint.read_list(list_id=list_id, max_workers=8, window_size=250)
+        # Library adds its own properties (e.g. ParentList) to items, so only the columns of rest api are compared
+        self.assertTrue(df[df_parallel.columns].equals(df_parallel))
+        self.assertGreater(self.server.max_active, 1)
+        columns = ["Title", "Author/Title"]
+        df_filter = self.sharepoint.read_list(list_id=list_id, columns=columns, filter="Units eq 3")
+        df_parallel = self.sharepoint.read_list(list_id=list_id, columns=columns, filter="Units eq 3",
+                                                max_workers=4, window_size=700)
+        self.assertTrue(df_filter.equals(df_parallel))
+        with self.assertRaises(ValueError):
+            self.sharepoint.read_list(list_id=list_id, order_by="Title", max_workers=4)
+
+    def test_read_list_throttled(self):
+        """Throttled requests are retried after Retry-After seconds"""
+        list_id = self.add_list(1000)
+        self.server.throttle_requests = 3
+        tic = time.perf_counter()
+        df = self.sharepoint.read_list(list_id=list_id, max_workers=4, window_size=100)
+        self.assertGreaterEqual(time.perf_counter() - tic, self.server.retry_after)
+        self.assertEqual(self.server.throttled, 3)
+        self.assertEqual(df.index.tolist(), list(range(1, 1001)))
+
+    def test_context_throttled(self):
+        """Throttled requests of the context are retried as well, instead of raising ClientRequestException"""
+        sharepoint = MockSharepoint(self.server.url, session=create_session())
+        url = next(iter(self.files))
+        self.server.throttle_requests = 2
+        self.server.retry_after = 0.2
+        self.assertTrue(sharepoint.exits(url))
+        self.assertEqual(self.server.throttled, 2)
+        stats = sharepoint.request_stats[urlparse(self.server.url).netloc]
+        self.assertEqual(stats.throttled, 2)
+        self.assertGreaterEqual(stats.wait_time, 0.4 * 0.9)
+        self.assertLess(stats.concurrency_limit, 32)
+
+    def test_read_list_cached(self):
+        """Cached reads only fetch modified items and drop deleted ones"""
+        list_id = self.add_list(1000)
+        cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        os.makedirs(cache_dir)
+        df = self.sharepoint.read_list_cached(list_id=list_id, cache_dir=cache_dir)
+        self.assertTrue(df.equals(self.sharepoint.read_list_columnar(list_id=list_id)))
+        items = self.server.lists[list_id]["items"]
+        items[4].update(Title="Changed", Modified="2024-02-01T10:00:00Z")
+        del items[6]
+        items.append(dict(items[0], ID=1001, Modified="2024-02-02T10:00:00Z"))
+        n_requests = self.server.requests
+        df = self.sharepoint.read_list_cached(list_title="Sample list", cache_dir=cache_dir)
+        self.assertTrue(df.equals(self.sharepoint.read_list_columnar(list_id=list_id)))
+        self.assertEqual(df.loc[5, "Title"], "Changed")
+        self.assertNotIn(7, df.index)
+        query = parse_qs(urlparse(self.server.paths[n_requests + 1]).query)
+        self.assertEqual(query["$filter"], ["Modified ge datetime'2024-01-28T10:00:00Z'"])
+        self.assertEqual(os.listdir(cache_dir), [f"{list_id}.sqlite"])
+
+    def test_write_list(self):
+        """Rows are inserted in batches, reporting errors per row"""
+        list_id = self.add_list(0)
+        df = pd.DataFrame(dict(Title=[f"New {i}" for i in range(250)], Amount=[i / 2 for i in range(250)]),
+                          index=range(1000, 1250))
+        written, errors = self.sharepoint.write_list(df, list_id=list_id)
+        self.assertEqual(errors, dict())
+        self.assertEqual(sorted(written), df.index.tolist())
+        self.assertEqual(self.server.batches, 3)
+        # Batches are written concurrently, so IDs do not follow the order of rows
+        df_list = self.sharepoint.read_list(list_id=list_id, columns=["Title", "Amount"])
+        self.assertTrue(df_list.loc[[written[index] for index in df.index]].reset_index(drop=True).equals(
+            df.reset_index(drop=True)))
+        wrong = pd.DataFrame(dict(Title=["Right", "Wrong"], Amount=[1., "wrong"]))
+        written, errors = self.sharepoint.write_list(wrong, list_title="Sample list")
+        self.assertEqual(written, {0: 251})
+        self.assertEqual(list(errors), [1])
+        self.assertIn("Cannot convert a primitive value", errors[1])
+        written, errors = self.sharepoint.write_list(wrong.assign(Wrong=1), list_id=list_id)
+        self.assertEqual((written, list(errors)), (dict(), [0, 1]))
+        self.assertEqual(errors[0], "400: Column 'Wrong' does not exist. It may have been deleted by another user.")
+
+    def test_write_list_upsert(self):
+        """Rows whose key exists update items, the rest are inserted"""
+        list_id = self.add_list(10)
+        df = pd.DataFrame(dict(Title=["Item 2", "Item 5", "Item 20"], Amount=[-1., -2., -3.]))
+        written, errors = self.sharepoint.write_list(df, list_id=list_id, mode="upsert", key="Title")
+        self.assertEqual((written, errors), ({0: 2, 1: 5, 2: 11}, dict()))
+        df_list = self.sharepoint.read_list_columnar(list_id=list_id)
+        self.assertEqual(df_list["Amount"].tolist(), [1.5, -1., 4.5, 6., -2., 9., 10.5, 12., 13.5, 15., -3.])
+        written, errors = self.sharepoint.write_list(df_list[["Title"]].iloc[:2].assign(Title="Renamed"),
+                                                     list_id=list_id, mode="upsert", key="ID")
+        self.assertEqual(written, {1: 1, 2: 2})
+        with self.assertRaises(ValueError):
+            self.sharepoint.write_list(df, list_id=list_id, mode="upsert")
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow not installed")
+    def test_read_list_parquet(self):
+        """Pages are streamed to a parquet file"""
+        list_id = self.add_list(1234)
+        parquet_path = os.path.join(self.tmp_dir.name, "list.parquet")
+        self.assertIsNone(self.sharepoint.read_list_columnar(list_id=list_id, page_size=100,
+                                                             parquet_path=parquet_path))
+        df = pd.read_parquet(parquet_path)
+        self.assertEqual(len(df), 1234)
+        self.assertEqual(df.loc[5, "Tags"], '["a", "b"]')
+
+    @skip_unless_benchmark
+    def test_benchmark_read_list(self):
+        """Compares peak memory and rows/s of read_list and read_list_columnar"""
+        n_items = 10_000
+        list_id = self.add_list(n_items)
+        self.server.latency = 0
+        results = dict()
+        for name, read in [("read_list", self.sharepoint.read_list),
+                           ("read_list_columnar", self.sharepoint.read_list_columnar)]:
+            tic = time.perf_counter()
+            df = read(list_id=list_id)
+            elapsed = time.perf_counter() - tic
+            del df
+            tracemalloc.start()
+            df = read(list_id=list_id)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = peak
+            report(f"{name}: {n_items / elapsed:,.0f} rows/s, peak memory {peak / 1024 ** 2:.1f}MB, "
+                   f"result {df.memory_usage(deep=True).sum() / 1024 ** 2:.1f}MB")
+            del df
+        self.assertLess(results["read_list_columnar"], results["read_list"])
+
+    def create_local_file(self, size: int) -> tuple:
+        """Creates a local file with random contents. Returns its path and contents"""
+        contents = os.urandom(size)
+        local_path = os.path.join(self.tmp_dir.name, "upload.bin")
+        with open(local_path, "wb") as f:
+            f.write(contents)
+        return local_path, contents
+
+    def test_upload_file_chunked(self):
+        """Uploads a file in several chunks"""
+        local_path, contents = self.create_local_file(3_000_000)
+        url = self.sharepoint.upload_file_chunked(local_path, "Shared Documents/folder 0", min_chunk_size=100_000)
+        self.assertEqual(url, "/sites/test/Shared Documents/folder 0/upload.bin")
+        self.assertEqual(self.server.files[url], contents)
+        self.assertFalse(os.path.exists(local_path + ".upload"))
+        self.assertEqual(self.server.uploads, dict())
+
+    def test_upload_file_chunked_resume(self):
+        """An interrupted upload continues from the last acknowledged offset"""
+        local_path, contents = self.create_local_file(1_000_000)
+        self.server.fail_upload_after = 3
+        with self.assertRaises(requests.HTTPError):
+            self.sharepoint.upload_file_chunked(local_path, min_chunk_size=100_000, max_chunk_size=100_000)
+        state = load_transfer_state(local_path + ".upload")
+        self.assertEqual(state["offset"], 300_000)
+        self.server.fail_upload_after = None
+        url = self.sharepoint.upload_file_chunked(local_path, min_chunk_size=100_000, max_chunk_size=100_000)
+        self.assertEqual(self.server.files[url], contents)
+        self.assertFalse(os.path.exists(local_path + ".upload"))
+
+    def test_upload_file_chunked_expired_session(self):
+        """If the upload session is no longer valid, upload starts from scratch"""
+        local_path, contents = self.create_local_file(1_000_000)
+        self.server.fail_upload_after = 3
+        with self.assertRaises(requests.HTTPError):
+            self.sharepoint.upload_file_chunked(local_path, min_chunk_size=100_000, max_chunk_size=100_000)
+        self.server.fail_upload_after = None
+        self.server.uploads.clear()
+        url = self.sharepoint.upload_file_chunked(local_path, min_chunk_size=100_000, max_chunk_size=100_000)
+        self.assertEqual(self.server.files[url], contents)
+
+    def test_upload_file_chunked_lost_start(self):
+        """If the response to StartUpload is lost, next call does not get stuck with the saved upload session"""
+        local_path, contents = self.create_local_file(1_000_000)
+        self.server.lose_upload_responses = 1
+        with self.assertRaises(requests.ConnectionError):
+            self.sharepoint.upload_file_chunked(local_path, min_chunk_size=100_000, max_chunk_size=100_000)
+        state = load_transfer_state(local_path + ".upload")
+        self.assertEqual(state["offset"], 0)
+        self.assertIn(state["upload_id"], self.server.uploads)
+        url = self.sharepoint.upload_file_chunked(local_path, min_chunk_size=100_000, max_chunk_size=100_000)
+        self.assertEqual(self.server.files[url], contents)
+        self.assertFalse(os.path.exists(local_path + ".upload"))
+
+    def test_download_file_resumable(self):
+        """Downloads a file in parallel ranges"""
+        url = "/sites/test/Shared Documents/large.bin"
+        self.server.files[url] = os.urandom(5_000_001)
+        local_path = self.sharepoint.download_file_resumable(url, self.tmp_dir.name, parallel_ranges=4,
+                                                             chunk_size=100_000)
+        with open(local_path, "rb") as f:
+            self.assertEqual(f.read(), self.server.files[url])
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["large.bin"])
+
+    def test_download_file_resumable_interrupted(self):
+        """An interrupted download continues from the bytes already written, and restarts if file changed"""
+        url = "/sites/test/Shared Documents/large.bin"
+        self.server.files[url] = os.urandom(1_000_000)
+        for parallel_ranges in (1, 3):
+            with self.subTest(parallel_ranges=parallel_ranges):
+                self.server.truncate_downloads = 200_000
+                with self.assertRaises(requests.RequestException):
+                    self.sharepoint.download_file_resumable(url, self.tmp_dir.name, parallel_ranges, 10_000)
+                state = load_transfer_state(os.path.join(self.tmp_dir.name, "large.bin.download"))
+                self.assertGreaterEqual(sum(r[2] - r[0] for r in state["ranges"]), 190_000)
+                self.server.truncate_downloads = None
+                if parallel_ranges > 1:
+                    # Remote file changes, so download must start again
+                    self.server.files[url] = os.urandom(1_000_000)
+                local_path = self.sharepoint.download_file_resumable(url, self.tmp_dir.name, parallel_ranges)
+                with open(local_path, "rb") as f:
+                    self.assertEqual(f.read(), self.server.files[url])
+                self.assertEqual(os.listdir(self.tmp_dir.name), ["large.bin"])
+                os.remove(local_path)
+
+    def test_exists_many(self):
+        """Existence checks and file properties are sent in batches and give the same results as one by one"""
+        missing = [f"/sites/test/Shared Documents/missing_{i}.bin" for i in range(10)]
+        urls = list(self.files) + missing
+        expected = {url: self.sharepoint.exits(url) for url in urls}
+        exists, errors = self.sharepoint.exists_many(urls, batch_size=20)
+        self.assertEqual(errors, dict())
+        self.assertEqual(exists, expected)
+        # Three requests instead of one per file
+        self.assertEqual(self.server.batches, 3)
+        properties, errors = self.sharepoint.get_files_many(urls)
+        self.assertEqual(set(errors), set(missing))
+        self.assertEqual({url: int(p['Length']) for url, p in properties.items()},
+                         {url: len(contents) for url, contents in self.files.items()})
+
+    def test_list_folders_many(self):
+        folders, errors = self.sharepoint.list_folders_many(["/sites/test/Shared Documents",
+                                                             "/sites/test/Shared Documents/folder 0"])
+        self.assertEqual(errors, dict())
+        self.assertEqual(list(folders["/sites/test/Shared Documents"]),
+                         [f"/sites/test/Shared Documents/folder {i}" for i in range(3)])
+        self.assertEqual(folders["/sites/test/Shared Documents/folder 0"], dict())
+
+    def test_metadata_cache(self):
+        """Repeated calls are answered from cache, expired files are revalidated with their ETag and own writes
+        invalidate cache"""
+        sharepoint = MockSharepoint(self.server.url, metadata_cache=MetadataCache(ttl=1))
+        folder = "/sites/test/Shared Documents/folder 0"
+        url = next(url for url in self.files if url.startswith(folder + "/"))
+        requests_before = self.server.requests
+        for _ in range(3):
+            self.assertEqual(list(sharepoint.list_folders()),
+                             [f"/sites/test/Shared Documents/folder {i}" for i in range(3)])
+            files = sharepoint.list_files_folder(folder)
+            self.assertTrue(sharepoint.exits(url))
+            self.assertFalse(sharepoint.exits(url + ".missing"))
+        self.assertEqual(self.server.requests - requests_before, 4)
+        self.assertEqual(files[url].length, len(self.files[url]))
+        self.assertEqual(sharepoint.metadata_cache.stats.hits, 8)
+        time.sleep(1)
+        self.assertEqual(sharepoint.get_file_properties(url)["Length"], str(len(self.files[url])))
+        self.assertEqual(sharepoint.metadata_cache.stats.revalidations, 1)
+        sharepoint.delete(url)
+        self.assertFalse(sharepoint.exits(url))
+        self.assertNotIn(url, sharepoint.list_files_folder(folder))
+        local_path = os.path.join(self.tmp_dir.name, "new.bin")
+        with open(local_path, "wb") as f:
+            f.write(b"new file")
+        sharepoint.upload_file(local_path, folder)
+        self.assertIn(folder + "/new.bin", sharepoint.list_files_folder(folder))
+        self.assertTrue(sharepoint.exits(folder + "/new.bin"))
+        # Every upload path invalidates the folder, also files too small for an upload session
+        for name, size in [("small.bin", 100), ("large.bin", 3000)]:
+            local_path = os.path.join(self.tmp_dir.name, name)
+            with open(local_path, "wb") as f:
+                f.write(os.urandom(size))
+            self.assertNotIn(folder + "/" + name, sharepoint.list_files_folder(folder))
+            sharepoint.upload_file_chunked(local_path, folder, min_chunk_size=1000)
+            self.assertIn(folder + "/" + name, sharepoint.list_files_folder(folder))
+            self.assertTrue(sharepoint.exits(folder + "/" + name))
+
+    def test_selenium_sharepoint(self):
+        """Subclasses that do not call Sharepoint.__init__ work with and without metadata cache"""
+        url = next(iter(self.files))
+        for metadata_cache in (None, MetadataCache()):
+            sharepoint = SeleniumSharepoint(self.server.url, token_broker=FakeSeleniumBroker(),
+                                            metadata_cache=metadata_cache)
+            self.assertEqual(list(sharepoint.list_folders()),
+                             [f"/sites/test/Shared Documents/folder {i}" for i in range(3)])
+            self.assertIn(url, sharepoint.list_files_folder(url.rsplit("/", 1)[0]))
+            self.assertTrue(sharepoint.exits(url))
+            self.assertIs(sharepoint.metadata_cache, metadata_cache)
+
+    def test_walk(self):
+        """Walks nested folders listing siblings concurrently, honouring max_depth"""
+        for i in range(3):
+            for j in range(4):
+                self.server.files[f"/sites/test/Shared Documents/folder {i}/sub {j}/deep/file.bin"] = b"deep"
+        root = "/sites/test/Shared Documents"
+        walked = {folder: (folders, files) for folder, folders, files in self.sharepoint.walk(max_workers=8)}
+        self.assertEqual(len(walked), 1 + 3 + 12 + 12)
+        # Folders of the same level are listed at once
+        self.assertGreater(self.server.max_active, 2)
+        listed = {f"{folder}/{name}" for folder, (_, files) in walked.items() for name in files}
+        self.assertEqual(listed, set(self.server.files))
+        self.assertEqual(set(walked[root][0]), {f"folder {i}" for i in range(3)})
+        self.assertEqual(walked[root + "/folder 0/sub 0"][0]["deep"]["ServerRelativeUrl"],
+                         root + "/folder 0/sub 0/deep")
+        shallow = [folder for folder, _, _ in self.sharepoint.walk(root + "/folder 1/", max_depth=1)]
+        self.assertEqual(shallow[0], root + "/folder 1")
+        self.assertEqual(set(shallow[1:]), {f"{root}/folder 1/sub {j}" for j in range(4)})
+
+    def test_delete_many(self):
+        """Each deletion is independent, so missing files are reported without stopping the rest"""
+        urls = list(self.files)[:30]
+        missing = "/sites/test/Shared Documents/missing.bin"
+        deleted, errors = self.sharepoint.delete_many([missing] + urls, batch_size=8)
+        self.assertEqual(set(deleted), set(urls))
+        self.assertEqual(list(errors), [missing])
+        self.assertTrue(errors[missing].startswith("404"))
+        self.assertFalse(set(urls) & set(self.server.files))
+        self.assertEqual(len(self.server.files), self.n_files - len(urls))
+
+    def test_connection_reuse(self):
+        """Requests of the context and raw requests of several threads share a pool of kept alive connections"""
+        pool_size = 4
+        sharepoint = MockSharepoint(self.server.url, session=create_session(pool_size=pool_size))
+        list_id = self.add_list(1000)
+        sharepoint.read_list(list_id=list_id)
+        _, errors = sharepoint.download_many(self.files, self.tmp_dir.name, max_workers=pool_size)
+        self.assertEqual(errors, dict())
+        stats = sharepoint.connection_stats
+        self.assertLessEqual(stats.created, pool_size)
+        self.assertGreaterEqual(stats.requests, self.server.requests)
+        self.assertGreater(stats.reused, stats.created * 5)
+
+    def test_benchmark_download_many(self):
+        """Compares sequential download_file against download_many, that sends several requests at once"""
+        urls = list(self.files)
+        tic = time.perf_counter()
+        for url in urls:
+            self.sharepoint.download_file(url, self.tmp_dir.name)
+        sequential = time.perf_counter() - tic
+        tic = time.perf_counter()
+        _, errors = self.sharepoint.download_many(urls, self.tmp_dir.name, max_workers=8)
+        parallel = time.perf_counter() - tic
+        report(f"{len(urls)} files with {self.latency * 1000:.0f}ms latency: sequential {sequential:.2f}s, "
+               f"download_many {parallel:.2f}s ({sequential / parallel:.1f}x)")
+        self.assertEqual(errors, dict())
+        self.assertGreater(self.server.max_active, 1)
+        self.assertLessEqual(self.server.max_active, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
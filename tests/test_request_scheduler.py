@@ -0,0 +1,100 @@
+"""
+Tests of RequestScheduler: Retry-After, AIMD concurrency control and token bucket of each resource
+"""
+import threading
+import time
+import unittest
+
+import requests
+
+from ong_office365.request_scheduler import RequestScheduler, ResourceLimiter, retry_after_seconds
+
+
+def throttled_response(retry_after: str = None, status: int = 429) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return response
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(retry_after_seconds(throttled_response("3"), 0), 3)
+        self.assertAlmostEqual(retry_after_seconds(throttled_response("Wed, 21 Oct 2015 07:28:00 GMT"), 0), 0)
+        self.assertEqual(retry_after_seconds(throttled_response(status=503), 2), 4)
+
+    def test_resources(self):
+        """Each host has its own limiter"""
+        scheduler = RequestScheduler(max_concurrency=4)
+        self.assertIs(scheduler.limiter("https://contoso.sharepoint.com/sites/a/_api/web"),
+                      scheduler.limiter("https://CONTOSO.sharepoint.com/sites/b"))
+        self.assertIsNot(scheduler.limiter("https://contoso.sharepoint.com/"),
+                         scheduler.limiter("https://graph.microsoft.com/v1.0/me"))
+
+    def test_aimd(self):
+        """Concurrency is halved once per throttling episode and recovers with successful requests"""
+        limiter = ResourceLimiter(max_concurrency=16)
+        for _ in range(8):
+            limiter.acquire()
+        for _ in range(8):
+            limiter.release(retry_after=0.2)
+        self.assertEqual(limiter.stats.concurrency_limit, 8)
+        self.assertEqual(limiter.stats.throttled, 8)
+        tic = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - tic, 0.15)
+        limiter.release()
+        for _ in range(100):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.stats.concurrency_limit, 16)
+        self.assertGreaterEqual(limiter.stats.wait_time, 0.15)
+
+    def test_concurrency_limit(self):
+        """No more than the concurrency limit of requests are in flight at once"""
+        limiter = ResourceLimiter(max_concurrency=3)
+        in_flight, max_in_flight, lock = [0], [0], threading.Lock()
+
+        def request():
+            limiter.acquire()
+            with lock:
+                in_flight[0] += 1
+                max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+            limiter.release()
+
+        threads = [threading.Thread(target=request) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max_in_flight[0], 3)
+        self.assertEqual(limiter.stats.requests, 20)
+
+    def test_token_bucket(self):
+        """After the burst, requests are sent at the given rate"""
+        limiter = ResourceLimiter(max_concurrency=8, rate=50, burst=5)
+        tic = time.monotonic()
+        for _ in range(25):
+            limiter.acquire()
+            limiter.release()
+        self.assertGreaterEqual(time.monotonic() - tic, 20 / 50 * 0.9)
+
+    def test_release(self):
+        """Throttled requests are retried until max_retries"""
+        scheduler = RequestScheduler(max_concurrency=4, max_retries=2)
+        url = "https://contoso.sharepoint.com/_api/web"
+        for attempt, expected in enumerate([0.01, 0.01, None]):
+            scheduler.acquire(url)
+            self.assertEqual(scheduler.release(url, throttled_response("0.01"), attempt), expected)
+        scheduler.acquire(url)
+        self.assertIsNone(scheduler.release(url, None, 0))
+        self.assertEqual(scheduler.stats["contoso.sharepoint.com"].throttled, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()